@@ -0,0 +1,30 @@
+"""
+Start-up latency of the ``idemseq`` command in a new process, including interpreter start-up
+and imports: ``idemseq --help``, which doesn't import any base, and ``idemseq <base> list``.
+Start-up of the interpreter alone, and with click imported, are measured for reference.
+"""
+import os
+import subprocess
+import sys
+
+from timing import best_of
+
+
+def benchmarks(quick=False):
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(p for p in (root, env.get('PYTHONPATH')) if p)
+    repeat = 3 if quick else 5
+
+    commands = (
+        ('cli.python_startup', ['-c', 'pass']),
+        ('cli.import_click', ['-c', 'import click']),
+        ('cli.help', ['-m', 'idemseq.cli', '--help']),
+        ('cli.list', ['-m', 'idemseq.cli', 'idemseq.examples.example01:example', 'list']),
+    )
+    with open(os.devnull, 'w') as devnull:
+        for name, args in commands:
+            yield name, best_of(
+                lambda: subprocess.check_call([sys.executable] + args, env=env, stdout=devnull, stderr=devnull),
+                repeat=repeat,
+            )
@@ -0,0 +1,39 @@
+"""
+Cost of setting up a dry run over a sequence with finished commands, and of running one.
+"""
+import os
+import shutil
+import tempfile
+
+from idemseq.command import Command
+from idemseq.sequence import SequenceBase
+
+from timing import best_of
+
+
+def benchmarks(quick=False):
+    size = 200 if quick else 1000
+    base = SequenceBase(*[Command(lambda: None, name='command_{}'.format(i)) for i in range(size)])
+    directory = tempfile.mkdtemp()
+    try:
+        sequence = base(os.path.join(directory, 'dry-run.db'))
+        sequence.run(stop_before='command_{}'.format(size // 2))
+
+        def set_up_dry_run(sequence):
+            with sequence.env(dry_run=True), sequence._status_snapshot():
+                sequence._get_known_statuses()
+
+        def forget_dry_run():
+            sequence._dry_run_state_registry_instance = None
+            return sequence
+
+        yield 'dry_run.setup.n={}'.format(size), best_of(set_up_dry_run, setup=forget_dry_run, number=1, repeat=20)
+
+        def dry_run(sequence):
+            sequence.run(dry_run=True)
+
+        seconds = best_of(dry_run, setup=forget_dry_run, repeat=3)
+        yield 'dry_run.run.per_step.n={}'.format(size), seconds / (size - size // 2)
+        sequence.close()
+    finally:
+        shutil.rmtree(directory)
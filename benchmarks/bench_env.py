@@ -0,0 +1,64 @@
+"""
+Compares lookup cost of context and run options in nested sequence envs
+for the flattened env (the default) and the linked-parent design.
+
+    PYTHONPATH=. python benchmarks/bench_env.py
+
+`benchmarks` measures the default design for the suite, see run.py.
+"""
+import timeit
+
+from idemseq.base import AttrDict, Options
+from idemseq.sequence import SequenceEnv, SequenceRunOptions
+
+
+class LinkedSequenceRunOptions(Options):
+    _valid_options = SequenceRunOptions._valid_options
+
+
+class LinkedSequenceEnv(SequenceEnv):
+    context_cls = AttrDict
+    run_options_cls = LinkedSequenceRunOptions
+
+
+def measure(env_cls, depth, number=10000):
+    uid = 'bench-{}-{}'.format(env_cls.__name__, depth)
+    envs = [env_cls(sequence_uid=uid, context={'level_{}'.format(i): i}) for i in range(depth)]
+    envs[0].run_options.force = True
+
+    push_time = timeit.timeit(lambda: [env.push() for env in envs] and [env.pop() for env in reversed(envs)], number=10)
+    push_time /= 10
+
+    for env in envs:
+        env.push()
+    top = envs[-1]
+    try:
+        option_time = timeit.timeit(lambda: top.run_options.force, number=number) / number
+        context_time = timeit.timeit(lambda: top.context.level_0, number=number) / number
+    finally:
+        for env in reversed(envs):
+            env.pop()
+
+    return push_time, option_time, context_time
+
+
+def benchmarks(quick=False):
+    for depth in (1, 10, 100):
+        push_time, option_time, context_time = measure(SequenceEnv, depth, number=1000 if quick else 10000)
+        yield 'env.push_all.depth={}'.format(depth), push_time
+        yield 'env.option_lookup.depth={}'.format(depth), option_time
+        yield 'env.context_lookup.depth={}'.format(depth), context_time
+
+
+def main():
+    print('{:>20} {:>6} {:>14} {:>14} {:>14}'.format('env', 'depth', 'push all (ms)', 'option (us)', 'context (us)'))
+    for depth in (1, 10, 100, 500):
+        for env_cls in (SequenceEnv, LinkedSequenceEnv):
+            push_time, option_time, context_time = measure(env_cls, depth)
+            print('{:>20} {:>6} {:>14.3f} {:>14.3f} {:>14.3f}'.format(
+                env_cls.__name__, depth, push_time * 1e3, option_time * 1e6, context_time * 1e6,
+            ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,18 @@
+"""
+Overhead of `Sequence.run` per step, for sequences of no-op commands.
+"""
+from idemseq.command import Command
+from idemseq.sequence import SequenceBase
+
+from timing import best_of
+
+
+def create_base(size):
+    return SequenceBase(*[Command(lambda: None, name='command_{}'.format(i)) for i in range(size)])
+
+
+def benchmarks(quick=False):
+    for size in (10, 100, 1000) if quick else (10, 100, 1000, 10000):
+        base = create_base(size)
+        seconds = best_of(lambda sequence: sequence.run(), setup=base, repeat=3 if size >= 1000 else 5)
+        yield 'run.per_step.n={}'.format(size), seconds / size
@@ -0,0 +1,54 @@
+"""
+Throughput of `SqliteStateRegistry` writes and reads, in a database file and in memory.
+"""
+import os
+import shutil
+import tempfile
+
+from idemseq.command import Command
+from idemseq.persistence import SqliteStateRegistry
+from idemseq.sequence import SequenceCommand
+
+from timing import best_of
+
+
+def benchmarks(quick=False):
+    size = 200 if quick else 1000
+    commands = [SequenceCommand(Command(lambda: None, name='command_{}'.format(i))) for i in range(size)]
+    directory = tempfile.mkdtemp()
+    try:
+        for database in ('file', 'memory'):
+            counter = [0]
+
+            def create_registry(batch_writes=False):
+                if database == 'memory':
+                    registry = SqliteStateRegistry(batch_writes=batch_writes)
+                else:
+                    counter[0] += 1
+                    path = os.path.join(directory, 'bench-{}.db'.format(counter[0]))
+                    registry = SqliteStateRegistry(path, batch_writes=batch_writes)
+                registry.get_known_statuses()
+                return registry
+
+            def write(registry):
+                for command in commands:
+                    registry.update_status(command, SequenceCommand.status_finished)
+                registry.flush()
+
+            seconds = best_of(write, setup=create_registry, repeat=3)
+            yield 'sqlite.{}.write.per_status'.format(database), seconds / size
+
+            seconds = best_of(write, setup=lambda: create_registry(batch_writes=True), repeat=3)
+            yield 'sqlite.{}.batched_write.per_status'.format(database), seconds / size
+
+            registry = create_registry()
+            write(registry)
+            yield 'sqlite.{}.get_status'.format(database), best_of(
+                lambda: registry.get_status(commands[size // 2]), number=1000,
+            )
+            yield 'sqlite.{}.get_known_statuses.per_status'.format(database), best_of(
+                registry.get_known_statuses, number=10,
+            ) / size
+            registry.close()
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,99 @@
+"""
+Runs the benchmark suite and prints the results as JSON: seconds per operation
+(per step, per status, per lookup...) by benchmark name, lower is better.
+
+    PYTHONPATH=. python benchmarks/run.py --output baseline.json
+    PYTHONPATH=. python benchmarks/run.py --baseline baseline.json
+
+With ``--baseline``, results are compared to those stored in the file, and the exit status
+is 1 if any benchmark is slower than its baseline by more than ``--tolerance``.
+Compare results from the same machine only.
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+
+import bench_cli
+import bench_dry_run
+import bench_env
+import bench_run
+import bench_sqlite
+
+suites = (
+    ('run', bench_run),
+    ('sqlite', bench_sqlite),
+    ('dry_run', bench_dry_run),
+    ('env', bench_env),
+    ('cli', bench_cli),
+)
+
+
+def run_benchmarks(only=None, quick=False):
+    results = {}
+    for name, suite in suites:
+        if only and name not in only:
+            continue
+        for benchmark, seconds in suite.benchmarks(quick=quick):
+            sys.stderr.write('{:<50} {:>14.3f} us\n'.format(benchmark, seconds * 1e6))
+            results[benchmark] = seconds
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns a list of tuples of benchmark name, baseline seconds, current seconds and ratio
+    of those for benchmarks present in both, and whether any of them regressed.
+    """
+    rows = []
+    regressed = False
+    for benchmark in sorted(set(results) & set(baseline)):
+        ratio = results[benchmark] / baseline[benchmark] if baseline[benchmark] else float('inf')
+        regressed = regressed or ratio > 1 + tolerance
+        rows.append((benchmark, baseline[benchmark], results[benchmark], ratio))
+    return rows, regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--only', action='append', choices=[name for name, _ in suites], help='Run only these suites')
+    parser.add_argument('--quick', action='store_true', help='Smaller sizes, fewer rounds')
+    parser.add_argument('--output', help='Write results to this file instead of standard output')
+    parser.add_argument('--baseline', help='Compare results to those in this file')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed slowdown, 0.25 for 25%%')
+    args = parser.parse_args(argv)
+
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'quick': args.quick,
+            'timestamp': time.time(),
+        },
+        'results': run_benchmarks(only=args.only, quick=args.quick),
+    }
+
+    encoded = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(encoded + '\n')
+    else:
+        print(encoded)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        rows, regressed = compare(report['results'], baseline, args.tolerance)
+        sys.stderr.write('\n{:<50} {:>14} {:>14} {:>8}\n'.format('benchmark', 'baseline (us)', 'current (us)', 'ratio'))
+        for benchmark, before, after, ratio in rows:
+            sys.stderr.write('{:<50} {:>14.3f} {:>14.3f} {:>8.2f}{}\n'.format(
+                benchmark, before * 1e6, after * 1e6, ratio, ' !' if ratio > 1 + args.tolerance else '',
+            ))
+        return 1 if regressed else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,27 @@
+"""
+Timing helpers shared by the benchmarks.
+"""
+import timeit
+
+
+def best_of(func, number=1, repeat=5, setup=None):
+    """
+    Returns the best time in seconds of one call of ``func`` out of ``repeat`` rounds
+    of ``number`` calls. ``setup``, if passed, is called before every round and its return
+    value is passed to ``func``, so that every round starts from the same state.
+    """
+    best = None
+    for _ in range(repeat):
+        arg = setup() if setup is not None else None
+        timer = timeit.default_timer
+        if setup is not None:
+            started = timer()
+            for _ in range(number):
+                func(arg)
+        else:
+            started = timer()
+            for _ in range(number):
+                func()
+        elapsed = (timer() - started) / number
+        best = elapsed if best is None else min(best, elapsed)
+    return best
@@ -0,0 +1,370 @@
+"""
+asyncio support for running sequences from coroutines. Requires Python 3.5+.
+
+Sequence and command state are only touched from the event loop's thread.
+Blocking state registry calls and plain (non-coroutine) commands are run in
+an executor so that one event loop can drive many sequences concurrently.
+
+Coroutine commands which time out are cancelled like any other task; plain commands
+are asked to stop, see `idemseq.cancellation`.
+
+`run_sequence` selects commands, holds the sequence's lease and reports metrics like
+`Sequence.run`. With the ``max_workers`` run option, up to that many independent commands
+run concurrently as tasks on the loop. ``executor='process'`` is not supported.
+"""
+import asyncio
+import functools
+import logging
+import time
+import weakref
+
+from idemseq.cancellation import Cancellation
+from idemseq.metrics import measure_command, measure_run
+from idemseq.sequence import SequenceCommand
+
+log = logging.getLogger(__name__)
+
+
+class AsyncStateRegistry(object):
+    """
+    Adapts a `StateRegistry` for use from coroutines.
+
+    Calls to blocking registries are run in ``executor`` (the loop's default executor if None),
+    one at a time per registry, because a registry's connection must not be used concurrently.
+    Registries with native asyncio support can subclass this and override the coroutine methods.
+    """
+
+    def __init__(self, state_registry, executor=None):
+        self._state_registry = state_registry
+        self._executor = executor
+        self._lock = None
+
+    @property
+    def state_registry(self):
+        return self._state_registry
+
+    async def _call(self, method, *args):
+        if not self._state_registry.blocking:
+            return method(*args)
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            return await asyncio.get_event_loop().run_in_executor(self._executor, functools.partial(method, *args))
+
+    async def update_status(self, command, status):
+        return await self._call(self._state_registry.update_status, command, status)
+
+    async def record_attempt(self, *args):
+        return await self._call(self._state_registry.record_attempt, *args)
+
+    async def get_known_statuses(self):
+        return await self._call(self._state_registry.get_known_statuses)
+
+    async def flush(self):
+        return await self._call(self._state_registry.flush)
+
+    async def save_result(self, *args):
+        return await self._call(self._state_registry.save_result, *args)
+
+    async def load_result(self, command):
+        return await self._call(self._state_registry.load_result, command)
+
+    async def get_input_hashes(self):
+        return await self._call(self._state_registry.get_input_hashes)
+
+    async def acquire_lease(self, resource, owner, ttl):
+        return await self._call(self._state_registry.acquire_lease, resource, owner, ttl)
+
+    async def release_lease(self, resource, owner):
+        return await self._call(self._state_registry.release_lease, resource, owner)
+
+    async def heartbeat(self):
+        return await self._call(self._state_registry.heartbeat)
+
+
+# AsyncStateRegistry instances by event loop, then by state registry, because
+# their locks can only be used on the loop they were created on
+_async_state_registries = weakref.WeakKeyDictionary()
+
+
+def get_async_state_registry(state_registry):
+    """
+    Returns the `AsyncStateRegistry` for the state registry on the current event loop,
+    creating it on first use.
+    """
+    loop = asyncio.get_event_loop()
+    if loop not in _async_state_registries:
+        _async_state_registries[loop] = weakref.WeakKeyDictionary()
+    registries = _async_state_registries[loop]
+    if state_registry not in registries:
+        registries[state_registry] = AsyncStateRegistry(state_registry)
+    return registries[state_registry]
+
+
+async def _load_status_snapshot(sequence):
+    state_registry = sequence._state_registry
+    if state_registry not in sequence._status_snapshots:
+        statuses = await get_async_state_registry(state_registry).get_known_statuses()
+        sequence._status_snapshots[state_registry] = dict(statuses)
+
+
+async def _set_command_status(sequence_command, status):
+    sequence = sequence_command._sequence
+    for state_registry in sequence._state_registries_to_update():
+        await get_async_state_registry(state_registry).update_status(sequence_command, status)
+        sequence._update_status_snapshots(state_registry, sequence_command.name, status)
+    sequence._discard_dry_run_status(sequence_command, status)
+
+
+async def _record_attempt(sequence_command, timing, error=None):
+    sequence = sequence_command._sequence
+    for record in sequence._attempt_records(sequence_command, timing, error=error):
+        await get_async_state_registry(sequence._real_state_registry).record_attempt(*record)
+
+
+async def _load_stored_results(sequence_command):
+    """
+    Loads, without blocking the loop, the stored results that preparing the command may need:
+    input hashes and the results of persisting commands its parameters are named after.
+    """
+    sequence = sequence_command._sequence
+    if sequence_command.tracks_inputs and sequence._input_hashes is None:
+        input_hashes = await get_async_state_registry(sequence._real_state_registry).get_input_hashes()
+        sequence._input_hashes = dict(input_hashes)
+    needed = []
+    for name in sequence_command.command.binding_plan.names:
+        if name in sequence._base and sequence[name].options.persist_result:
+            needed.append(sequence[name])
+    for command in needed:
+        if command.name not in sequence._stored_results:
+            stored = await get_async_state_registry(sequence._real_state_registry).load_result(command)
+            sequence._stored_results[command.name] = stored
+
+
+async def _load_selection_inputs(sequence):
+    """
+    Loads, without blocking the loop, what `Sequence._select_commands` needs
+    to decide whether finished commands which track their inputs run again.
+    """
+    statuses = sequence._get_known_statuses()
+    for command in sequence.all_commands:
+        if command.tracks_inputs and statuses.get(command.name) == SequenceCommand.status_finished:
+            await _load_stored_results(command)
+
+
+async def _acquire_lease(sequence):
+    """
+    Acquires the lease like `Sequence._lease` does. Returns True if the caller
+    must release it with `_release_lease`.
+    """
+    if sequence.lease_ttl is None or sequence.run_options.dry_run or sequence._lease_depth:
+        sequence._lease_depth += 1
+        return False
+    state_registry = get_async_state_registry(sequence._real_state_registry)
+    retry_delays = sequence._lease_retry_delays(time.time() + sequence.lease_timeout)
+    while not await state_registry.acquire_lease(sequence.lease_resource, sequence.lease_owner, sequence.lease_ttl):
+        await asyncio.sleep(next(retry_delays))
+    sequence._lease_depth += 1
+    return True
+
+
+async def _release_lease(sequence, acquired):
+    sequence._lease_depth -= 1
+    if acquired:
+        await get_async_state_registry(sequence._real_state_registry).release_lease(
+            sequence.lease_resource, sequence.lease_owner,
+        )
+
+
+async def _heartbeat(sequence):
+    if sequence._lease_depth and sequence.lease_ttl is not None and not sequence.run_options.dry_run:
+        await get_async_state_registry(sequence._real_state_registry).heartbeat()
+
+
+async def _save_result(sequence_command, result, kwargs):
+    sequence = sequence_command._sequence
+    record = sequence._result_record(sequence_command, result, kwargs)
+    if record is not None:
+        await get_async_state_registry(sequence._real_state_registry).save_result(*record)
+
+
+async def _call_coroutine_command(sequence_command, kwargs, timing):
+    """
+    Awaits the coroutine command, retrying it as `SequenceCommand._execute` retries other commands.
+    """
+    sequence = sequence_command._sequence
+    command = sequence_command.command
+    log.debug('Command "{}" starting'.format(command.name))
+    while True:
+        timing['started_at'] = time.time()
+        try:
+            # CPU time measured here includes other coroutines that ran while this one was waiting
+            with measure_command(sequence.metrics, sequence, command.name):
+                result = await command._func(**kwargs)
+        except Exception as e:
+            timing['finished_at'] = time.time()
+            delay = sequence_command._schedule_retry(e, timing)
+            if delay is None:
+                log.error('Command "{}" failed with an exception'.format(command.name))
+                raise
+        else:
+            timing['finished_at'] = time.time()
+            log.debug('Command "{}" finished'.format(command.name))
+            return result
+        await asyncio.sleep(delay)
+
+
+class _TimedOut(Exception):
+    pass
+
+
+async def _wait_for(awaitable, timeout):
+    """
+    Like `asyncio.wait_for`, but raises `_TimedOut`, so that a TimeoutError raised by
+    the command itself is not mistaken for the command timing out.
+    """
+    task = asyncio.ensure_future(awaitable)
+    done, _ = await asyncio.wait([task], timeout=timeout)
+    if not done:
+        task.cancel()
+        await asyncio.wait([task])
+        raise _TimedOut()
+    return task.result()
+
+
+async def _run_in_status_snapshot(sequence, run):
+    """
+    Awaits ``run()`` within the sequence's status snapshot. If the snapshot is the outermost one,
+    batched writes are flushed through `AsyncStateRegistry` before leaving it, so that
+    `Sequence._status_snapshot` has nothing left to flush on the loop's thread.
+    """
+    outermost = sequence._status_snapshots is None
+    with sequence._status_snapshot():
+        if not outermost:
+            return await run()
+        state_registry = get_async_state_registry(sequence._real_state_registry)
+        try:
+            result = await run()
+        except BaseException:
+            try:
+                await state_registry.flush()
+            except Exception:
+                log.exception('Failed to flush state registry after an error')
+            raise
+        await state_registry.flush()
+        return result
+
+
+async def run_command(sequence_command):
+    """
+    Runs a single sequence command, see `SequenceCommand.run_async`.
+    """
+    return await _run_in_status_snapshot(sequence_command._sequence, lambda: _run_command(sequence_command))
+
+
+async def _run_command(sequence_command):
+    sequence = sequence_command._sequence
+    with sequence_command._warn_only_failures():
+        await _load_status_snapshot(sequence)
+        await _load_stored_results(sequence_command)
+
+        prepared = sequence_command._prepare()
+        if prepared is None:
+            return
+        kwargs, dry_run = prepared
+
+        timing = {}
+        cancellation = Cancellation()
+        try:
+            if dry_run:
+                result = sequence_command._execute(kwargs, dry_run=True)
+            elif sequence_command.command.is_coroutine:
+                result = await _wait_for(
+                    _call_coroutine_command(sequence_command, kwargs, timing), sequence_command.timeout,
+                )
+            else:
+                result = await _wait_for(
+                    asyncio.get_event_loop().run_in_executor(None, functools.partial(
+                        sequence_command._execute, kwargs, timing=timing, cancellation=cancellation,
+                    )),
+                    sequence_command.timeout,
+                )
+        except _TimedOut:
+            timed_out_timing = {}
+            error = sequence_command._cancel(cancellation, timing, timed_out_timing)
+            await _record_attempt(sequence_command, timed_out_timing, error=error)
+            await _set_command_status(sequence_command, SequenceCommand.status_timed_out)
+            raise error
+        except Exception as e:
+            await _record_attempt(sequence_command, timing, error=e)
+            raise
+
+        await _record_attempt(sequence_command, timing)
+        await _save_result(sequence_command, result, kwargs)
+        await _set_command_status(sequence_command, SequenceCommand.status_finished)
+        return result
+
+
+async def _run_concurrently(sequence, commands):
+    """
+    Runs up to ``max_workers`` commands at a time as tasks, starting each command as soon as
+    the commands it depends on are done, like `Sequence._run_concurrently` does with threads.
+    On failure no further commands are started, the running ones are waited for,
+    and the first exception is raised.
+    """
+    pending = list(commands)
+    unfinished_names = set(c.name for c in commands)
+    running = {}
+    error = None
+    try:
+        while pending or running:
+            if error is None:
+                ready = [
+                    c for c in pending
+                    if not unfinished_names.intersection(sequence._base.dependencies_of(c.name))
+                ]
+                for command in ready[:sequence.run_options.max_workers - len(running)]:
+                    pending.remove(command)
+                    running[asyncio.ensure_future(run_command(command))] = command
+            if not running:
+                break
+            done, _ = await asyncio.wait(list(running), return_when=asyncio.FIRST_COMPLETED)
+            await _heartbeat(sequence)
+            for task in done:
+                unfinished_names.discard(running.pop(task).name)
+                if task.exception() is not None:
+                    error = error or task.exception()
+    finally:
+        if running:
+            for task in running:
+                task.cancel()
+            await asyncio.wait(list(running))
+    if error is not None:
+        raise error
+
+
+async def run_sequence(sequence, context=None, **run_options):
+    """
+    Runs the commands of the sequence, see `Sequence.run_async`.
+    """
+    with measure_run(sequence.metrics, sequence), sequence.env(context=context, **run_options):
+        if sequence.run_options.executor == 'process':
+            raise ValueError('Commands of sequences run with run_async() can not run in processes')
+
+        acquired = await _acquire_lease(sequence)
+        try:
+            await _run_in_status_snapshot(sequence, lambda: _run_commands(sequence))
+        finally:
+            await _release_lease(sequence, acquired)
+
+
+async def _run_commands(sequence):
+    await _load_status_snapshot(sequence)
+    await _load_selection_inputs(sequence)
+    commands = sequence._select_commands(on_skip=sequence._observe_skip)
+    if sequence.run_options.max_workers:
+        await _run_concurrently(sequence, commands)
+    else:
+        for command in commands:
+            await run_command(command)
+            await _heartbeat(sequence)
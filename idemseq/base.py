@@ -29,6 +29,14 @@ class AttrDict(dict):
         else:
             return False
 
+    def flat_view(self):
+        """
+        Returns a new dictionary of own and inherited values.
+        """
+        flat = dict(self._parent_.flat_view()) if self._parent_ is not None else {}
+        flat.update(dict.items(self))
+        return flat
+
 
 class Options(dict):
     _valid_options = {}
@@ -76,6 +84,115 @@ class Options(dict):
         else:
             return False
 
+    def flat_view(self):
+        """
+        Returns a new dictionary of own and inherited explicitly set options.
+        """
+        flat = dict(self._parent_options_.flat_view()) if self._parent_options_ is not None else {}
+        flat.update(dict.items(self))
+        return flat
+
+
+class FlatViewMixin(object):
+    """
+    Materialises a flat view of own and inherited values of an `AttrDict` or `Options`
+    when the parent is set, so that lookups don't walk the chain of parents.
+    Subclasses name the attribute holding the parent in ``_parent_attr``.
+
+    The flat view is a snapshot: writes to this dictionary are reflected in it,
+    but changes made to the parents after `set_parent` are not.
+    """
+
+    _parent_attr = None
+
+    def __init__(self, *args, **kwargs):
+        super(FlatViewMixin, self).__init__(*args, **kwargs)
+        dict.__setattr__(self, '_flat_', dict(self))
+
+    def __getattr__(self, item):
+        if item == '_flat_':
+            # Not initialised yet, for example while being copied
+            raise AttributeError(item)
+        try:
+            return self._flat_[item]
+        except KeyError:
+            return self._get_missing(item)
+
+    def _get_missing(self, item):
+        raise AttributeError(item)
+
+    def __setitem__(self, key, value):
+        super(FlatViewMixin, self).__setitem__(key, value)
+        self._flat_[key] = value
+
+    def __delitem__(self, key):
+        super(FlatViewMixin, self).__delitem__(key)
+        self._rebuild_flat_view()
+
+    def __contains__(self, item):
+        return item in self._flat_
+
+    def update(self, *args, **kwargs):
+        super(FlatViewMixin, self).update(*args, **kwargs)
+        self._rebuild_flat_view()
+
+    def pop(self, *args):
+        value = super(FlatViewMixin, self).pop(*args)
+        self._rebuild_flat_view()
+        return value
+
+    def popitem(self):
+        item = super(FlatViewMixin, self).popitem()
+        self._rebuild_flat_view()
+        return item
+
+    def setdefault(self, key, default=None):
+        value = super(FlatViewMixin, self).setdefault(key, default)
+        self._rebuild_flat_view()
+        return value
+
+    def clear(self):
+        super(FlatViewMixin, self).clear()
+        self._rebuild_flat_view()
+
+    def set_parent(self, parent):
+        super(FlatViewMixin, self).set_parent(parent)
+        self._rebuild_flat_view()
+
+    def flat_view(self):
+        """
+        Returns the merged mapping of all visible values. It is shared, don't modify it.
+        """
+        return self._flat_
+
+    def _rebuild_flat_view(self):
+        parent = getattr(self, self._parent_attr)
+        flat = dict(parent.flat_view()) if parent is not None else {}
+        flat.update(dict.items(self))
+        dict.__setattr__(self, '_flat_', flat)
+
+
+class FlatAttrDict(FlatViewMixin, AttrDict):
+    """
+    An `AttrDict` with a flat view of its own and all inherited values, see `FlatViewMixin`.
+    """
+
+    _parent_attr = '_parent_'
+
+
+class FlatOptions(FlatViewMixin, Options):
+    """
+    `Options` with a flat view of explicitly set options of their own and of their parents,
+    see `FlatViewMixin`. Options not set anywhere in the chain resolve to their defaults.
+    """
+
+    _parent_attr = '_parent_options_'
+
+    def _get_missing(self, item):
+        if item in self._valid_options:
+            return self._valid_options[item]
+        raise AttributeError(item)
+
 
 class DryRunResult(object):
     def __init__(self, **call_details):
@@ -0,0 +1,70 @@
+"""
+Cooperative cancellation of commands which run for longer than their timeout,
+see the ``timeout`` option of commands and the ``timeout`` run option.
+
+Python threads can't be stopped from the outside, so a command which times out while running
+in a thread keeps running in the background unless it checks whether it has been cancelled,
+for example between chunks of work::
+
+    from idemseq.cancellation import current_cancellation
+
+    @base.command(timeout=60)
+    def download(urls):
+        cancellation = current_cancellation()
+        for url in urls:
+            cancellation.raise_if_cancelled()
+            ...
+
+Coroutine commands are cancelled by the event loop like any other task.
+"""
+import contextlib
+import threading
+
+from idemseq.exceptions import CancelledError
+
+
+class Cancellation(object):
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def is_cancelled(self):
+        return self._event.is_set()
+
+    def raise_if_cancelled(self):
+        if self.is_cancelled:
+            raise CancelledError()
+
+    def wait(self, timeout):
+        """
+        Sleeps for ``timeout`` seconds, or until cancelled. Returns True if cancelled.
+        """
+        return self._event.wait(timeout) or self.is_cancelled
+
+
+_local = threading.local()
+
+
+def current_cancellation():
+    """
+    Returns the `Cancellation` of the command running in the current thread.
+    Outside commands with a timeout, returns one which is never cancelled.
+    """
+    cancellation = getattr(_local, 'cancellation', None)
+    return cancellation if cancellation is not None else Cancellation()
+
+
+@contextlib.contextmanager
+def cancellation_scope(cancellation):
+    """
+    Makes ``cancellation`` the current cancellation of the thread in the block.
+    """
+    previous = getattr(_local, 'cancellation', None)
+    _local.cancellation = cancellation
+    try:
+        yield cancellation
+    finally:
+        _local.cancellation = previous
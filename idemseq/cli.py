@@ -1,21 +1,33 @@
+"""
+The ``idemseq`` command. Start-up time matters because the command is run often,
+for example by cron jobs and health checks calling ``list``: the base module and the rest
+of idemseq are only imported once a ``BASE_MODULE:BASE_NAME`` subcommand is given,
+and modules that only some commands need are imported by those commands.
+"""
 import importlib
 
 import click
 
-from idemseq.controller import create_controller_cli
-
 
 class IdemseqCli(click.MultiCommand):
     def __init__(self, *args, **kwargs):
         kwargs.setdefault('subcommand_metavar', 'BASE_MODULE:BASE_NAME ACTION ...')
         super(IdemseqCli, self).__init__(*args, **kwargs)
+        # Controllers by base path, click may resolve the same subcommand more than once
+        self._controllers = {}
 
     def list_commands(self, ctx):
         return ()
 
     def get_command(self, ctx, cmd_name):
-        base_module, base_name = cmd_name.split(':', 1)
-        return create_controller_cli(getattr(importlib.import_module(base_module), base_name))
+        if cmd_name not in self._controllers:
+            from idemseq.controller import create_controller_cli
+
+            base_module, base_name = cmd_name.split(':', 1)
+            self._controllers[cmd_name] = create_controller_cli(
+                getattr(importlib.import_module(base_module), base_name), base_path=cmd_name,
+            )
+        return self._controllers[cmd_name]
 
 
 @click.command(cls=IdemseqCli)
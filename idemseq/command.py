@@ -1,11 +1,69 @@
+import collections
+import importlib
+import inspect
 import logging
 
 from funcsigs import signature
 
 from idemseq.base import Options
+from idemseq.results import serializers
 
 log = logging.getLogger(__name__)
 
+# inspect.iscoroutinefunction is not available before Python 3.5
+_iscoroutinefunction = getattr(inspect, 'iscoroutinefunction', lambda func: False)
+
+
+BindingPlan = collections.namedtuple('BindingPlan', ('names', 'required', 'defaults', 'accepts_var_kwargs'))
+
+_missing = object()
+
+
+def _update_code_digest(digest, code):
+    if code is None:
+        return
+    digest.update(code.co_code)
+    digest.update(repr((code.co_names, code.co_varnames)).encode('utf-8'))
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            _update_code_digest(digest, const)
+        else:
+            digest.update(_canonical_repr(const).encode('utf-8'))
+
+
+def _canonical_repr(const):
+    """
+    Returns ``repr(const)`` of a code constant, except that elements of frozensets
+    (``x in {'a', 'b'}``) are sorted, so that it doesn't depend on the hash seed of the process.
+    """
+    if isinstance(const, tuple):
+        items = [_canonical_repr(item) for item in const]
+        return '({})'.format(items[0] + ',' if len(items) == 1 else ', '.join(items))
+    if isinstance(const, frozenset):
+        if not const:
+            return 'frozenset()'
+        return 'frozenset({{{}}})'.format(', '.join(sorted(_canonical_repr(item) for item in const)))
+    if inspect.iscode(const):
+        import hashlib
+        digest = hashlib.sha1()
+        _update_code_digest(digest, const)
+        return digest.hexdigest()
+    return repr(const)
+
+
+def resolve_import_path(import_path):
+    """
+    Returns the function at ``module:qualified.name``, see `Command.import_path`.
+    Modules are imported once per process.
+    """
+    module_name, _, qualname = import_path.partition(':')
+    obj = importlib.import_module(module_name)
+    for attr in qualname.split('.'):
+        obj = getattr(obj, attr)
+    if isinstance(obj, Command):
+        obj = obj._func
+    return obj
+
 
 class CommandOptions(Options):
     _valid_options = {
@@ -13,8 +71,29 @@ class CommandOptions(Options):
         'order': -1,
         'run_always': None,
         'run_until_finished': None,
+        'depends_on': None,
+        'persist_result': None,
+        'invalidate_on_change': None,
+        'fingerprint': None,
+        'version': None,
+        'max_attempts': None,
+        'retry_on': None,
+        'retry_backoff': None,
+        'retry_max_backoff': None,
+        'retry_budget': None,
+        'timeout': None,
     }
 
+    def __init__(self, *args, **kwargs):
+        super(CommandOptions, self).__init__(*args, **kwargs)
+        persist_result = self.get('persist_result')
+        if persist_result not in (None, False, True):
+            formats = sorted(serializers)
+            if persist_result not in formats:
+                raise ValueError('Unsupported persist_result format {!r}, use True or one of: {}'.format(
+                    persist_result, ', '.join(formats),
+                ))
+
 
 class Command(object):
     """
@@ -31,6 +110,29 @@ class Command(object):
         if self._func:
             self._signature = signature(self._func)
 
+        self._binding_plan = self._compile_binding_plan()
+        self._code_fingerprint = None
+        self._import_path = _missing
+
+    def _compile_binding_plan(self):
+        names = []
+        required = set()
+        defaults = {}
+        accepts_var_kwargs = False
+        if self._signature is not None:
+            for param in self._signature.parameters.values():
+                if param.kind == param.VAR_KEYWORD:
+                    accepts_var_kwargs = True
+                elif param.kind == param.VAR_POSITIONAL:
+                    continue
+                elif param.default is param.empty:
+                    names.append(param.name)
+                    required.add(param.name)
+                else:
+                    names.append(param.name)
+                    defaults[param.name] = param.default
+        return BindingPlan(tuple(names), frozenset(required), defaults, accepts_var_kwargs)
+
     def __str__(self):
         return '{}(name={})'.format(self.__class__.__name__, self.name)
 
@@ -48,6 +150,73 @@ class Command(object):
         """
         return self._signature.parameters.values()
 
+    @property
+    def binding_plan(self):
+        """
+        A `BindingPlan` compiled from the function's signature: names of parameters that
+        are bound from context by name, which of them are required, defaults of the others,
+        and whether the function accepts ``**kwargs`` (these are not bound from context).
+        """
+        return self._binding_plan
+
+    def bind(self, *mappings):
+        """
+        Looks up arguments for the function's parameters by name in mappings, the first mapping
+        that has the name wins. Parameters with defaults are left out if not found.
+        Returns a tuple of the keyword arguments and a list of names of missing required parameters.
+        """
+        kwargs = {}
+        missing = []
+        for name in self._binding_plan.names:
+            for mapping in mappings:
+                value = mapping.get(name, _missing)
+                if value is not _missing:
+                    kwargs[name] = value
+                    break
+            else:
+                if name in self._binding_plan.required:
+                    missing.append(name)
+        return kwargs, missing
+
+    @property
+    def code_fingerprint(self):
+        """
+        A hash of the function's bytecode, constants and names, computed once per process.
+        Doesn't change when the function is only moved around in its file, or its comments are edited.
+        """
+        if self._code_fingerprint is None:
+            import hashlib
+            digest = hashlib.sha1()
+            _update_code_digest(digest, getattr(self._func, '__code__', None))
+            self._code_fingerprint = digest.hexdigest()
+        return self._code_fingerprint
+
+    @property
+    def import_path(self):
+        """
+        ``module:qualified.name`` by which worker processes find the function, or None
+        if the function isn't importable by it, like lambdas and functions defined in functions.
+        """
+        if self._import_path is _missing:
+            self._import_path = None
+            module_name = getattr(self._func, '__module__', None)
+            qualname = getattr(self._func, '__qualname__', getattr(self._func, '__name__', None))
+            if module_name and qualname and '<' not in qualname:
+                import_path = '{}:{}'.format(module_name, qualname)
+                try:
+                    if resolve_import_path(import_path) is self._func:
+                        self._import_path = import_path
+                except (ImportError, AttributeError):
+                    pass
+        return self._import_path
+
+    @property
+    def is_coroutine(self):
+        """
+        True if the underlying function is a coroutine function (declared with ``async def``).
+        """
+        return _iscoroutinefunction(self._func)
+
     @property
     def options(self):
         """
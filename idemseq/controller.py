@@ -4,10 +4,13 @@ from idemseq.log import configure_logging
 from idemseq.sequence import SequenceCommand
 
 
-def create_controller_cli(base):
+def create_controller_cli(base, base_path=None):
     """
     From SequenceBase creates a runnable Command Line Interface (cli) based controller
     to manage sequences of this base.
+
+    ``base_path`` is the ``module:name`` import path of the base, required
+    to run a fleet of sequences in worker processes.
     """
 
     scope = {}
@@ -18,6 +21,8 @@ def create_controller_cli(base):
     def get_sequence():
         if 'sequence' not in scope:
             scope['sequence'] = base(scope['sequence_id'])
+            if scope.get('keep_history'):
+                scope['sequence']._real_state_registry.keep_history = True
         return scope['sequence']
 
     def sequence_id_callback(ctx, param, value):
@@ -26,6 +31,9 @@ def create_controller_cli(base):
     def log_level_callback(ctx, param, value):
         configure_logging(log_level=value)
 
+    def keep_history_callback(ctx, param, value):
+        scope['keep_history'] = value
+
     @click.group()
     @click.option(
         '--sequence-id',
@@ -43,13 +51,24 @@ def create_controller_cli(base):
         envvar='IDEMSEQ_LOG_LEVEL',
         default='info',
     )
+    @click.option(
+        '--keep-history',
+        callback=keep_history_callback,
+        expose_value=False,
+        is_flag=True,
+        envvar='IDEMSEQ_KEEP_HISTORY',
+        help='Record every attempt to run a command, see the stats command',
+    )
     def cli():
         pass
 
     @cli.command(name='list')
     def list_():
-        for command in get_sequence().all_commands:
-            click.echo(' * {} ({})'.format(command.name, command.status))
+        sequence = get_sequence()
+        # One read of all statuses instead of one per command
+        with sequence._status_snapshot():
+            for command in sequence.all_commands:
+                click.echo(' * {} ({})'.format(command.name, command.status))
 
     @cli.command()
     @click.argument('selector', type=command_choice, required=False)
@@ -57,12 +76,40 @@ def create_controller_cli(base):
     @click.option('--force', is_flag=True)
     @click.option('--start-at', type=command_choice)
     @click.option('--stop-before', type=command_choice)
-    def run(selector, **run_options):
+    @click.option('--max-workers', type=int, help='Run independent commands concurrently on this many threads')
+    @click.option(
+        '--executor',
+        type=click.Choice(['thread', 'process']),
+        help='Run commands on a pool of threads (with --max-workers) or processes (for CPU-bound commands)',
+    )
+    @click.option('--timeout', type=float, help='Seconds after which commands without a timeout of their own time out')
+    @click.option(
+        '--on-timeout',
+        type=click.Choice(['stop', 'continue']),
+        help='Stop (the default) or continue with commands which don\'t depend on a command that timed out',
+    )
+    @click.option(
+        '--lease-ttl',
+        type=float,
+        envvar='IDEMSEQ_LEASE_TTL',
+        help='Hold a lease on the sequence, renewed between commands, so that no other runner runs it meanwhile',
+    )
+    @click.option(
+        '--lease-timeout',
+        type=float,
+        default=0,
+        envvar='IDEMSEQ_LEASE_TIMEOUT',
+        help='Seconds to wait for a lease held by another runner',
+    )
+    def run(selector, lease_ttl, lease_timeout, **run_options):
         sequence = get_sequence()
+        if lease_ttl is not None:
+            sequence.lease_ttl = lease_ttl
+            sequence.lease_timeout = lease_timeout
         if not selector:
             sequence.run(**run_options)
         else:
-            with sequence.env(**run_options):
+            with sequence.env(**run_options), sequence._lease():
                 sequence[selector].run()
 
     @cli.command()
@@ -79,4 +126,72 @@ def create_controller_cli(base):
     def mark(selector, status):
         get_sequence()[selector].status = status
 
+    @cli.command()
+    def stats():
+        """
+        Shows durations of past attempts per command and the estimated time to finish.
+        Requires a state registry that keeps history.
+        """
+        def format_duration(seconds):
+            return '-' if seconds is None else '{:.3f}s'.format(seconds)
+
+        sequence = get_sequence()
+        for s in sequence.history():
+            click.echo(' * {} (attempts={}, failures={}, p50={}, p95={})'.format(
+                s['name'], s['attempts'], s['failures'], format_duration(s['p50']), format_duration(s['p95']),
+            ))
+        next_command = sequence.next_command
+        if next_command is not None:
+            click.echo('Estimated remaining time from {}: {} (p50), {} (p95)'.format(
+                next_command.name,
+                format_duration(sequence.estimate_remaining_time(50)),
+                format_duration(sequence.estimate_remaining_time(95)),
+            ))
+
+    @cli.command()
+    @click.argument('sequences', type=click.File('r'), default='-')
+    @click.option('--max-workers', type=int, default=8)
+    @click.option('--processes', is_flag=True, help='Run sequences in worker processes instead of threads')
+    @click.option('--dry-run', is_flag=True)
+    def fleet(sequences, max_workers, processes, **run_options):
+        """
+        Runs sequences listed in SEQUENCES file (stdin by default), one per line,
+        either as a sequence id or as a JSON object {"sequence_id": ..., "context": {...}}.
+        Prints the outcome of each sequence as soon as it completes.
+        """
+        import json
+
+        from idemseq.fleet import FleetRunner
+
+        if processes and base_path is None:
+            raise click.UsageError('--processes requires the base to be loaded by its import path')
+
+        def read_items():
+            for line in sequences:
+                line = line.strip()
+                if not line:
+                    continue
+                if line.startswith('{'):
+                    item = json.loads(line)
+                    yield item['sequence_id'], item.get('context')
+                else:
+                    yield line
+
+        runner = FleetRunner(
+            base_path if processes else base,
+            max_workers=max_workers,
+            executor=FleetRunner.executor_process if processes else FleetRunner.executor_thread,
+        )
+
+        failed = False
+        for outcome in runner.run(read_items(), **run_options):
+            if outcome.status == FleetRunner.outcome_failed:
+                failed = True
+                click.echo('{} {} ({!r})'.format(outcome.sequence_id, outcome.status, outcome.error))
+            else:
+                click.echo('{} {}'.format(outcome.sequence_id, outcome.status))
+
+        if failed:
+            click.get_current_context().exit(1)
+
     return cli
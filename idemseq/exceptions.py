@@ -17,3 +17,65 @@ class SequenceCommandException(SequenceException):
 
     def __str__(self):
         return '(message={}, command={})'.format(self.message, self.command)
+
+
+class MissingContextError(SequenceCommandException, TypeError):
+    """
+    Raised before a command is run when the context lacks values for its required parameters.
+    A TypeError, like calling the command's function with missing arguments would raise.
+    """
+
+    def __init__(self, sequence_command, missing):
+        super(MissingContextError, self).__init__(
+            sequence_command,
+            'Missing context for required parameters ({})'.format(', '.join(missing)),
+        )
+        self.missing = missing
+
+
+class StatusConflictError(RuntimeError):
+    """
+    Raised by state registries with optimistic concurrency control when a command's status
+    was changed by someone else since this registry last saw it.
+    """
+
+    def __init__(self, name, expected_status, actual_status):
+        super(StatusConflictError, self).__init__(
+            'Status of {} changed from {} to {} concurrently'.format(name, expected_status, actual_status)
+        )
+        self.name = name
+        self.expected_status = expected_status
+        self.actual_status = actual_status
+
+
+class LeaseError(RuntimeError):
+    """
+    Raised when a lease on a sequence (or a part of it) can't be acquired because another
+    runner holds it, or when a held lease has been taken over by another runner.
+    """
+
+    def __init__(self, resource, owner, message):
+        super(LeaseError, self).__init__(message)
+        self.resource = resource
+        self.owner = owner
+
+
+class CommandTimeoutError(SequenceCommandException):
+    """
+    Raised when a command runs for longer than its timeout. The command is marked as timed out
+    and cancelled, see `idemseq.cancellation`.
+    """
+
+    def __init__(self, sequence_command, timeout):
+        super(CommandTimeoutError, self).__init__(
+            sequence_command,
+            'Command timed out after {} seconds'.format(timeout),
+        )
+        self.timeout = timeout
+
+
+class CancelledError(RuntimeError):
+    """
+    Raised in a command which checks for cancellation after it has been cancelled,
+    see `idemseq.cancellation`.
+    """
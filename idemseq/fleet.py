@@ -0,0 +1,149 @@
+"""
+Running sequences of one base for many sequence ids from a single process.
+"""
+import collections
+import importlib
+import itertools
+import logging
+
+from concurrent import futures
+
+from idemseq.sequence import Sequence, SequenceBase, SequenceCommand
+
+log = logging.getLogger(__name__)
+
+
+FleetOutcome = collections.namedtuple('FleetOutcome', ('sequence_id', 'status', 'error'))
+
+
+def load_base(base):
+    """
+    Returns ``base`` if it is a `SequenceBase`, otherwise imports it from a ``module:name`` string.
+    """
+    if isinstance(base, SequenceBase):
+        return base
+    module_name, base_name = base.split(':', 1)
+    return getattr(importlib.import_module(module_name), base_name)
+
+
+def _run_sequence(base, sequence_cls, sequence_id, context, run_options, check_finished):
+    """
+    Runs a single sequence of the fleet. A module-level function so that it can be run in worker processes.
+    """
+    with sequence_cls(base=load_base(base), state_registry_name=sequence_id) as sequence:
+        if check_finished and sequence.is_finished:
+            return FleetOutcome(sequence_id, FleetRunner.outcome_skipped, None)
+        try:
+            sequence.run(context=context, **run_options)
+        except Exception as e:
+            log.error('Sequence "{}" failed: {!r}'.format(sequence_id, e))
+            return FleetOutcome(sequence_id, FleetRunner.outcome_failed, e)
+        if sequence.is_finished:
+            return FleetOutcome(sequence_id, FleetRunner.outcome_finished, None)
+        else:
+            return FleetOutcome(sequence_id, FleetRunner.outcome_unfinished, None)
+
+
+class FleetRunner(object):
+    """
+    Runs sequences of one base for many sequence ids with bounded concurrency,
+    yielding a `FleetOutcome` for every sequence as soon as it is known.
+
+    With ``skip_finished`` on, finished sequences are not run at all, so their ``run_always``
+    commands don't run either. If the state registry can report statuses of many sequences
+    at once (see `SharedSqliteStateRegistry`), finished sequences are found with one query
+    per ``chunk_size`` sequence ids; otherwise each worker checks its own sequence.
+
+    With ``executor='process'``, ``base`` must be given as a ``module:name`` string
+    so that worker processes can import it.
+    """
+
+    outcome_skipped = 'skipped'
+    outcome_finished = 'finished'
+    outcome_unfinished = 'unfinished'
+    outcome_failed = 'failed'
+
+    executor_thread = 'thread'
+    executor_process = 'process'
+
+    def __init__(self, base, sequence_cls=Sequence, max_workers=8, executor=executor_thread,
+                 skip_finished=True, chunk_size=500):
+        if executor not in (self.executor_thread, self.executor_process):
+            raise ValueError('Unsupported executor "{}"'.format(executor))
+        if executor == self.executor_process and isinstance(base, SequenceBase):
+            raise ValueError('Process executor requires base as "module:name" string')
+        self._base_ref = base
+        self._base = load_base(base)
+        self._sequence_cls = sequence_cls
+        self.max_workers = max_workers
+        self.executor = executor
+        self.skip_finished = skip_finished
+        self.chunk_size = chunk_size
+
+    def _create_executor(self):
+        if self.executor == self.executor_process:
+            return futures.ProcessPoolExecutor(max_workers=self.max_workers)
+        return futures.ThreadPoolExecutor(max_workers=self.max_workers)
+
+    def _chunks(self, items):
+        items = iter(items)
+        while True:
+            chunk = list(itertools.islice(items, self.chunk_size))
+            if not chunk:
+                return
+            yield [(item, None) if not isinstance(item, (tuple, list)) else tuple(item) for item in chunk]
+
+    def _find_finished(self, sequence_ids):
+        """
+        Returns a set of ids of finished sequences, or None if the state registry
+        can't answer that with a single query.
+        """
+        state_registry = self._sequence_cls.create_state_registry(sequence_ids[0])
+        try:
+            statuses = state_registry.get_known_statuses_by_sequence(sequence_ids)
+        except NotImplementedError:
+            return None
+        finally:
+            state_registry.close()
+        names = [command.name for command in self._base]
+        return set(
+            sequence_id for sequence_id, sequence_statuses in statuses.items()
+            if all(sequence_statuses.get(name) == SequenceCommand.status_finished for name in names)
+        )
+
+    def run(self, items, **run_options):
+        """
+        Runs sequences for ``items``, an iterable of sequence ids or of ``(sequence_id, context)`` pairs.
+        Returns a generator of `FleetOutcome` in the order in which the sequences complete.
+        """
+        with self._create_executor() as executor:
+            running = set()
+            for chunk in self._chunks(items):
+                finished_ids = None
+                if self.skip_finished:
+                    finished_ids = self._find_finished([sequence_id for sequence_id, _ in chunk])
+
+                for sequence_id, context in chunk:
+                    if finished_ids is not None and sequence_id in finished_ids:
+                        yield FleetOutcome(sequence_id, self.outcome_skipped, None)
+                        continue
+
+                    # Keep the number of queued sequences bounded so that outcomes are streamed
+                    # while items are still being consumed.
+                    while len(running) >= self.max_workers * 2:
+                        done, running = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+                        for future in done:
+                            yield future.result()
+
+                    running.add(executor.submit(
+                        _run_sequence,
+                        self._base_ref,
+                        self._sequence_cls,
+                        sequence_id,
+                        context,
+                        run_options,
+                        self.skip_finished and finished_ids is None,
+                    ))
+
+            for future in futures.as_completed(running):
+                yield future.result()
@@ -0,0 +1,489 @@
+"""
+State registry backed by a Redis-compatible key-value store, for sequences that run
+on many hosts against shared state.
+
+Statuses of a sequence are stored in one hash, so reading all of them is a single HGETALL.
+Persisted results and input hashes of commands, see `idemseq.results`, are stored in two more hashes
+and written in the same pipeline as the status of the command that produced them.
+Writes are sent in one pipeline and, with ``compare_and_set`` enabled, only succeed if
+the statuses that the registry has seen haven't been changed by anyone else meanwhile::
+
+    class JobsStateRegistry(KeyValueStateRegistry):
+        client = redis.Redis(host='state.internal', decode_responses=True)
+
+        # or, in tests and without any network services:
+        client = InMemoryKeyValueClient()
+
+The registry uses the subset of the redis-py client API that `InMemoryKeyValueClient` implements.
+"""
+import base64
+import collections
+import fnmatch
+import json
+import threading
+
+from idemseq.exceptions import StatusConflictError
+from idemseq.persistence import StateRegistry
+from idemseq.sequence import SequenceCommand
+
+
+class WatchError(Exception):
+    """
+    Raised by `InMemoryPipeline.execute` when a watched key was modified, like redis-py's WatchError.
+    """
+
+
+def _watch_errors():
+    try:
+        from redis.exceptions import WatchError as RedisWatchError
+    except ImportError:
+        return WatchError,
+    return WatchError, RedisWatchError
+
+
+def _decode(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
+
+
+class KeyValueStateRegistry(StateRegistry):
+    """
+    Stores command statuses of a sequence in a hash ``<key_prefix>:<name>:statuses``,
+    and, with ``keep_history`` enabled, attempts in a list ``<key_prefix>:<name>:history``.
+    Results are stored base64-encoded in a hash ``<key_prefix>:<name>:results``
+    and input hashes in a hash ``<key_prefix>:<name>:input_hashes``.
+
+    Writes follow the same rules as `SqliteStateRegistry`: with ``batch_writes`` enabled only
+    transitions to ``finished`` are deferred, until ``flush_every`` updates are pending
+    or ``flush()`` is called.
+
+    With ``compare_and_set`` enabled, pending writes are applied in a WATCH/MULTI/EXEC
+    transaction which checks that every command whose status this registry has read or written
+    still has that status. If not, `StatusConflictError` is raised and the pending writes
+    are dropped. Statuses the registry has never read are written blindly.
+    """
+
+    client = None
+
+    key_prefix = 'idemseq'
+
+    batch_writes = False
+    flush_every = None
+
+    keep_history = False
+
+    compare_and_set = True
+
+    # How many times to retry a transaction which failed because
+    # statuses of other commands of the same sequence were updated meanwhile.
+    max_transaction_retries = 10
+
+    # Maximum number of commands sent in one pipeline by get_known_statuses_by_sequence
+    _max_pipeline_size = 500
+
+    def __init__(self, name=None, client=None, key_prefix=None, batch_writes=None, flush_every=None,
+                 keep_history=None, compare_and_set=None):
+        if name is None:
+            raise ValueError('{} requires a sequence id as its name'.format(self.__class__.__name__))
+        super(KeyValueStateRegistry, self).__init__(name)
+
+        if client is not None:
+            self.client = client
+        if self.client is None:
+            raise ValueError('{} requires a key-value client'.format(self.__class__.__name__))
+        if key_prefix is not None:
+            self.key_prefix = key_prefix
+        if batch_writes is not None:
+            self.batch_writes = batch_writes
+        if flush_every is not None:
+            self.flush_every = flush_every
+        if keep_history is not None:
+            self.keep_history = keep_history
+        if compare_and_set is not None:
+            self.compare_and_set = compare_and_set
+
+        self._pending_statuses = collections.OrderedDict()
+        self._pending_attempts = []
+        self._pending_results = collections.OrderedDict()
+
+        # Statuses as last read from or written to the store, checked by compare-and-set.
+        # Once all statuses have been read, commands missing from them were seen as unknown.
+        self._seen_statuses = {}
+        self._seen_all_statuses = False
+
+    def _statuses_key(self, sequence_id=None):
+        return '{}:{}:statuses'.format(self.key_prefix, self.name if sequence_id is None else sequence_id)
+
+    @property
+    def _history_key(self):
+        return '{}:{}:history'.format(self.key_prefix, self.name)
+
+    @property
+    def _results_key(self):
+        return '{}:{}:results'.format(self.key_prefix, self.name)
+
+    @property
+    def _input_hashes_key(self):
+        return '{}:{}:input_hashes'.format(self.key_prefix, self.name)
+
+    def update_status(self, command, status):
+        if status not in SequenceCommand.valid_statuses:
+            raise ValueError(status)
+
+        self._pending_statuses.pop(command.name, None)
+        self._pending_statuses[command.name] = status
+
+        if not self.batch_writes or self._should_flush(status):
+            self.flush()
+
+    def _should_flush(self, last_status):
+        if last_status != SequenceCommand.status_finished:
+            return True
+        if self.flush_every is not None and len(self._pending_statuses) >= self.flush_every:
+            return True
+        return False
+
+    def record_attempt(self, command, started_at, finished_at, status, previous_status=None, error_type=None,
+                       retry_delay=None):
+        if not self.keep_history:
+            return
+        self._pending_attempts.append(json.dumps([
+            command.name, started_at, finished_at, finished_at - started_at, previous_status, status, error_type,
+            retry_delay,
+        ]))
+        if not self.batch_writes:
+            self.flush()
+
+    def get_history(self, name=None):
+        self.flush()
+        columns = (
+            'name', 'started_at', 'finished_at', 'duration', 'previous_status', 'status', 'error_type', 'retry_delay',
+        )
+        # Attempts recorded before retries were introduced have no retry_delay
+        history = [
+            dict(zip(columns, json.loads(_decode(a)) + [None])) for a in self.client.lrange(self._history_key, 0, -1)
+        ]
+        if name is not None:
+            history = [a for a in history if a['name'] == name]
+        return sorted(history, key=lambda a: a['started_at'])
+
+    def save_result(self, command, data, input_hash=None):
+        # Written together with the status update that follows, see SequenceCommand.run
+        self._pending_results[command.name] = data, input_hash
+
+    def load_result(self, command):
+        if command.name in self._pending_results:
+            return self._pending_results[command.name]
+        with self.client.pipeline(transaction=False) as pipeline:
+            pipeline.hget(self._results_key, command.name)
+            pipeline.hget(self._input_hashes_key, command.name)
+            data, input_hash = pipeline.execute()
+        if data is None and input_hash is None:
+            return None
+        return (base64.b64decode(_decode(data)) if data is not None else None), _decode(input_hash)
+
+    def get_input_hashes(self):
+        input_hashes = {_decode(k): _decode(v) for k, v in self.client.hgetall(self._input_hashes_key).items()}
+        input_hashes.update(
+            (name, input_hash) for name, (_, input_hash) in self._pending_results.items() if input_hash is not None
+        )
+        return input_hashes
+
+    def get_status(self, command):
+        if command.name in self._pending_statuses:
+            return self._pending_statuses[command.name]
+        status = _decode(self.client.hget(self._statuses_key(), command.name))
+        if status is None:
+            status = SequenceCommand.status_unknown
+        self._seen_statuses[command.name] = status
+        return status
+
+    def get_known_statuses(self):
+        statuses = {
+            _decode(k): _decode(v)
+            for k, v in self.client.hgetall(self._statuses_key()).items()
+        }
+        self._seen_statuses.update(statuses)
+        self._seen_all_statuses = True
+        statuses.update(self._pending_statuses)
+        return statuses
+
+    def get_known_statuses_by_sequence(self, sequence_ids=None):
+        """
+        Returns a mapping of sequence ids to mappings of command names to command statuses,
+        for the specified sequences or for all sequences stored under ``key_prefix``.
+        Statuses are read with pipelined HGETALLs. Sequences without any recorded status are omitted.
+        """
+        self.flush()
+        if sequence_ids is None:
+            prefix, suffix = '{}:'.format(self.key_prefix), ':statuses'
+            sequence_ids = sorted(
+                _decode(key)[len(prefix):-len(suffix)]
+                for key in self.client.scan_iter(match='{}*{}'.format(prefix, suffix))
+            )
+        else:
+            sequence_ids = list(sequence_ids)
+
+        statuses = {}
+        for i in range(0, len(sequence_ids), self._max_pipeline_size):
+            chunk = sequence_ids[i:i + self._max_pipeline_size]
+            with self.client.pipeline(transaction=False) as pipeline:
+                for sequence_id in chunk:
+                    pipeline.hgetall(self._statuses_key(sequence_id))
+                results = pipeline.execute()
+            for sequence_id, sequence_statuses in zip(chunk, results):
+                if sequence_statuses:
+                    statuses[sequence_id] = {_decode(k): _decode(v) for k, v in sequence_statuses.items()}
+        return statuses
+
+    def transition_status(self, command, expected_status, status):
+        """
+        Sets the status of the command to ``status`` only if it currently is ``expected_status``.
+        Returns True if the status was changed.
+        """
+        if status not in SequenceCommand.valid_statuses:
+            raise ValueError(status)
+        self.flush()
+        try:
+            self._write({command.name: status}, [], {}, {command.name: expected_status})
+        except StatusConflictError:
+            return False
+        return True
+
+    def flush(self):
+        if not self._pending_statuses and not self._pending_attempts and not self._pending_results:
+            return
+        statuses = dict(self._pending_statuses)
+        attempts = list(self._pending_attempts)
+        results = dict(self._pending_results)
+        self._pending_statuses.clear()
+        del self._pending_attempts[:]
+        self._pending_results.clear()
+
+        expected = {}
+        if self.compare_and_set:
+            for name in statuses:
+                if name in self._seen_statuses:
+                    expected[name] = self._seen_statuses[name]
+                elif self._seen_all_statuses:
+                    expected[name] = SequenceCommand.status_unknown
+        self._write(statuses, attempts, results, expected)
+
+    def _write(self, statuses, attempts, results, expected):
+        """
+        Writes statuses, attempts and results in one pipeline. If ``expected`` is not empty,
+        the pipeline is a transaction which only succeeds if the commands still have the expected statuses.
+        """
+        if not expected:
+            with self.client.pipeline(transaction=False) as pipeline:
+                self._queue_writes(pipeline, statuses, attempts, results)
+                pipeline.execute()
+            self._seen_statuses.update(statuses)
+            return
+
+        key = self._statuses_key()
+        names = list(expected)
+        watch_errors = _watch_errors()
+        with self.client.pipeline() as pipeline:
+            for _ in range(self.max_transaction_retries + 1):
+                try:
+                    pipeline.watch(key)
+                    actual = [_decode(s) or SequenceCommand.status_unknown for s in pipeline.hmget(key, names)]
+                    for name, actual_status in zip(names, actual):
+                        if actual_status != expected[name]:
+                            pipeline.reset()
+                            self._seen_statuses[name] = actual_status
+                            raise StatusConflictError(name, expected[name], actual_status)
+                    pipeline.multi()
+                    self._queue_writes(pipeline, statuses, attempts, results)
+                    pipeline.execute()
+                    self._seen_statuses.update(statuses)
+                    return
+                except watch_errors:
+                    # Another status of this sequence changed, check ours again
+                    continue
+        # Gave up because of contention, the actual status is not known
+        raise StatusConflictError(names[0], expected[names[0]], None)
+
+    def _queue_writes(self, pipeline, statuses, attempts, results):
+        if statuses:
+            pipeline.hset(self._statuses_key(), mapping=statuses)
+        if attempts:
+            pipeline.rpush(self._history_key, *attempts)
+        if results:
+            self._queue_result_writes(pipeline, results)
+
+    def _queue_result_writes(self, pipeline, results):
+        encoded = {
+            name: (base64.b64encode(data).decode('ascii') if data is not None else None)
+            for name, (data, _) in results.items()
+        }
+        input_hashes = {name: input_hash for name, (_, input_hash) in results.items()}
+        for key, values in ((self._results_key, encoded), (self._input_hashes_key, input_hashes)):
+            stored = {name: value for name, value in values.items() if value is not None}
+            if stored:
+                pipeline.hset(key, mapping=stored)
+            # Values stored by earlier runs are replaced, also by None
+            cleared = [name for name, value in values.items() if value is None]
+            if cleared:
+                pipeline.hdel(key, *cleared)
+
+
+class InMemoryKeyValueClient(object):
+    """
+    In-process stand-in for a Redis server and redis-py client, implementing the commands
+    used by `KeyValueStateRegistry`. Values are returned as strings, like a client created
+    with ``decode_responses=True``. Thread-safe, so many registries and threads may share one.
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._versions = collections.defaultdict(int)
+        self._lock = threading.RLock()
+
+        # Number of requests the client would have sent to a server, a pipeline counts as one
+        self.round_trips = 0
+
+    def _touch(self, key):
+        self._versions[key] += 1
+
+    def _request(self):
+        self.round_trips += 1
+
+    def hget(self, key, field):
+        with self._lock:
+            self._request()
+            return self._data.get(key, {}).get(field)
+
+    def hmget(self, key, fields):
+        with self._lock:
+            self._request()
+            values = self._data.get(key, {})
+            return [values.get(f) for f in fields]
+
+    def hgetall(self, key):
+        with self._lock:
+            self._request()
+            return dict(self._data.get(key, {}))
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        with self._lock:
+            self._request()
+            items = dict(mapping or {})
+            if field is not None:
+                items[field] = value
+            values = self._data.setdefault(key, {})
+            added = len(set(items) - set(values))
+            values.update((k, str(v)) for k, v in items.items())
+            self._touch(key)
+            return added
+
+    def hdel(self, key, *fields):
+        with self._lock:
+            self._request()
+            values = self._data.get(key, {})
+            deleted = 0
+            for field in fields:
+                if field in values:
+                    del values[field]
+                    deleted += 1
+            if deleted:
+                self._touch(key)
+            return deleted
+
+    def rpush(self, key, *values):
+        with self._lock:
+            self._request()
+            items = self._data.setdefault(key, [])
+            items.extend(str(v) for v in values)
+            self._touch(key)
+            return len(items)
+
+    def lrange(self, key, start, end):
+        with self._lock:
+            self._request()
+            items = self._data.get(key, [])
+            return list(items[start:] if end == -1 else items[start:end + 1])
+
+    def delete(self, *keys):
+        with self._lock:
+            self._request()
+            deleted = 0
+            for key in keys:
+                if key in self._data:
+                    del self._data[key]
+                    self._touch(key)
+                    deleted += 1
+            return deleted
+
+    def scan_iter(self, match='*'):
+        with self._lock:
+            self._request()
+            keys = [k for k in self._data if fnmatch.fnmatchcase(k, match)]
+        return iter(keys)
+
+    def pipeline(self, transaction=True):
+        return InMemoryPipeline(self, transaction=transaction)
+
+
+class InMemoryPipeline(object):
+    """
+    Pipeline of `InMemoryKeyValueClient` with redis-py semantics: after `watch` commands run
+    immediately until `multi` is called, after which they are queued until `execute`,
+    which raises `WatchError` if any watched key was modified since it was watched.
+    """
+
+    _commands = ('hget', 'hmget', 'hgetall', 'hset', 'hdel', 'rpush', 'lrange', 'delete')
+
+    def __init__(self, client, transaction=True):
+        self._client = client
+        self._transaction = transaction
+        self.reset()
+
+    def reset(self):
+        self._queue = []
+        self._watched = {}
+        self._immediate = False
+
+    def watch(self, *keys):
+        with self._client._lock:
+            self._client._request()
+            for key in keys:
+                self._watched[key] = self._client._versions[key]
+        self._immediate = True
+
+    def multi(self):
+        self._immediate = False
+
+    def __getattr__(self, item):
+        if item not in self._commands:
+            raise AttributeError(item)
+
+        def command(*args, **kwargs):
+            if self._immediate:
+                return getattr(self._client, item)(*args, **kwargs)
+            self._queue.append((item, args, kwargs))
+            return self
+
+        return command
+
+    def execute(self):
+        client = self._client
+        with client._lock:
+            try:
+                for key, version in self._watched.items():
+                    if client._versions[key] != version:
+                        raise WatchError('Watched variable changed')
+                round_trips = client.round_trips
+                results = [getattr(client, name)(*args, **kwargs) for name, args, kwargs in self._queue]
+                client.round_trips = round_trips + 1
+                return results
+            finally:
+                self.reset()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.reset()
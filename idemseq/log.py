@@ -1,33 +1,24 @@
 import logging
-import logging.config
 
 
 def configure_logging(log_level=None):
+    """
+    Replaces handlers of the root logger with one that logs to stderr at ``log_level``.
+
+    Configured by hand rather than with ``logging.config`` which takes longer
+    to import than the rest of the CLI start-up, see `idemseq.cli`.
+    """
     if isinstance(log_level, str):
         log_level = getattr(logging, log_level.upper())
 
     log_level = log_level or logging.INFO
 
-    logging.config.dictConfig({
-        'version': 1,
-        'disable_existing_loggers': False,
-        'formatters': {
-            'standard': {
-                'format': '%(asctime)s [%(levelname)s] %(name)s: %(message)s'
-            },
-        },
-        'handlers': {
-            'default': {
-                'level': log_level,
-                'formatter': 'standard',
-                'class': 'logging.StreamHandler',
-            },
-        },
-        'loggers': {
-            '': {
-                'handlers': ['default'],
-                'level': log_level,
-                'propagate': True,
-            },
-        }
-    })
+    handler = logging.StreamHandler()
+    handler.setLevel(log_level)
+    handler.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] %(name)s: %(message)s'))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(log_level)
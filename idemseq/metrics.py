@@ -0,0 +1,216 @@
+"""
+Measurements of sequence runs.
+
+Set `Sequence.metrics` (on a subclass, or on an instance) to a `MetricsHook` to receive them.
+`InMemoryMetrics` aggregates measurements and exports them as JSON or in Prometheus text format.
+"""
+import collections
+import contextlib
+import json
+import threading
+import time
+
+# CPU time of the calling thread where available so that commands running
+# concurrently on worker threads don't count each other's time.
+if hasattr(time, 'thread_time'):
+    thread_cpu_time = time.thread_time
+elif hasattr(time, 'process_time'):
+    thread_cpu_time = time.process_time
+else:
+    thread_cpu_time = time.clock
+
+process_cpu_time = getattr(time, 'process_time', thread_cpu_time)
+
+
+class MetricsHook(object):
+    """
+    Receives measurements from sequences. All methods do nothing by default.
+
+    Methods may be called from worker threads when commands run concurrently.
+    """
+
+    skip_already_finished = 'already_finished'
+    skip_start_at = 'start_at'
+    skip_stop_before = 'stop_before'
+    skip_dry_run = 'dry_run'
+    skip_dependency_timed_out = 'dependency_timed_out'
+
+    outcome_finished = 'finished'
+    outcome_failed = 'failed'
+
+    def observe_run(self, sequence, wall_time, cpu_time):
+        """
+        Called after `Sequence.run()` with its duration in seconds, including failed runs.
+        """
+        pass
+
+    def observe_command(self, sequence, command_name, outcome, wall_time, cpu_time):
+        """
+        Called after every attempt to call a command function, with its outcome and duration in seconds.
+        """
+        pass
+
+    def observe_skip(self, sequence, command_name, reason):
+        """
+        Called when a command is not called during a run, with one of the ``skip_*`` reasons.
+        """
+        pass
+
+    def observe_registry(self, sequence, operation, duration):
+        """
+        Called after every call to the sequence's state registry with the name of the method called.
+        """
+        pass
+
+
+@contextlib.contextmanager
+def measure_command(metrics, sequence, command_name):
+    """
+    Measures the block as an attempt to call the command, if ``metrics`` is set.
+    """
+    if metrics is None:
+        yield
+        return
+    wall_started, cpu_started = time.time(), thread_cpu_time()
+    outcome = MetricsHook.outcome_failed
+    try:
+        yield
+        outcome = MetricsHook.outcome_finished
+    finally:
+        metrics.observe_command(
+            sequence, command_name, outcome, time.time() - wall_started, thread_cpu_time() - cpu_started,
+        )
+
+
+@contextlib.contextmanager
+def measure_run(metrics, sequence):
+    """
+    Measures the block as a sequence run, if ``metrics`` is set.
+    """
+    if metrics is None:
+        yield
+        return
+    wall_started, cpu_started = time.time(), process_cpu_time()
+    try:
+        yield
+    finally:
+        metrics.observe_run(sequence, time.time() - wall_started, process_cpu_time() - cpu_started)
+
+
+class InMemoryMetrics(MetricsHook):
+    """
+    Aggregates measurements of all sequences that report to it, per command name.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._runs = {'count': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0}
+            self._commands = collections.defaultdict(lambda: {
+                'attempts': 0,
+                'failures': 0,
+                'wall_seconds': 0.0,
+                'cpu_seconds': 0.0,
+                'max_wall_seconds': 0.0,
+            })
+            self._skips = collections.defaultdict(lambda: collections.defaultdict(int))
+            self._registry = collections.defaultdict(lambda: {'calls': 0, 'seconds': 0.0})
+
+    def observe_run(self, sequence, wall_time, cpu_time):
+        with self._lock:
+            self._runs['count'] += 1
+            self._runs['wall_seconds'] += wall_time
+            self._runs['cpu_seconds'] += cpu_time
+
+    def observe_command(self, sequence, command_name, outcome, wall_time, cpu_time):
+        with self._lock:
+            command = self._commands[command_name]
+            command['attempts'] += 1
+            if outcome == self.outcome_failed:
+                command['failures'] += 1
+            command['wall_seconds'] += wall_time
+            command['cpu_seconds'] += cpu_time
+            command['max_wall_seconds'] = max(command['max_wall_seconds'], wall_time)
+
+    def observe_skip(self, sequence, command_name, reason):
+        with self._lock:
+            self._skips[command_name][reason] += 1
+
+    def observe_registry(self, sequence, operation, duration):
+        with self._lock:
+            self._registry[operation]['calls'] += 1
+            self._registry[operation]['seconds'] += duration
+
+    def snapshot(self):
+        """
+        Returns a copy of the aggregated measurements as a dictionary.
+
+        ``overhead_seconds`` is the time spent in runs outside of command functions,
+        which is only meaningful for runs that don't run commands concurrently.
+        """
+        with self._lock:
+            runs = dict(self._runs)
+            runs['overhead_seconds'] = runs['wall_seconds'] - sum(c['wall_seconds'] for c in self._commands.values())
+            return {
+                'runs': runs,
+                'commands': {k: dict(v) for k, v in self._commands.items()},
+                'skips': {k: dict(v) for k, v in self._skips.items()},
+                'registry': {k: dict(v) for k, v in self._registry.items()},
+            }
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.snapshot(), sort_keys=True, **kwargs)
+
+    def to_prometheus(self, prefix='idemseq'):
+        """
+        Returns the measurements in Prometheus text exposition format.
+        """
+        snapshot = self.snapshot()
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append('# HELP {}_{} {}'.format(prefix, name, help_text))
+            lines.append('# TYPE {}_{} {}'.format(prefix, name, metric_type))
+            for labels, value in samples:
+                label_str = ','.join('{}="{}"'.format(k, _escape_label(v)) for k, v in labels)
+                if label_str:
+                    lines.append('{}_{}{{{}}} {!r}'.format(prefix, name, label_str, value))
+                else:
+                    lines.append('{}_{} {!r}'.format(prefix, name, value))
+
+        runs = snapshot['runs']
+        metric('runs_total', 'counter', 'Sequence runs.', [((), runs['count'])])
+        metric('run_wall_seconds_total', 'counter', 'Wall time spent in sequence runs.', [((), runs['wall_seconds'])])
+        metric('run_cpu_seconds_total', 'counter', 'CPU time spent in sequence runs.', [((), runs['cpu_seconds'])])
+
+        commands = sorted(snapshot['commands'].items())
+        for key, name, metric_type, help_text in (
+            ('attempts', 'command_attempts_total', 'counter', 'Calls of command functions.'),
+            ('failures', 'command_failures_total', 'counter', 'Calls of command functions that raised.'),
+            ('wall_seconds', 'command_wall_seconds_total', 'counter', 'Wall time spent in command functions.'),
+            ('cpu_seconds', 'command_cpu_seconds_total', 'counter', 'CPU time spent in command functions.'),
+            ('max_wall_seconds', 'command_max_wall_seconds', 'gauge', 'Longest call of command function.'),
+        ):
+            metric(name, metric_type, help_text, [((('command', c),), v[key]) for c, v in commands])
+
+        metric('command_skips_total', 'counter', 'Commands not called during a run, by reason.', [
+            ((('command', c), ('reason', r)), n)
+            for c, reasons in sorted(snapshot['skips'].items()) for r, n in sorted(reasons.items())
+        ])
+
+        registry = sorted(snapshot['registry'].items())
+        metric('registry_calls_total', 'counter', 'Calls to state registries.', [
+            ((('operation', o), ), v['calls']) for o, v in registry
+        ])
+        metric('registry_seconds_total', 'counter', 'Time spent in calls to state registries.', [
+            ((('operation', o), ), v['seconds']) for o, v in registry
+        ])
+
+        return '\n'.join(lines) + '\n'
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
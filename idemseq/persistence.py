@@ -1,8 +1,12 @@
+import collections
 import contextlib
 import logging
 import sqlite3
+import threading
+import time
 import uuid
 
+from idemseq.exceptions import LeaseError
 from idemseq.sequence import SequenceCommand
 
 
@@ -10,6 +14,10 @@ log = logging.getLogger(__name__)
 
 
 class StateRegistry(object):
+    # Whether calls to the registry may block on I/O. Coroutines run calls to blocking
+    # registries in an executor, see `idemseq.aio.AsyncStateRegistry`.
+    blocking = True
+
     def __init__(self, name):
         self._name = name
 
@@ -40,29 +48,488 @@ class StateRegistry(object):
         """
         raise NotImplementedError()
 
+    def get_known_statuses_by_sequence(self, sequence_ids=None):
+        """
+        Returns a mapping of sequence ids to mappings of command names to command statuses.
+        Only registries that store many sequences in one place support this.
+        """
+        raise NotImplementedError()
+
+    def record_attempt(self, command, started_at, finished_at, status, previous_status=None, error_type=None,
+                       retry_delay=None):
+        """
+        Records an attempt to run the command: its start and end timestamps, the status it resulted in,
+        the status of the command before the attempt, the name of the exception class if it failed,
+        and the number of seconds waited before the command was retried, if it was.
+        Registries that don't keep history ignore this.
+        """
+        pass
+
+    def get_history(self, name=None):
+        """
+        Returns a list of recorded attempts, of the command ``name`` or of all commands, oldest first.
+        Each attempt is a dictionary with keys ``name``, ``started_at``, ``finished_at``, ``duration``,
+        ``previous_status``, ``status``, ``error_type`` and ``retry_delay``.
+        """
+        return []
+
+    def save_result(self, command, data, input_hash=None):
+        """
+        Stores the encoded result of the command's last successful run (bytes, or None if only
+        ``input_hash`` is of interest) and the hash of the arguments it was called with.
+        See `idemseq.results`.
+        """
+        raise NotImplementedError()
+
+    def load_result(self, command):
+        """
+        Returns a tuple of the encoded result and the input hash stored by `save_result`,
+        or None if nothing is stored for the command.
+        """
+        raise NotImplementedError()
+
+    def get_input_hashes(self):
+        """
+        Returns a mapping of command names to input hashes stored by `save_result`.
+        """
+        raise NotImplementedError()
+
+    def acquire_lease(self, resource, owner, ttl):
+        """
+        Tries to acquire a lease on ``resource`` (for example the whole sequence, or one command)
+        for ``owner``, valid for ``ttl`` seconds unless renewed by `heartbeat`.
+        Returns True if the lease was acquired or was already held by ``owner``, and False
+        if another owner holds a lease which hasn't expired. Expired leases are taken over.
+        """
+        raise NotImplementedError()
+
+    def release_lease(self, resource, owner):
+        """
+        Releases the lease on ``resource`` if it is held by ``owner``.
+        """
+        raise NotImplementedError()
+
+    def heartbeat(self):
+        """
+        Renews leases held through this registry which are due for renewal.
+        Raises `LeaseError` if a lease has been taken over by another owner.
+        Cheap enough to call after every command.
+        """
+        pass
+
+    def flush(self):
+        """
+        Persists any status updates that the registry has accepted but not yet written.
+        Registries that write through on every update have nothing to do here.
+        """
+        pass
+
+    def close(self):
+        """
+        Flushes pending status updates and releases any resources held by the registry.
+        The registry may still be used afterwards, resources are then acquired again.
+        """
+        self.flush()
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of idle SQLite connections shared by all registries in the process.
+
+    Registries check a connection out when they first need one and return it on ``close()``,
+    so short-lived sequences reuse connections that are already open and configured instead
+    of paying for connecting and checking the schema every time.
+
+    At most ``max_size`` idle connections are kept; connections idle for longer than
+    ``idle_timeout`` seconds are closed. Checked out connections are not limited.
+    """
+
+    def __init__(self, max_size=32, idle_timeout=300):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._idle = {}
+
+    def __len__(self):
+        """
+        Number of idle connections in the pool.
+        """
+        with self._lock:
+            return sum(len(v) for v in self._idle.values())
+
+    def acquire(self, key, connect):
+        """
+        Returns an idle connection registered under ``key``, or a new one created by calling ``connect()``.
+        """
+        with self._lock:
+            expired = self._pop_expired()
+            connection = None
+            if self._idle.get(key):
+                connection, _ = self._idle[key].pop()
+        self._close_all(expired)
+        if connection is None:
+            connection = connect()
+        return connection
+
+    def release(self, key, connection):
+        """
+        Returns a connection to the pool for reuse under ``key``.
+        """
+        connection.rollback()
+        with self._lock:
+            self._idle.setdefault(key, []).append((connection, time.time()))
+            evicted = self._pop_expired()
+            while sum(len(v) for v in self._idle.values()) > self.max_size:
+                evicted.append(self._pop_oldest())
+        self._close_all(evicted)
+
+    def clear(self):
+        """
+        Closes all idle connections.
+        """
+        with self._lock:
+            evicted = [c for v in self._idle.values() for c, _ in v]
+            self._idle.clear()
+        self._close_all(evicted)
+
+    def _pop_expired(self):
+        expired = []
+        if self.idle_timeout is None:
+            return expired
+        threshold = time.time() - self.idle_timeout
+        for key in list(self._idle):
+            expired.extend(c for c, released_at in self._idle[key] if released_at < threshold)
+            self._idle[key] = [(c, t) for c, t in self._idle[key] if t >= threshold]
+        return expired
+
+    def _pop_oldest(self):
+        key = min((k for k in self._idle if self._idle[k]), key=lambda k: self._idle[k][0][1])
+        connection, _ = self._idle[key].pop(0)
+        return connection
+
+    def _close_all(self, connections):
+        for connection in connections:
+            connection.close()
+
+
+default_connection_pool = ConnectionPool()
+
 
 class SqliteStateRegistry(StateRegistry):
+    """
+    Stores command statuses in a SQLite database.
+
+    By default every ``update_status`` is committed immediately. With ``batch_writes`` enabled,
+    updates are buffered and written in a single transaction when ``flush_every`` updates
+    are pending, when the oldest pending update is ``flush_interval`` milliseconds old
+    (checked on each update), or when ``flush()`` is called -- ``Sequence`` calls it at the end
+    of every run, including runs that fail.
+
+    Durability guarantee of batched writes: only transitions to ``finished`` are ever deferred.
+    Any other status (``failed``, or ``unknown`` after a reset) is written immediately
+    together with everything pending. A crash can therefore only lose the record that
+    a command finished, which makes it run again, but never leaves a command recorded
+    as finished when it was reset or failed afterwards.
+
+    With ``keep_history`` enabled, every attempt to run a command is also recorded in a history
+    table, see `record_attempt`. History is written together with statuses, so it is batched
+    the same way. So are persisted command results, see `save_result`.
+
+    Connections are opened with the pragmas in ``pragmas``: WAL journaling lets readers
+    (for example ``idemseq ... list``) run while a sequence is writing, and
+    ``synchronous=NORMAL`` syncs on WAL checkpoints rather than on every commit.
+    A database survives process crashes; only an OS crash or power loss can roll back
+    the most recent commits, with the same consequence as losing batched writes.
+
+    Leases are stored in a leases table and acquired in ``BEGIN IMMEDIATE`` transactions
+    which wait at most ``lease_busy_timeout`` milliseconds for other writers, so that
+    contending runners get an answer quickly and can back off. Held leases are renewed
+    in the same transaction as every flush of status updates, which fails, and writes nothing,
+    if a lease has been taken over by another owner in the meantime.
+    """
+
     _table_name = 'steps'
 
-    def __init__(self, name=None):
+    # Bump when the layout of the tables changes. Stored in the database as PRAGMA user_version
+    # so that opening an up-to-date database costs a single pragma read.
+    _schema_version = 5
+
+    pragmas = (
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('cache_size', -8000),  # KiB
+        ('mmap_size', 64 * 1024 * 1024),
+        ('busy_timeout', 5000),  # milliseconds
+    )
+
+    cached_statements = 64
+
+    # Set to None to not pool connections of this registry
+    connection_pool = default_connection_pool
+
+    _statements = {
+        'create_table': 'CREATE TABLE IF NOT EXISTS {table} (name varchar primary key, status varchar)',
+        'create_history_table': (
+            'CREATE TABLE IF NOT EXISTS {table}_history ('
+            'name varchar NOT NULL, started_at real, finished_at real, duration real, '
+            'previous_status varchar, status varchar, error_type varchar'
+            ')'
+        ),
+        'create_history_index': 'CREATE INDEX IF NOT EXISTS {table}_history_name ON {table}_history (name)',
+        'update_status': 'INSERT OR REPLACE INTO {table} (name, status) VALUES (?, ?)',
+        'get_status': 'SELECT status FROM {table} WHERE name = ?',
+        'get_known_statuses': 'SELECT name, status FROM {table}',
+        'add_history_retry_delay': 'ALTER TABLE {table}_history ADD COLUMN retry_delay real',
+        'record_attempt': (
+            'INSERT INTO {table}_history '
+            '(name, started_at, finished_at, duration, previous_status, status, error_type, retry_delay) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)'
+        ),
+        'get_history': (
+            'SELECT name, started_at, finished_at, duration, previous_status, status, error_type, retry_delay '
+            'FROM {table}_history ORDER BY started_at'
+        ),
+        'get_command_history': (
+            'SELECT name, started_at, finished_at, duration, previous_status, status, error_type, retry_delay '
+            'FROM {table}_history WHERE name = ? ORDER BY started_at'
+        ),
+        'create_lease_table': (
+            'CREATE TABLE IF NOT EXISTS {table}_leases '
+            '(resource varchar primary key, owner varchar NOT NULL, expires_at real NOT NULL)'
+        ),
+        'get_lease': 'SELECT owner, expires_at FROM {table}_leases WHERE resource = ?',
+        'set_lease': 'INSERT OR REPLACE INTO {table}_leases (resource, owner, expires_at) VALUES (?, ?, ?)',
+        'renew_lease': 'UPDATE {table}_leases SET expires_at = ?3 WHERE resource = ?1 AND owner = ?2',
+        'delete_lease': 'DELETE FROM {table}_leases WHERE resource = ? AND owner = ?',
+        'create_results_table': (
+            'CREATE TABLE IF NOT EXISTS {table}_results (name varchar primary key, data blob, input_hash varchar)'
+        ),
+        'save_result': 'INSERT OR REPLACE INTO {table}_results (name, data, input_hash) VALUES (?, ?, ?)',
+        'load_result': 'SELECT data, input_hash FROM {table}_results WHERE name = ?',
+        'get_input_hashes': 'SELECT name, input_hash FROM {table}_results WHERE input_hash IS NOT NULL',
+    }
+
+    # Statements run, in this order, when the database's schema version is behind
+    _schema = (
+        'create_table', 'create_history_table', 'create_history_index', 'create_lease_table', 'create_results_table',
+    )
+
+    # Statements run when the database's schema version is behind the version they were added in.
+    # Unlike those in ``_schema``, they can only run once.
+    _migrations = (
+        (5, 'add_history_retry_delay'),
+    )
+
+    _history_columns = (
+        'name', 'started_at', 'finished_at', 'duration', 'previous_status', 'status', 'error_type', 'retry_delay',
+    )
+
+    batch_writes = False
+    flush_every = None
+    flush_interval = None
+
+    keep_history = False
+
+    # Milliseconds to wait for other writers when acquiring a lease, instead of busy_timeout
+    lease_busy_timeout = 50
+
+    def __init__(self, name=None, batch_writes=None, flush_every=None, flush_interval=None, keep_history=None):
         if name is None:
             name = ':memory:'
         super(SqliteStateRegistry, self).__init__(name)
         self._actual_connection = None
 
+        if batch_writes is not None:
+            self.batch_writes = batch_writes
+        if flush_every is not None:
+            self.flush_every = flush_every
+        if flush_interval is not None:
+            self.flush_interval = flush_interval
+        if keep_history is not None:
+            self.keep_history = keep_history
+
+        self._pending_statuses = collections.OrderedDict()
+        self._pending_attempts = []
+        self._pending_results = collections.OrderedDict()
+        self._pending_since = None
+
+        # Leases held through this registry: resource -> (owner, ttl, time of last renewal)
+        self._leases = {}
+
+        self._sql = {k: v.format(table=self._table_name) for k, v in self._statements.items()}
+
+    @property
+    def _database(self):
+        """
+        Path of the SQLite database file to connect to.
+        """
+        return self.name
+
+    def _params(self, *values):
+        """
+        Returns query parameters for the statements in ``_statements``.
+        """
+        return values
+
     def update_status(self, command, status):
         if status not in SequenceCommand.valid_statuses:
             raise ValueError(status)
+
+        self._pending_statuses.pop(command.name, None)
+        self._pending_statuses[command.name] = status
+        if self._pending_since is None:
+            self._pending_since = time.time()
+
+        if not self.batch_writes or self._should_flush(status):
+            self.flush()
+
+    def record_attempt(self, command, started_at, finished_at, status, previous_status=None, error_type=None,
+                       retry_delay=None):
+        if not self.keep_history:
+            return
+        self._pending_attempts.append((
+            command.name, started_at, finished_at, finished_at - started_at, previous_status, status, error_type,
+            retry_delay,
+        ))
+        if self._pending_since is None:
+            self._pending_since = time.time()
+        if not self.batch_writes:
+            self.flush()
+
+    def get_history(self, name=None):
+        self.flush()
+        with self._cursor() as cursor:
+            if name is None:
+                cursor.execute(self._sql['get_history'], self._params())
+            else:
+                cursor.execute(self._sql['get_command_history'], self._params(name))
+            return [dict(zip(self._history_columns, row)) for row in cursor.fetchall()]
+
+    def _should_flush(self, last_status):
+        if last_status != SequenceCommand.status_finished:
+            return True
+        if self.flush_every is not None and len(self._pending_statuses) >= self.flush_every:
+            return True
+        if self.flush_interval is not None and (time.time() - self._pending_since) * 1000 >= self.flush_interval:
+            return True
+        return False
+
+    def flush(self):
+        if not self._pending_statuses and not self._pending_attempts and not self._pending_results:
+            return
+        try:
+            with self._cursor() as cursor:
+                if self._pending_results:
+                    cursor.executemany(
+                        self._sql['save_result'],
+                        [self._params(name, *result) for name, result in self._pending_results.items()],
+                    )
+                if self._pending_statuses:
+                    cursor.executemany(
+                        self._sql['update_status'],
+                        [self._params(*s) for s in self._pending_statuses.items()],
+                    )
+                if self._pending_attempts:
+                    cursor.executemany(self._sql['record_attempt'], [self._params(*a) for a in self._pending_attempts])
+                self._renew_leases(cursor)
+        except LeaseError:
+            # Whoever holds the lease now decides what the state is
+            self._clear_pending()
+            raise
+        self._clear_pending()
+
+    def _clear_pending(self):
+        self._pending_statuses.clear()
+        del self._pending_attempts[:]
+        self._pending_results.clear()
+        self._pending_since = None
+
+    def save_result(self, command, data, input_hash=None):
+        # Written together with the status update that follows, see SequenceCommand.run
+        self._pending_results[command.name] = (sqlite3.Binary(data) if data is not None else None), input_hash
+        if self._pending_since is None:
+            self._pending_since = time.time()
+
+    def load_result(self, command):
+        if command.name in self._pending_results:
+            data, input_hash = self._pending_results[command.name]
+        else:
+            with self._cursor() as cursor:
+                cursor.execute(self._sql['load_result'], self._params(command.name))
+                row = cursor.fetchone()
+            if row is None:
+                return None
+            data, input_hash = row
+        return (bytes(data) if data is not None else None), input_hash
+
+    def get_input_hashes(self):
+        with self._cursor() as cursor:
+            cursor.execute(self._sql['get_input_hashes'], self._params())
+            input_hashes = {r[0]: r[1] for r in cursor.fetchall()}
+        input_hashes.update(
+            (name, input_hash) for name, (_, input_hash) in self._pending_results.items() if input_hash is not None
+        )
+        return input_hashes
+
+    def _renew_leases(self, cursor):
+        now = time.time()
+        for resource, (owner, ttl, _) in list(self._leases.items()):
+            cursor.execute(self._sql['renew_lease'], self._params(resource, owner, now + ttl))
+            if cursor.rowcount == 0:
+                del self._leases[resource]
+                raise LeaseError(resource, owner, 'Lease on {} was taken over from {}'.format(resource, owner))
+            self._leases[resource] = owner, ttl, now
+
+    def heartbeat(self):
+        now = time.time()
+        if not any(now - renewed_at >= ttl / 3.0 for _, ttl, renewed_at in self._leases.values()):
+            return
+        if self._pending_statuses or self._pending_attempts or self._pending_results:
+            self.flush()
+        else:
+            with self._cursor() as cursor:
+                self._renew_leases(cursor)
+
+    def acquire_lease(self, resource, owner, ttl):
+        self.flush()
+        connection = self._connection
+        connection.execute('PRAGMA busy_timeout = {:d}'.format(self.lease_busy_timeout))
+        try:
+            try:
+                connection.execute('BEGIN IMMEDIATE')
+            except sqlite3.OperationalError as e:
+                # Another runner is writing, treat it like a lease held by someone else
+                log.debug('Could not lock database to acquire lease on {}: {}'.format(resource, e))
+                return False
+            try:
+                now = time.time()
+                row = connection.execute(self._sql['get_lease'], self._params(resource)).fetchone()
+                if row is not None and row[0] != owner and row[1] > now:
+                    connection.rollback()
+                    return False
+                if row is not None and row[0] != owner:
+                    log.warning('Taking over lease on {} from {} which expired'.format(resource, row[0]))
+                connection.execute(self._sql['set_lease'], self._params(resource, owner, now + ttl))
+                connection.commit()
+            except Exception:
+                connection.rollback()
+                raise
+        finally:
+            connection.execute('PRAGMA busy_timeout = {:d}'.format(dict(self.pragmas).get('busy_timeout', 0)))
+        self._leases[resource] = owner, ttl, now
+        return True
+
+    def release_lease(self, resource, owner):
+        self.flush()
+        self._leases.pop(resource, None)
         with self._cursor() as cursor:
-            cursor.execute('INSERT OR REPLACE INTO {} (name, status) VALUES (?, ?)'.format(
-                self._table_name,
-            ), (command.name, status))
+            cursor.execute(self._sql['delete_lease'], self._params(resource, owner))
 
     def get_status(self, command):
+        if command.name in self._pending_statuses:
+            return self._pending_statuses[command.name]
         with self._cursor() as cursor:
-            cursor.execute('SELECT status FROM {} WHERE name = ?'.format(
-                self._table_name,
-            ), (command.name,))
+            cursor.execute(self._sql['get_status'], self._params(command.name))
             rows = list(cursor.fetchall())
             if not rows:
                 return SequenceCommand.status_unknown
@@ -71,29 +538,72 @@ class SqliteStateRegistry(StateRegistry):
 
     def get_known_statuses(self):
         with self._cursor() as cursor:
-            cursor.execute('SELECT name, status FROM {}'.format(
-                self._table_name
-            ))
-            return {r[0]: r[1] for r in cursor.fetchall()}
+            cursor.execute(self._sql['get_known_statuses'], self._params())
+            statuses = {r[0]: r[1] for r in cursor.fetchall()}
+        statuses.update(self._pending_statuses)
+        return statuses
 
-    def _ensure_tables_exist(self):
-        with self._cursor() as cursor:
-            cursor.execute('SELECT * FROM sqlite_master WHERE type = "table";')
-            tables = list(cursor.fetchall())
-            if not tables:
-                cursor.execute('CREATE TABLE {} (name varchar primary key, status varchar);'.format(
-                    self._table_name
-                ))
+    def _ensure_tables_exist(self, connection):
+        if connection.execute('PRAGMA user_version').fetchone()[0] >= self._schema_version:
+            return
+        with connection:
+            # Another process may be upgrading the same database, check again once it's done
+            connection.execute('BEGIN IMMEDIATE')
+            version = connection.execute('PRAGMA user_version').fetchone()[0]
+            if version >= self._schema_version:
+                return
+            for statement in self._schema:
+                connection.execute(self._sql[statement])
+            for added_in_version, statement in self._migrations:
+                if version < added_in_version:
+                    connection.execute(self._sql[statement])
+            connection.execute('PRAGMA user_version = {:d}'.format(self._schema_version))
+
+    def _configure_connection(self, connection):
+        for pragma, value in self.pragmas:
+            connection.execute('PRAGMA {} = {}'.format(pragma, value))
+
+    def _connect(self):
+        if self._database != ':memory:':
+            log.debug('Opening/creating SQLite database at {}'.format(self._database))
+        # Pooled connections may be checked out by a different thread than the one that opened them.
+        connection = sqlite3.connect(
+            self._database,
+            cached_statements=self.cached_statements,
+            check_same_thread=False,
+        )
+        self._configure_connection(connection)
+        self._ensure_tables_exist(connection)
+        return connection
+
+    @property
+    def _pool_key(self):
+        return self.__class__, self._database
+
+    @property
+    def _is_pooled(self):
+        # Every connection to :memory: is a separate database so those can't be shared
+        return self.connection_pool is not None and self._database != ':memory:'
 
     @property
     def _connection(self):
         if self._actual_connection is None:
-            if self.name != ':memory:':
-                log.debug('Opening/creating SQLite database at {}'.format(self.name))
-            self._actual_connection = sqlite3.connect(self.name)
-            self._ensure_tables_exist()
+            if self._is_pooled:
+                self._actual_connection = self.connection_pool.acquire(self._pool_key, self._connect)
+            else:
+                self._actual_connection = self._connect()
         return self._actual_connection
 
+    def close(self):
+        self.flush()
+        if self._actual_connection is None:
+            return
+        connection, self._actual_connection = self._actual_connection, None
+        if self._is_pooled:
+            self.connection_pool.release(self._pool_key, connection)
+        else:
+            connection.close()
+
     @contextlib.contextmanager
     def _cursor(self):
         cursor = self._connection.cursor()
@@ -107,20 +617,206 @@ class SqliteStateRegistry(StateRegistry):
             cursor.close()
 
 
+class SharedSqliteStateRegistry(SqliteStateRegistry):
+    """
+    Stores statuses of many sequences in one SQLite database, keyed by ``(sequence_id, name)``.
+
+    The registry name is the sequence id, the database file is set with the ``database``
+    class attribute or constructor argument::
+
+        class JobsStateRegistry(SharedSqliteStateRegistry):
+            database = '/var/lib/jobs/sequences.db'
+
+        class JobSequence(Sequence):
+            state_registry_cls = JobsStateRegistry
+
+    Besides the usual per-sequence methods, the registry answers questions across
+    all sequences in the database, see `find_sequences` and `get_known_statuses_by_sequence`.
+    """
+
+    _table_name = 'sequence_steps'
+
+    _schema_version = 5
+
+    _statements = {
+        'create_table': (
+            'CREATE TABLE IF NOT EXISTS {table} ('
+            'sequence_id varchar NOT NULL, name varchar NOT NULL, status varchar, '
+            'PRIMARY KEY (sequence_id, name)'
+            ') WITHOUT ROWID'
+        ),
+        'create_index': 'CREATE INDEX IF NOT EXISTS {table}_name_status ON {table} (name, status)',
+        'create_history_table': (
+            'CREATE TABLE IF NOT EXISTS {table}_history ('
+            'sequence_id varchar NOT NULL, name varchar NOT NULL, started_at real, finished_at real, '
+            'duration real, previous_status varchar, status varchar, error_type varchar'
+            ')'
+        ),
+        'create_history_index': (
+            'CREATE INDEX IF NOT EXISTS {table}_history_sequence_name ON {table}_history (sequence_id, name)'
+        ),
+        'add_history_retry_delay': 'ALTER TABLE {table}_history ADD COLUMN retry_delay real',
+        'record_attempt': (
+            'INSERT INTO {table}_history '
+            '(sequence_id, name, started_at, finished_at, duration, previous_status, status, error_type, retry_delay) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'
+        ),
+        'get_history': (
+            'SELECT name, started_at, finished_at, duration, previous_status, status, error_type, retry_delay '
+            'FROM {table}_history WHERE sequence_id = ? ORDER BY started_at'
+        ),
+        'get_command_history': (
+            'SELECT name, started_at, finished_at, duration, previous_status, status, error_type, retry_delay '
+            'FROM {table}_history WHERE sequence_id = ? AND name = ? ORDER BY started_at'
+        ),
+        'update_status': 'INSERT OR REPLACE INTO {table} (sequence_id, name, status) VALUES (?, ?, ?)',
+        'get_status': 'SELECT status FROM {table} WHERE sequence_id = ? AND name = ?',
+        'get_known_statuses': 'SELECT name, status FROM {table} WHERE sequence_id = ?',
+        'get_all_known_statuses': 'SELECT sequence_id, name, status FROM {table}',
+        'get_known_statuses_in': 'SELECT sequence_id, name, status FROM {table} WHERE sequence_id IN ({{placeholders}})',
+        'find_sequences': 'SELECT sequence_id FROM {table} WHERE name = ? AND status = ? ORDER BY sequence_id',
+        'list_sequences': 'SELECT DISTINCT sequence_id FROM {table} ORDER BY sequence_id',
+        'create_lease_table': (
+            'CREATE TABLE IF NOT EXISTS {table}_leases ('
+            'sequence_id varchar NOT NULL, resource varchar NOT NULL, owner varchar NOT NULL, '
+            'expires_at real NOT NULL, PRIMARY KEY (sequence_id, resource)'
+            ') WITHOUT ROWID'
+        ),
+        'get_lease': 'SELECT owner, expires_at FROM {table}_leases WHERE sequence_id = ? AND resource = ?',
+        'set_lease': (
+            'INSERT OR REPLACE INTO {table}_leases (sequence_id, resource, owner, expires_at) VALUES (?, ?, ?, ?)'
+        ),
+        'renew_lease': (
+            'UPDATE {table}_leases SET expires_at = ?4 WHERE sequence_id = ?1 AND resource = ?2 AND owner = ?3'
+        ),
+        'delete_lease': 'DELETE FROM {table}_leases WHERE sequence_id = ? AND resource = ? AND owner = ?',
+        'create_results_table': (
+            'CREATE TABLE IF NOT EXISTS {table}_results ('
+            'sequence_id varchar NOT NULL, name varchar NOT NULL, data blob, input_hash varchar, '
+            'PRIMARY KEY (sequence_id, name)'
+            ')'
+        ),
+        'save_result': 'INSERT OR REPLACE INTO {table}_results (sequence_id, name, data, input_hash) VALUES (?, ?, ?, ?)',
+        'load_result': 'SELECT data, input_hash FROM {table}_results WHERE sequence_id = ? AND name = ?',
+        'get_input_hashes': (
+            'SELECT name, input_hash FROM {table}_results WHERE sequence_id = ? AND input_hash IS NOT NULL'
+        ),
+    }
+
+    _schema = (
+        'create_table', 'create_index', 'create_history_table', 'create_history_index', 'create_lease_table',
+        'create_results_table',
+    )
+
+    # Stay well below SQLITE_MAX_VARIABLE_NUMBER of older SQLite builds
+    _max_query_params = 500
+
+    database = None
+
+    def __init__(self, name=None, database=None, **kwargs):
+        if name is None:
+            raise ValueError('{} requires a sequence id as its name'.format(self.__class__.__name__))
+        if database is not None:
+            self.database = database
+        if self.database is None:
+            raise ValueError('{} requires a database'.format(self.__class__.__name__))
+        super(SharedSqliteStateRegistry, self).__init__(name=name, **kwargs)
+
+    @property
+    def sequence_id(self):
+        return self.name
+
+    @property
+    def _database(self):
+        return self.database
+
+    def _params(self, *values):
+        return (self.sequence_id,) + values
+
+    def list_sequences(self):
+        """
+        Returns ids of all sequences that have a status recorded in the database.
+        """
+        self.flush()
+        with self._cursor() as cursor:
+            cursor.execute(self._sql['list_sequences'])
+            return [r[0] for r in cursor.fetchall()]
+
+    def find_sequences(self, name, status):
+        """
+        Returns ids of all sequences in which command ``name`` has the given ``status``.
+        """
+        if status not in SequenceCommand.valid_statuses:
+            raise ValueError(status)
+        self.flush()
+        with self._cursor() as cursor:
+            cursor.execute(self._sql['find_sequences'], (name, status))
+            return [r[0] for r in cursor.fetchall()]
+
+    def get_known_statuses_by_sequence(self, sequence_ids=None):
+        """
+        Returns a mapping of sequence ids to mappings of command names to command statuses,
+        for the specified sequences or for all sequences in the database.
+        Sequences without any recorded status are omitted.
+        """
+        self.flush()
+        statuses = collections.defaultdict(dict)
+        with self._cursor() as cursor:
+            if sequence_ids is None:
+                cursor.execute(self._sql['get_all_known_statuses'])
+                rows = cursor.fetchall()
+            else:
+                sequence_ids = list(sequence_ids)
+                rows = []
+                for i in range(0, len(sequence_ids), self._max_query_params):
+                    chunk = sequence_ids[i:i + self._max_query_params]
+                    cursor.execute(
+                        self._sql['get_known_statuses_in'].replace('{placeholders}', ', '.join('?' * len(chunk))),
+                        chunk,
+                    )
+                    rows.extend(cursor.fetchall())
+        for sequence_id, name, status in rows:
+            statuses[sequence_id][name] = status
+        return dict(statuses)
+
+
 class DryRunStateRegistry(StateRegistry):
-    def __init__(self, name=None):
+    """
+    Copy-on-write overlay over a real state registry. Statuses are read through
+    from the real registry, status updates are kept in memory and never reach it.
+    """
+
+    blocking = False
+
+    def __init__(self, name=None, real_state_registry=None):
         # Always generate a unique name to ensure that dry runs aren't related to each other.
-        # Dry run state should always be a copy of the last known real state.
         name = '{}-{}'.format(name, uuid.uuid4())
         super(DryRunStateRegistry, self).__init__(name)
+        self._real_state_registry = real_state_registry
         self._storage = {}
+        if real_state_registry is not None:
+            self.blocking = real_state_registry.blocking
 
     def get_status(self, command):
-        return self._storage.get(command.name, SequenceCommand.status_unknown)
+        if command.name in self._storage:
+            return self._storage[command.name]
+        if self._real_state_registry is not None:
+            return self._real_state_registry.get_status(command)
+        return SequenceCommand.status_unknown
 
     def get_known_statuses(self):
-        return self._storage
+        if self._real_state_registry is None:
+            return self._storage
+        known_statuses = dict(self._real_state_registry.get_known_statuses())
+        known_statuses.update(self._storage)
+        return known_statuses
 
     def update_status(self, command, status):
         assert status in SequenceCommand.valid_statuses
         self._storage[command.name] = status
+
+    def discard_status(self, command):
+        """
+        Forgets the status recorded in the dry run so that the real one shows through again.
+        """
+        self._storage.pop(command.name, None)
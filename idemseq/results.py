@@ -0,0 +1,134 @@
+"""
+Encoding of command results persisted in state registries, and hashing of command inputs.
+
+A command declared with ``persist_result=True`` (pickle) or ``persist_result='json'`` / ``'msgpack'``
+has its return value stored in the state registry when it finishes. Later commands, also in later
+processes, receive it as the argument named after the command::
+
+    @base.command(persist_result='json')
+    def fetch(url):
+        return requests.get(url).json()
+
+    @base.command
+    def parse(fetch):
+        ...
+
+A command declared with ``invalidate_on_change=True`` runs again, even though finished,
+when the hash of the arguments it is called with differs from the one of its last run.
+A command declared with ``fingerprint=True`` also runs again when its code or its declared
+``version`` changes::
+
+    @base.command(fingerprint=True, version=2)
+    def parse(fetch):
+        ...
+"""
+import json
+
+
+class ResultSerializer(object):
+    name = None
+
+    def dumps(self, value):
+        raise NotImplementedError()
+
+    def loads(self, data):
+        raise NotImplementedError()
+
+
+class PickleResultSerializer(ResultSerializer):
+    name = 'pickle'
+
+    def dumps(self, value):
+        import pickle
+        return pickle.dumps(value, protocol=2)
+
+    def loads(self, data):
+        import pickle
+        return pickle.loads(data)
+
+
+class JsonResultSerializer(ResultSerializer):
+    name = 'json'
+
+    def dumps(self, value):
+        return json.dumps(value).encode('utf-8')
+
+    def loads(self, data):
+        return json.loads(data.decode('utf-8'))
+
+
+class MsgpackResultSerializer(ResultSerializer):
+    """
+    Requires the msgpack package.
+    """
+
+    name = 'msgpack'
+
+    def dumps(self, value):
+        import msgpack
+        return msgpack.packb(value, use_bin_type=True)
+
+    def loads(self, data):
+        import msgpack
+        return msgpack.unpackb(data, raw=False)
+
+
+serializers = {s.name: s() for s in (PickleResultSerializer, JsonResultSerializer, MsgpackResultSerializer)}
+
+
+def encode_result(value, format='pickle', compress=False):
+    """
+    Returns bytes which start with a header line naming the format and compression, if any.
+    """
+    data = serializers[format].dumps(value)
+    header = format
+    if compress:
+        import zlib
+        data = zlib.compress(data)
+        header += '+zlib'
+    return header.encode('ascii') + b'\n' + data
+
+
+def decode_result(encoded):
+    header, data = bytes(encoded).split(b'\n', 1)
+    format, _, compression = header.decode('ascii').partition('+')
+    if compression == 'zlib':
+        import zlib
+        data = zlib.decompress(data)
+    return serializers[format].loads(data)
+
+
+def hash_inputs(kwargs):
+    """
+    Returns a hash of keyword arguments of a command call. Values which aren't JSON serialisable
+    are hashed by their ``repr``, so objects without a stable ``repr`` always count as changed,
+    as do arguments which can't be encoded at all, like self-referencing containers.
+    """
+    import hashlib
+    try:
+        encoded = json.dumps(_canonical(kwargs), sort_keys=True, default=repr)
+    except (TypeError, ValueError, RuntimeError):
+        import uuid
+        encoded = uuid.uuid4().hex
+    return hashlib.sha1(encoded.encode('utf-8')).hexdigest()
+
+
+def _canonical(value):
+    """
+    Returns a JSON-friendly equivalent of ``value`` which encodes the same way in every process:
+    elements of sets are sorted, and dictionary keys other than strings become strings
+    prefixed with their type, so that keys of mixed types can be sorted.
+    """
+    if isinstance(value, dict):
+        return {
+            (k if isinstance(k, str) else '{}:{!r}'.format(type(k).__name__, k)): _canonical(v)
+            for k, v in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    if isinstance(value, (set, frozenset)):
+        return sorted(
+            (_canonical(v) for v in value),
+            key=lambda v: json.dumps(v, sort_keys=True, default=repr),
+        )
+    return value
@@ -1,56 +1,130 @@
+import contextlib
 import logging
 
 import collections
 
-import functools
+import math
+import os
+import threading
+import time
 import uuid
+import weakref
 
-from werkzeug.local import LocalStack, LocalProxy
+from concurrent import futures
 
-from idemseq.base import Options, AttrDict, DryRunResult
-from idemseq.command import Command
-from idemseq.exceptions import SequenceCommandException
+# Modules only needed by some runs (random, socket) are imported where they are used
+# to keep start-up of the CLI fast, see idemseq.cli
+
+from idemseq.base import FlatAttrDict, FlatOptions, DryRunResult
+from idemseq.cancellation import Cancellation, cancellation_scope
+from idemseq.command import Command, resolve_import_path
+from idemseq.exceptions import CommandTimeoutError, LeaseError, MissingContextError, SequenceCommandException
+from idemseq.metrics import MetricsHook, measure_command, measure_run
+from idemseq.results import decode_result, encode_result, hash_inputs
 
 log = logging.getLogger(__name__)
 
 
-class SequenceRunOptions(Options):
+def _percentile(values, percentile):
+    """
+    Returns the nearest-rank percentile of values, or None if there are no values.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = int(math.ceil(percentile / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+class SequenceRunOptions(FlatOptions):
     _valid_options = {
         'warn_only': False,
         'dry_run': None,
         'start_at': None,
         'stop_before': None,
         'force': None,
+        'max_workers': None,
+        'timeout': None,
+        'on_timeout': None,
+        'executor': None,
     }
 
 
-_sequence_env_stacks = collections.defaultdict(LocalStack)
+class SequenceEnvStack(threading.local):
+    """
+    Stack of `SequenceEnv` of one sequence. Each thread sees its own stack.
+    """
+
+    def __init__(self):
+        self.envs = []
+
+    @property
+    def top(self):
+        envs = self.envs
+        return envs[-1] if envs else None
+
+    def push(self, env):
+        self.envs.append(env)
+
+    def pop(self):
+        envs = self.envs
+        return envs.pop() if envs else None
+
+
+# Env stacks by sequence uid. A sequence owns its stack so the entry is gone
+# as soon as the sequence is garbage-collected.
+_sequence_env_stacks = weakref.WeakValueDictionary()
 
 
 def get_current_sequence_env(sequence_uid):
-    env = _sequence_env_stacks[sequence_uid].top
+    stack = _sequence_env_stacks.get(sequence_uid)
+    env = stack.top if stack is not None else None
     if env is None:
         raise RuntimeError('Requesting current sequence environment outside of context')
     return env
 
 
 class SequenceEnv(object):
+    """
+    Context and run options of a sequence, pushed onto and popped from the sequence's env stack.
+
+    When pushed, an env takes a flattened copy of the context and run options of the env
+    below it, so lookups don't depend on how deeply envs are nested.
+    """
+
+    context_cls = FlatAttrDict
+    run_options_cls = SequenceRunOptions
+
     def __init__(self, sequence_uid=None, context=None, **run_options):
         self.sequence_uid = sequence_uid
-        self.context = AttrDict(context or {})
-        self.run_options = SequenceRunOptions(run_options)
+        self.context = self.context_cls(context or {})
+        self.run_options = self.run_options_cls(run_options)
+
+        # Keeps alive the stack this env created because no sequence owns one for its uid
+        self._own_stack = None
 
     def push(self):
-        top = _sequence_env_stacks[self.sequence_uid].top
+        stack = _sequence_env_stacks.get(self.sequence_uid)
+        if stack is None:
+            stack = self._own_stack = _sequence_env_stacks[self.sequence_uid] = SequenceEnvStack()
+        top = stack.top
         if top:
             self.context.set_parent(top.context)
             self.run_options.set_parent(top.run_options)
-        _sequence_env_stacks[self.sequence_uid].push(self)
+        stack.push(self)
+
+    def flat_context(self):
+        """
+        Returns a mapping of all context values visible in this env. Don't modify it.
+        """
+        return self.context.flat_view()
 
     def pop(self):
-        popped = _sequence_env_stacks[self.sequence_uid].pop()
+        stack = _sequence_env_stacks.get(self.sequence_uid)
+        popped = stack.pop() if stack is not None else None
         if popped is not self:
             raise RuntimeError('Popped wrong {}'.format(self.__class__.__name__))
+        self._own_stack = None
         self.context.set_parent(None)
         self.run_options.set_parent(None)
 
@@ -61,22 +135,214 @@ class SequenceEnv(object):
         self.pop()
 
 
+RetryPolicy = collections.namedtuple('RetryPolicy', ('max_attempts', 'retry_on', 'backoff', 'max_backoff', 'budget'))
+
+
+def _schedule_retry(name, retry_policy, error, timing):
+    """
+    Decides whether to retry the command after the failed attempt timed in ``timing``.
+    Returns the number of seconds to wait before the next attempt, and moves the failed attempt
+    to ``timing['retries']``, or returns None if the command should not be retried.
+    """
+    retries = timing.setdefault('retries', [])
+    if len(retries) + 1 >= retry_policy.max_attempts:
+        return None
+    if not isinstance(error, retry_policy.retry_on):
+        return None
+
+    import random
+    delay = min(retry_policy.backoff * 2 ** len(retries), retry_policy.max_backoff) * random.uniform(0.5, 1.5)
+
+    if retry_policy.budget is not None:
+        first_started_at = retries[0]['started_at'] if retries else timing['started_at']
+        remaining = first_started_at + retry_policy.budget - timing['finished_at']
+        if delay >= remaining:
+            return None
+
+    log.warning('Command "{}" failed with {} (attempt {} of {}), retrying in {:.2f}s'.format(
+        name, type(error).__name__, len(retries) + 1, retry_policy.max_attempts, delay,
+    ))
+    retries.append({
+        'started_at': timing.pop('started_at'),
+        'finished_at': timing.pop('finished_at'),
+        'error_type': type(error).__name__,
+        'retry_delay': delay,
+    })
+    return delay
+
+
+def _call_with_retries(call, name, retry_policy, timing=None, cancellation=None):
+    """
+    Calls ``call`` until it succeeds or `_schedule_retry` gives up, and returns its result.
+    Start and end times of attempts are stored in ``timing``, see `SequenceCommand._execute`.
+    """
+    timing = {} if timing is None else timing
+    timing['running_since'] = time.time()
+    cancellation = Cancellation() if cancellation is None else cancellation
+    log.debug('Command "{}" starting'.format(name))
+    with cancellation_scope(cancellation):
+        while True:
+            timing['started_at'] = time.time()
+            try:
+                result = call()
+            except Exception as e:
+                timing['finished_at'] = time.time()
+                delay = None if cancellation.is_cancelled else _schedule_retry(name, retry_policy, e, timing)
+                if delay is None:
+                    log.error('Command "{}" failed with an exception'.format(name))
+                    raise
+            else:
+                timing['finished_at'] = time.time()
+                log.debug('Command "{}" finished'.format(name))
+                return result
+            # Nothing is held in the state registry while waiting, attempts are recorded afterwards
+            if cancellation.wait(delay):
+                cancellation.raise_if_cancelled()
+
+
+class _MeasurementRecorder(MetricsHook):
+    """
+    Collects measurements of command attempts made in a worker process, for the parent
+    to pass on to the sequence's metrics hook, see `SequenceCommand._complete`.
+    """
+
+    def __init__(self):
+        self.commands = []
+
+    def observe_command(self, sequence, command_name, outcome, wall_time, cpu_time):
+        self.commands.append((outcome, wall_time, cpu_time))
+
+
+def _execute_in_process(import_path, name, kwargs, retry_policy, measure=False):
+    """
+    Runs in a worker process: calls the command's function, found by its import path,
+    and returns a tuple of timing, the result and the exception, for the parent to record.
+    If ``measure`` is set, measurements of attempts are returned in ``timing['measurements']``.
+    """
+    func = resolve_import_path(import_path)
+    timing = {}
+    recorder = _MeasurementRecorder() if measure else None
+
+    def call():
+        with measure_command(recorder, None, name):
+            return func(**kwargs)
+
+    try:
+        return timing, _call_with_retries(call, name, retry_policy, timing), None
+    except Exception as e:
+        timing.setdefault('finished_at', time.time())
+        return timing, None, e
+    finally:
+        if recorder is not None:
+            timing['measurements'] = recorder.commands
+
+
+def _send_execution(connection, *args):
+    """
+    Runs in a process of its own, see `_ProcessTermination`: sends the outcome of `_execute_in_process`.
+    """
+    try:
+        connection.send(_execute_in_process(*args))
+    finally:
+        connection.close()
+
+
+class _ProcessTermination(Cancellation):
+    """
+    Runs a command in a process of its own, and cancels it by terminating the process.
+    """
+
+    def __init__(self):
+        super(_ProcessTermination, self).__init__()
+        self._lock = threading.Lock()
+        self._process = None
+
+    def run(self, timing, *args):
+        """
+        Called in a thread of `_ProcessPool`: starts the process and returns the outcome
+        of `_execute_in_process` called with ``args``. The timeout of the command counts
+        from when the process is started.
+        """
+        import multiprocessing
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        with self._lock:
+            self.raise_if_cancelled()
+            timing['running_since'] = time.time()
+            process = self._process = multiprocessing.Process(target=_send_execution, args=(sender,) + args)
+            process.daemon = True
+            process.start()
+        sender.close()
+        try:
+            # Checks now and then whether the process died without sending anything
+            while not receiver.poll(0.1):
+                if not process.is_alive() and not receiver.poll():
+                    break
+            else:
+                return receiver.recv()
+        except EOFError:
+            pass
+        finally:
+            receiver.close()
+            process.join()
+        self.raise_if_cancelled()
+        raise RuntimeError('Worker process exited with code {}'.format(process.exitcode))
+
+    def cancel(self):
+        with self._lock:
+            super(_ProcessTermination, self).cancel()
+            if self._process is not None:
+                self._process.terminate()
+
+
+class _ProcessPool(object):
+    """
+    Runs commands in worker processes for `Sequence._run_concurrently`, at most ``max_workers``
+    at a time. Commands without a timeout run in a shared process pool, those with a timeout
+    in a process of their own, see `_ProcessTermination`. Every command holds one of ``max_workers``
+    threads while it waits for or runs in a worker process.
+    """
+
+    def __init__(self, max_workers=None):
+        if max_workers is None:
+            import multiprocessing
+            max_workers = multiprocessing.cpu_count()
+        self._shared = futures.ProcessPoolExecutor(max_workers=max_workers)
+        self._slots = futures.ThreadPoolExecutor(max_workers=max_workers)
+
+    def submit(self, fn, *args, **kwargs):
+        return self._slots.submit(lambda: self._shared.submit(fn, *args, **kwargs).result())
+
+    def submit_to_own_process(self, termination, timing, *args):
+        return self._slots.submit(termination.run, timing, *args)
+
+    def shutdown(self, wait=True):
+        self._slots.shutdown(wait=wait)
+        self._shared.shutdown(wait=wait)
+
+
 class SequenceCommand(object):
     """
     Represents state of Command execution as part of a Sequence.
     
     This object should have no local state because user is allowed to create any number of these
     to represent the same thing. All writes should go to either self._command, or self._sequence.
+
+    A `Sequence` hands out one cached instance per command, so instances obtained from
+    the same sequence compare equal by identity.
     """
 
+    __slots__ = ('_command', '_sequence')
+
     status_unknown = 'unknown'
     status_failed = 'failed'
     status_finished = 'finished'
+    status_timed_out = 'timed_out'
 
     valid_statuses = (
         status_unknown,
         status_failed,
         status_finished,
+        status_timed_out,
     )
 
     def __init__(self, command, sequence=None):
@@ -85,6 +351,9 @@ class SequenceCommand(object):
         self._sequence = sequence
 
     def __getattr__(self, item):
+        if item in SequenceCommand.__slots__:
+            # Slots are unset until __init__ runs, e.g. in copy.copy(); don't delegate them
+            raise AttributeError(item)
         return getattr(self._command, item)
 
     def __setattr__(self, key, value):
@@ -94,16 +363,38 @@ class SequenceCommand(object):
             return setattr(self._command, key, value)
 
     def __eq__(self, other):
-        return (
+        return other is self or (
             isinstance(other, self.__class__)
-            and self._command == other._command
-            and self._sequence == other._sequence
+            and self._command is other._command
+            and self._sequence is other._sequence
         )
 
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self._command), id(self._sequence)))
+
     @property
     def command(self):
         return self._command
 
+    @property
+    def name(self):
+        return self._command.name
+
+    @property
+    def options(self):
+        return self._command.options
+
+    @property
+    def parameters(self):
+        return self._command.parameters
+
+    @property
+    def description(self):
+        return self._command.description
+
     @property
     def status(self):
         return self._sequence.get_command_status(self)
@@ -124,49 +415,316 @@ class SequenceCommand(object):
         """
         Low-level method to run individual commands.
         """
-        try:
-            if self._sequence.is_finished and not self.options.run_always:
-                log.debug('Command "{}" already completed - skipping'.format(self.name))
+        with self._sequence._status_snapshot(), self._warn_only_failures():
+            prepared = self._prepare()
+            if prepared is None:
                 return
+            timing = {}
+            try:
+                result = self._execute_with_timeout(*prepared, timing=timing)
+            except Exception as e:
+                self._sequence._record_attempt(self, timing, error=e)
+                if isinstance(e, CommandTimeoutError):
+                    self.status = self.status_timed_out
+                raise
+            self._sequence._record_attempt(self, timing)
+            self._sequence._save_result(self, result, prepared[0])
+            self.status = self.status_finished
+            return result
 
-            if self.is_finished and not (self.options.run_always or self.options.run_until_finished):
+    def _prepare(self):
+        """
+        Checks whether the command should and can run, and binds its arguments from context.
+        Returns None if the command should be skipped, otherwise a tuple of arguments for `_execute`.
+        Must be called in the thread that owns the sequence environment.
+        """
+        # Sequence.is_finished checks every command, so only when it can be true
+        if self.is_finished and not (self.options.run_always or self.tracks_inputs) and self._sequence.is_finished:
+            log.debug('Command "{}" already completed - skipping'.format(self.name))
+            self._sequence._observe_skip(self.name, MetricsHook.skip_already_finished)
+            return
+
+        if self.is_finished and not (self.options.run_always or self.options.run_until_finished):
+            if not self._inputs_changed():
                 log.debug('Command "{}" already completed - skipping'.format(self.name))
+                self._sequence._observe_skip(self.name, MetricsHook.skip_already_finished)
                 return
+            log.info('Code or inputs of command "{}" changed - running it again'.format(self.name))
+
+        # Make sure the commands this command depends on are all finished
+        if not self._sequence.run_options.force:
+            statuses = self._sequence._get_known_statuses()
+            unfinished_commands = [
+                name for name in self._sequence._base.requirements_of(self.name)
+                if statuses.get(name) != self.status_finished
+            ]
+
+            if unfinished_commands and self._sequence.run_options.on_timeout == 'continue':
+                timed_out_commands = [name for name in unfinished_commands if statuses.get(name) == self.status_timed_out]
+                if timed_out_commands:
+                    log.warning('Skipping command "{}" because commands it depends on timed out ({})'.format(
+                        self.name, ', '.join(timed_out_commands),
+                    ))
+                    self._sequence._observe_skip(self.name, MetricsHook.skip_dependency_timed_out)
+                    return
+
+            if unfinished_commands:
+                raise SequenceCommandException(
+                    self,
+                    'Previous commands not finished ({})'.format(', '.join(unfinished_commands)),
+                )
+
+        env = self._sequence._env
+        kwargs, missing = self._command.bind(env.flat_context(), self._sequence.results)
+        if missing:
+            raise MissingContextError(self, missing)
+
+        return kwargs, bool(env.run_options.dry_run)
 
-            # Make sure previous commands are all finished
-            if not self._sequence.run_options.force:
-                unfinished_commands = []
-                for command in self._sequence.all_commands:
-                    if command == self:
-                        break
-                    if not command.is_finished:
-                        unfinished_commands.append(command.name)
+    @property
+    def tracks_inputs(self):
+        """
+        True if the command runs again when finished, if its fingerprint changed:
+        the hash of its arguments (the invalidate_on_change option), and also of its code
+        and declared version (the fingerprint option).
+        """
+        return bool(self.options.invalidate_on_change or self.options.fingerprint)
 
-                if unfinished_commands:
-                    raise SequenceCommandException(
-                        self,
-                        'Previous commands not finished ({})'.format(', '.join(unfinished_commands)),
-                    )
+    def _inputs_changed(self):
+        """
+        Returns True if the command tracks its inputs and its fingerprint for the arguments
+        it would be called with now differs from the one of its last successful run.
+        Commands with arguments missing from context count as unchanged.
+        """
+        if not self.tracks_inputs:
+            return False
+        kwargs, missing = self._command.bind(self._sequence._env.flat_context(), self._sequence.results)
+        if missing:
+            return False
+        return self._sequence._stored_input_hashes().get(self.name) != self._sequence._fingerprint(self, kwargs)
+
+    def run_async(self):
+        """
+        Returns a coroutine which runs the command, see `Sequence.run_async`.
+        """
+        from idemseq.aio import run_command
+        return run_command(self)
+
+    @property
+    def timeout(self):
+        """
+        Seconds after which the command is cancelled and marked as timed out: the timeout option
+        of the command or, if not set, the timeout run option. None for no timeout.
+        """
+        if self.options.timeout is not None:
+            return self.options.timeout
+        return self._sequence.run_options.timeout
+
+    def _execute_with_timeout(self, kwargs, dry_run=False, timing=None):
+        """
+        Calls `_execute` in a separate thread if the command has a timeout, and waits for it
+        at most that long. Raises CommandTimeoutError after cancelling the command if it times out.
+        The thread is a daemon thread so that a command which ignores cancellation
+        doesn't keep the process from exiting.
+        """
+        timeout = self.timeout
+        if timeout is None or dry_run:
+            return self._execute(kwargs, dry_run=dry_run, timing=timing)
+
+        timing = {} if timing is None else timing
+        worker_timing = {}
+        cancellation = Cancellation()
+        future = futures.Future()
+
+        def target():
+            future.set_running_or_notify_cancel()
+            try:
+                future.set_result(self._execute(kwargs, timing=worker_timing, cancellation=cancellation))
+            except Exception as e:
+                future.set_exception(e)
+
+        thread = threading.Thread(target=target, name='idemseq-{}'.format(self.name))
+        thread.daemon = True
+        thread.start()
+        # Not future.result(timeout), its TimeoutError could also have been raised by the command
+        if not futures.wait([future], timeout=timeout).done:
+            raise self._cancel(cancellation, worker_timing, timing)
+        timing.update(worker_timing)
+        return future.result()
+
+    def _cancel(self, cancellation, worker_timing, timing):
+        """
+        Cancels the command which timed out while running in another thread, and stores in ``timing``
+        a snapshot of ``worker_timing``, which that thread may still be changing, for `_record_attempt`.
+        Returns CommandTimeoutError for the caller to raise.
+        """
+        cancellation.cancel()
+        now = time.time()
+        timing.update(
+            started_at=worker_timing.get('started_at', worker_timing.get('running_since', now)),
+            finished_at=now,
+            retries=list(worker_timing.get('retries', ())),
+        )
+        log.error('Command "{}" timed out after {} seconds'.format(self.name, self.timeout))
+        return CommandTimeoutError(self, self.timeout)
+
+    def _execute(self, kwargs, dry_run=False, timing=None, cancellation=None):
+        """
+        Calls the command with prepared arguments. Does not touch sequence state
+        so it is safe to call from worker threads.
+
+        If ``timing`` dictionary is passed, the start and end time of the call are
+        stored in it as ``started_at`` and ``finished_at``.
+
+        ``cancellation`` is made the current cancellation while the command runs,
+        see `idemseq.cancellation`.
+        """
+        if dry_run:
+            log.info('[dry-run] Command "{}"'.format(self.name))
+            self._sequence._observe_skip(self.name, MetricsHook.skip_dry_run)
+            return DryRunResult(command=self._command, kwargs=kwargs)
+        elif self._command.is_coroutine:
+            raise SequenceCommandException(self, 'Coroutine commands can only be run with run_async()')
 
-            kwargs = {}
-            for param in self._command.parameters:
-                if param.name in self._sequence.context:
-                    kwargs[param.name] = getattr(self._sequence.context, param.name)
+        def call():
+            with measure_command(self._sequence.metrics, self._sequence, self.name):
+                return self._command._func(**kwargs)
 
-            if self._sequence.run_options.dry_run:
-                log.info('[dry-run] Command "{}"'.format(self.name))
-                result = DryRunResult(command=self._command, kwargs=kwargs)
+        return _call_with_retries(call, self.name, self.retry_policy, timing, cancellation)
+
+    @property
+    def retry_policy(self):
+        """
+        `RetryPolicy` made of the retry options of the command, with defaults from the sequence.
+        """
+        options = self.options
+        return RetryPolicy(
+            max_attempts=options.max_attempts or 1,
+            retry_on=options.retry_on or Exception,
+            backoff=options.retry_backoff if options.retry_backoff is not None else self._sequence.retry_backoff,
+            max_backoff=(
+                options.retry_max_backoff if options.retry_max_backoff is not None
+                else self._sequence.retry_max_backoff
+            ),
+            budget=options.retry_budget,
+        )
+
+    def _schedule_retry(self, error, timing):
+        return _schedule_retry(self.name, self.retry_policy, error, timing)
+
+    @property
+    def import_path(self):
+        """
+        ``module:qualified.name`` of the command's function, or None if it can't be imported,
+        in which case the command can't be run in a process, see `Sequence.run`.
+        """
+        return self._command.import_path
+
+    def _submit_to_process(self, executor, kwargs, timing):
+        """
+        Submits execution of the command to a `_ProcessPool`, see `_submit`.
+        Commands with a timeout get a process of their own which is terminated if they time out.
+        Returns a future of the command's result and the cancellation of the command.
+        """
+        if self._command.is_coroutine:
+            raise SequenceCommandException(self, 'Coroutine commands can only be run with run_async()')
+        if self.import_path is None:
+            raise SequenceCommandException(
+                self, 'Commands run in processes must be functions importable by module and name',
+            )
+
+        args = self.import_path, self.name, kwargs, self.retry_policy, self._sequence.metrics is not None
+        if self.timeout is None:
+            cancellation = Cancellation()
+            worker_future = executor.submit(_execute_in_process, *args)
+        else:
+            cancellation = _ProcessTermination()
+            worker_future = executor.submit_to_own_process(cancellation, timing, *args)
+        future = futures.Future()
+
+        def unpack(worker_future):
+            # Called in a thread of the executor; the parent merges timing before anyone sees the outcome
+            try:
+                worker_timing, result, error = worker_future.result()
+            except BaseException as e:
+                worker_timing, result, error = {}, None, e
+            timing.update(worker_timing)
+            if future.cancelled():
+                return
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+        worker_future.add_done_callback(unpack)
+        return future, cancellation
+
+    def _submit(self, executor):
+        """
+        Prepares the command in the calling thread and submits its execution to executor.
+        Returns a tuple of the future, the timing dictionary and the keyword arguments to pass
+        to `_complete`, and the cancellation of the command, or None if the command was skipped
+        or failed under warn_only.
+        """
+        with self._warn_only_failures():
+            prepared = self._prepare()
+            if prepared is None:
+                return None
+            kwargs, dry_run = prepared
+            timing = {}
+            if isinstance(executor, _ProcessPool):
+                if dry_run:
+                    # Nothing to run; the sequence command itself can't be sent to a process
+                    cancellation = Cancellation()
+                    future = futures.Future()
+                    future.set_result(self._execute(kwargs, dry_run=True))
+                else:
+                    future, cancellation = self._submit_to_process(executor, kwargs, timing)
             else:
-                result = self._command(**kwargs)
+                cancellation = Cancellation()
+                future = executor.submit(self._execute, kwargs, dry_run, timing=timing, cancellation=cancellation)
+            return future, timing, kwargs, cancellation
 
+    def _complete(self, future, timing, kwargs=None):
+        """
+        Records the outcome of a future returned by `_submit`.
+        """
+        with self._warn_only_failures():
+            error = future.exception()
+            self._observe_measurements(timing)
+            self._sequence._record_attempt(self, timing, error=error)
+            if error is not None:
+                if isinstance(error, CommandTimeoutError):
+                    self.status = self.status_timed_out
+                future.result()
+            self._sequence._save_result(self, future.result(), kwargs or {})
             self.status = self.status_finished
 
-            return result
+    def _observe_measurements(self, timing):
+        """
+        Passes measurements made in a worker process, see `_execute_in_process`, to the metrics hook.
+        Commands run in threads are measured where they run.
+        """
+        metrics = self._sequence.metrics
+        for outcome, wall_time, cpu_time in timing.pop('measurements', ()):
+            if metrics is not None:
+                metrics.observe_command(self._sequence, self.name, outcome, wall_time, cpu_time)
 
+    @contextlib.contextmanager
+    def _warn_only_failures(self):
+        """
+        Logs instead of raising failures under the warn_only run option,
+        and timeouts if the on_timeout run option is ``'continue'``, in which case
+        commands which depend on the command that timed out are skipped, see `_prepare`.
+        """
+        try:
+            yield
         except Exception as e:
             if self._sequence.run_options.warn_only:
                 log.warning('[warn-only] Command "{}" failed:'.format(self.name))
                 log.exception(e)
+            elif isinstance(e, CommandTimeoutError) and self._sequence.run_options.on_timeout == 'continue':
+                log.warning('Command "{}" timed out, continuing with the next commands'.format(self.name))
             else:
                 raise
 
@@ -181,6 +739,12 @@ class SequenceBase(object):
     def __init__(self, *commands, **seq_options):
         self._order = {}
         self._commands = {}
+        self._requirements = {}
+        self._frozen = False
+
+        # Ordered index of command names, rebuilt lazily after commands are registered
+        self._names = None
+        self._positions = None
 
         for c in commands or ():
             if not isinstance(c, Command):
@@ -204,23 +768,118 @@ class SequenceBase(object):
         return self._commands[item]
 
     def __iter__(self):
-        for name in sorted(self._order, key=self._order.get):
+        for name in self.names:
             yield self._commands[name]
 
+    def _build_index(self):
+        if self._names is None:
+            self._names = tuple(sorted(self._order, key=self._order.get))
+            self._positions = {name: i for i, name in enumerate(self._names)}
+
+    @property
+    def names(self):
+        """
+        A tuple of command names in the order in which the commands run.
+        """
+        self._build_index()
+        return self._names
+
+    def freeze(self):
+        """
+        Prevents registration of further commands. Call this once all commands are declared,
+        for example at the end of the module that declares the base.
+        """
+        self._build_index()
+        self._frozen = True
+        return self
+
+    @property
+    def is_frozen(self):
+        return self._frozen
+
+    def dependencies_of(self, command_name):
+        """
+        Returns names of commands that the command directly depends on: those listed in
+        its `depends_on` option or, if the option is not set, all commands before it.
+        """
+        command = self[command_name]
+        index = self.index_of(command_name)
+        if command.options.depends_on is None:
+            return self.names[:index]
+
+        dependencies = []
+        for dependency in command.options.depends_on:
+            if isinstance(dependency, Command):
+                dependency = dependency.name
+            if dependency not in self:
+                raise ValueError('Command "{}" depends on unknown command "{}"'.format(command_name, dependency))
+            if self.index_of(dependency) >= index:
+                raise ValueError('Command "{}" must be ordered after its dependency "{}"'.format(
+                    command_name, dependency,
+                ))
+            dependencies.append(dependency)
+        return tuple(dependencies)
+
+    def requirements_of(self, command_name):
+        """
+        Returns a tuple of names of all commands that must be finished before the command can run,
+        that is, its dependencies and their requirements, in the order of commands.
+        """
+        command = self[command_name]
+        if command.options.depends_on is None:
+            # Dependencies of earlier commands are all ordered before them
+            return self.names[:self.index_of(command_name)]
+
+        if command_name not in self._requirements:
+            requirements = set()
+            to_visit = list(self.dependencies_of(command_name))
+            while to_visit:
+                dependency = to_visit.pop()
+                if dependency in requirements:
+                    continue
+                requirements.add(dependency)
+                if dependency in self._requirements:
+                    requirements.update(self._requirements[dependency])
+                else:
+                    to_visit.extend(self.dependencies_of(dependency))
+            self._requirements[command_name] = tuple(sorted(requirements, key=self.index_of))
+        return self._requirements[command_name]
+
     def __call__(self, step_registry_name=None, context=None, **run_options):
         return Sequence(state_registry_name=step_registry_name, base=self, context=context, **run_options)
 
     def index_of(self, command_name):
         assert command_name in self
-        for i, name in enumerate(sorted(self._order, key=self._order.get)):
-            if name == command_name:
-                return i
+        self._build_index()
+        return self._positions[command_name]
+
+    def commands_before(self, command_name):
+        """
+        Returns a tuple of commands that run before the command.
+        """
+        return tuple(self._commands[name] for name in self.names[:self.index_of(command_name)])
+
+    def commands_between(self, start_at=None, stop_before=None):
+        """
+        Returns a tuple of commands starting with ``start_at`` (or the first command)
+        up to, but excluding, ``stop_before`` (or up to the last command).
+        """
+        start = self.index_of(start_at) if start_at else None
+        stop = self.index_of(stop_before) if stop_before else None
+        return tuple(self._commands[name] for name in self.names[start:stop])
 
     def _register_command(self, command, order=None):
+        if self._frozen:
+            raise RuntimeError('Cannot register command "{}" in a frozen {}'.format(
+                command.name, self.__class__.__name__,
+            ))
         if command.name in self._commands:
             raise ValueError(command.name)
         self._commands[command.name] = command
         self._order[command.name] = order or len(self._order)
+        self._requirements = {}
+        self._names = None
+        self._positions = None
 
     def command(self, f=None, **options):
         def decorator(func):
@@ -234,6 +893,31 @@ class SequenceBase(object):
             return decorator
 
 
+class PersistedResults(object):
+    """
+    Read-only view of persisted command results of a sequence, see `Sequence.results`.
+    Results are loaded from the state registry when first looked up.
+    """
+
+    def __init__(self, sequence):
+        self._sequence = sequence
+
+    def get(self, name, default=None):
+        return self._sequence._lookup_result(name, default)
+
+    def __getitem__(self, name):
+        result = self._sequence._lookup_result(name, _no_result)
+        if result is _no_result:
+            raise KeyError(name)
+        return result
+
+    def __contains__(self, name):
+        return self._sequence._lookup_result(name, _no_result) is not _no_result
+
+
+_no_result = object()
+
+
 class Sequence(object):
     """
     Sequence is a concrete instance of SequenceBase.
@@ -242,29 +926,73 @@ class Sequence(object):
     """
     state_registry_cls = None
 
+    # MetricsHook to report measurements of runs to, see idemseq.metrics
+    metrics = None
+
+    # Seconds for which `run` holds a lease on the sequence in the state registry so that
+    # no other runner runs the sequence at the same time. None disables leases.
+    # Leases are renewed between commands, so this must be longer than the longest command,
+    # except in concurrent runs which renew the lease while waiting for commands.
+    lease_ttl = None
+
+    # Seconds to keep trying, backing off, to acquire a lease held by another runner
+    # before giving up with LeaseError
+    lease_timeout = 0
+
+    # Initial and maximum delay in seconds between attempts to acquire a lease
+    lease_backoff = 0.05
+    lease_max_backoff = 1.0
+
+    lease_resource = 'sequence'
+
+    # Results of commands with the persist_result option which are larger than this many bytes
+    # when encoded are not persisted. None for no limit. See idemseq.results.
+    max_result_size = 1024 * 1024
+
+    # Whether to compress persisted results with zlib
+    compress_results = False
+
+    # Initial and maximum delay in seconds between attempts of commands with the max_attempts option,
+    # unless set by the retry_backoff and retry_max_backoff options of the command
+    retry_backoff = 0.1
+    retry_max_backoff = 30.0
+
     def __init__(self, base, state_registry_name=None, context=None, **run_options):
         self._base = base
         self._uid = uuid.uuid4()
-        self._current_env = LocalProxy(functools.partial(get_current_sequence_env, self.uid))
 
-        state_registry_cls = self.state_registry_cls
-        if state_registry_cls is None:
-            from idemseq.persistence import SqliteStateRegistry
-            state_registry_cls = SqliteStateRegistry
-        self._real_state_registry = state_registry_cls(name=state_registry_name)
+        # Sequence owns its env stack, see _sequence_env_stacks
+        self._env_stack = _sequence_env_stacks[self._uid] = SequenceEnvStack()
+
+        self._real_state_registry = self.create_state_registry(state_registry_name)
         self._dry_run_state_registry_instance = None
+        self._status_snapshots = None
+        self._sequence_commands = {}
+        self._lease_depth = 0
 
-        # This is a dirty hack to ensure that we aren't building on top of another, unrelated sequence env stack
-        try:
-            assert self.run_options
-            raise Exception('Should have raised RuntimeError, the env stack is not clean')
-        except RuntimeError:
-            # Expected
-            pass
+        # Decoded results of commands with the persist_result option, by command name
+        self._results = {}
+        self._dry_run_results = {}
+
+        # Encoded results and input hashes loaded from the real state registry, by command name,
+        # and all input hashes loaded at once. Dropped at the end of every run.
+        self._stored_results = {}
+        self._input_hashes = None
 
         # Initialise this sequence's environment stack with whatever was passed at instantiation time
         self.env(context=context, **run_options).push()
 
+    @classmethod
+    def create_state_registry(cls, name=None):
+        """
+        Returns a new instance of the state registry class used by sequences of this class.
+        """
+        state_registry_cls = cls.state_registry_cls
+        if state_registry_cls is None:
+            from idemseq.persistence import SqliteStateRegistry
+            state_registry_cls = SqliteStateRegistry
+        return state_registry_cls(name=name)
+
     @property
     def uid(self):
         """
@@ -272,6 +1000,19 @@ class Sequence(object):
         """
         return self._uid
 
+    def close(self):
+        """
+        Flushes pending status updates and releases the state registry's connection.
+        The sequence can still be used afterwards.
+        """
+        self._real_state_registry.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
     def __iter__(self):
         """
         Returns an iterator over all sequence commands.
@@ -292,8 +1033,18 @@ class Sequence(object):
         This excludes commands already finished or otherwise excluded due to
         run options.
         """
+        for command in self._select_commands():
+            yield command
+
+    def _select_commands(self, on_skip=None):
+        """
+        Returns a list of commands to run, see `commands`.
+        Calls ``on_skip(command_name, reason)`` for each command that is left out.
+        """
+        on_skip = on_skip or (lambda command_name, reason: None)
         commands_to_run = []
 
+        statuses = self._get_known_statuses()
         sequence_is_finished = self.is_finished
         start_at = self.run_options.start_at
         if start_at and start_at not in self:
@@ -303,18 +1054,35 @@ class Sequence(object):
         if stop_before and stop_before not in self:
             raise ValueError('Invalid command specified for run option stop_before - "{}"'.format(stop_before))
 
+        stopped = False
+        selected_names = set()
         for command in self.all_commands:
             if start_at:
                 if command.name == start_at:
                     start_at = None
                 else:
+                    on_skip(command.name, MetricsHook.skip_start_at)
                     continue
 
             if stop_before and command.name == stop_before:
-                break
+                stopped = True
+            if stopped:
+                on_skip(command.name, MetricsHook.skip_stop_before)
+                continue
 
-            if not command.is_finished:
+            if statuses.get(command.name) != SequenceCommand.status_finished:
                 commands_to_run.append(command)
+                selected_names.add(command.name)
+                continue
+
+            if command.tracks_inputs and not (command.options.run_always or command.options.run_until_finished):
+                # Inputs of a command may also change when commands before it run again,
+                # in which case SequenceCommand._prepare checks again once they have run.
+                if command._inputs_changed() or selected_names.intersection(self._base.requirements_of(command.name)):
+                    commands_to_run.append(command)
+                    selected_names.add(command.name)
+                else:
+                    on_skip(command.name, MetricsHook.skip_already_finished)
                 continue
 
             if command.options.run_always:
@@ -322,17 +1090,18 @@ class Sequence(object):
 
             if not sequence_is_finished and command.options.run_until_finished:
                 commands_to_run.append(command)
+            elif not command.options.run_always:
+                on_skip(command.name, MetricsHook.skip_already_finished)
 
-        for command in commands_to_run:
-            yield command
+        return commands_to_run
 
     @property
     def all_commands(self):
         """
         A generator that yields all commands irrespective of `run_options` and command completion status.
         """
-        for command in self._base:
-            yield SequenceCommand(command=command, sequence=self)
+        for name in self._base.names:
+            yield self._get_sequence_command(name)
 
     @property
     def next_command(self):
@@ -340,9 +1109,10 @@ class Sequence(object):
         Returns the next command after the last finished command.
         Returns None if sequence is finished.
         """
-        for command in self.commands:
-            if not command.is_finished:
-                return command
+        with self._status_snapshot():
+            for command in self.commands:
+                if not command.is_finished:
+                    return command
         return None
 
     def __contains__(self, item):
@@ -351,7 +1121,17 @@ class Sequence(object):
     def __getitem__(self, item):
         if item not in self._base:
             raise KeyError(item)
-        return SequenceCommand(command=self._base[item], sequence=self)
+        return self._get_sequence_command(item)
+
+    def _get_sequence_command(self, name):
+        """
+        Returns the cached `SequenceCommand` of the command, creating it on first access.
+        """
+        try:
+            return self._sequence_commands[name]
+        except KeyError:
+            sequence_command = self._sequence_commands[name] = SequenceCommand(command=self._base[name], sequence=self)
+            return sequence_command
 
     def __len__(self):
         return len(self._base)
@@ -362,13 +1142,23 @@ class Sequence(object):
     def env(self, context=None, **run_options):
         return SequenceEnv(sequence_uid=self.uid, context=context, **run_options)
 
+    @property
+    def _env(self):
+        """
+        The current SequenceEnv of this thread.
+        """
+        env = self._env_stack.top
+        if env is None:
+            raise RuntimeError('Requesting current sequence environment outside of context')
+        return env
+
     @property
     def context(self):
-        return self._current_env.context
+        return self._env.context
 
     @property
     def run_options(self):
-        return self._current_env.run_options
+        return self._env.run_options
 
     def reset(self):
         log.warning('Resetting state')
@@ -378,21 +1168,17 @@ class Sequence(object):
     @property
     def _dry_run_state_registry(self):
         """
-        Lazily loaded private property because we don't want to be copying real state unless required to.
-        During a normal run which does not consult _dry_run_state_registry, this isn't initialised.
-        If it has been initialised during a normal run, its state is maintained by duplicating
-        all calls to the real state registry in `set_command_status`.
+        Lazily created overlay over the real state registry which reads statuses through
+        from the real registry and keeps only the statuses changed during dry runs.
+        Real status updates discard what dry runs assumed about the same commands,
+        see `_discard_dry_run_status`.
         """
         if self._dry_run_state_registry_instance is None:
             from idemseq.persistence import DryRunStateRegistry
-            self._dry_run_state_registry_instance = DryRunStateRegistry(name=self._real_state_registry.name)
-
-            # During initialisation, we have to copy the entire state so that in case dry_run context
-            # is entered, we return the right state.
-            for k, v in self._real_state_registry.get_known_statuses().items():
-                if k in self._base:
-                    self._dry_run_state_registry_instance.update_status(self[k], v)
-
+            self._dry_run_state_registry_instance = DryRunStateRegistry(
+                name=self._real_state_registry.name,
+                real_state_registry=self._real_state_registry,
+            )
         return self._dry_run_state_registry_instance
 
     @property
@@ -405,9 +1191,55 @@ class Sequence(object):
         else:
             return self._real_state_registry
 
+    @contextlib.contextmanager
+    def _status_snapshot(self):
+        """
+        Within this context, command statuses are read from a snapshot which is loaded
+        with a single `get_known_statuses()` call per state registry and is kept up to date
+        by `set_command_status`. Nested calls reuse the outermost snapshot.
+        On leaving the outermost context, any batched status writes are flushed.
+        If the context is left with an exception, a failure to flush is logged
+        so that it doesn't replace the original exception.
+        """
+        if self._status_snapshots is not None:
+            yield
+            return
+        self._status_snapshots = {}
+        succeeded = False
+        try:
+            yield
+            succeeded = True
+        finally:
+            self._status_snapshots = None
+            self._results.clear()
+            self._stored_results.clear()
+            self._input_hashes = None
+            if succeeded:
+                self._call_state_registry(self._real_state_registry, 'flush')
+            else:
+                try:
+                    self._call_state_registry(self._real_state_registry, 'flush')
+                except Exception:
+                    log.exception('Failed to flush state registry after an error')
+
+    def _get_known_statuses(self):
+        """
+        Returns a mapping of command names to statuses from the current state registry,
+        served from the status snapshot if one is active.
+        """
+        state_registry = self._state_registry
+        if self._status_snapshots is None:
+            return self._call_state_registry(state_registry, 'get_known_statuses')
+        if state_registry not in self._status_snapshots:
+            self._status_snapshots[state_registry] = dict(
+                self._call_state_registry(state_registry, 'get_known_statuses')
+            )
+        return self._status_snapshots[state_registry]
+
     @property
     def is_finished(self):
-        return all(command.is_finished for command in self.all_commands)
+        statuses = self._get_known_statuses()
+        return all(statuses.get(command.name) == SequenceCommand.status_finished for command in self._base)
 
     def is_all_finished_before(self, step):
         known_statuses = self._state_registry.get_known_statuses()
@@ -421,17 +1253,418 @@ class Sequence(object):
     def run(self, context=None, **run_options):
         """
         Runs the sequence of steps.
+
+        With the ``max_workers`` run option, independent commands run concurrently on a pool
+        of threads. With ``executor='process'``, commands run on a pool of processes instead,
+        ``max_workers`` of them (by default as many as there are CPUs), which suits CPU-bound commands.
+        Their functions must be importable by module and name, and their arguments and results
+        picklable. Worker processes only call functions; the state registry is only used by this process.
         """
-        with self.env(context=context, **run_options):
-            for command in self.commands:
-                command.run()
+        with measure_run(self.metrics, self), self.env(context=context, **run_options), self._lease():
+            with self._status_snapshot():
+                commands = self._select_commands(on_skip=self._observe_skip)
+                if self.run_options.max_workers or self.run_options.executor == 'process':
+                    self._run_concurrently(commands)
+                else:
+                    for command in commands:
+                        command.run()
+                        self._heartbeat()
+
+    @property
+    def lease_owner(self):
+        """
+        Identifies this sequence instance as the owner of leases.
+        """
+        import socket
+        return '{}:{}:{}'.format(socket.gethostname(), os.getpid(), self.uid)
+
+    @contextlib.contextmanager
+    def _lease(self):
+        """
+        Within this context, the sequence holds a lease on `lease_resource` in the real state registry
+        if `lease_ttl` is set. Dry runs and nested runs don't acquire leases.
+        """
+        if self.lease_ttl is None or self.run_options.dry_run or self._lease_depth:
+            self._lease_depth += 1
+            try:
+                yield
+            finally:
+                self._lease_depth -= 1
+            return
+
+        self._acquire_lease()
+        self._lease_depth += 1
+        try:
+            yield
+        finally:
+            self._lease_depth -= 1
+            self._call_state_registry(self._real_state_registry, 'release_lease', self.lease_resource, self.lease_owner)
+
+    def _acquire_lease(self):
+        retry_delays = self._lease_retry_delays(time.time() + self.lease_timeout)
+        while not self._call_state_registry(
+            self._real_state_registry, 'acquire_lease', self.lease_resource, self.lease_owner, self.lease_ttl,
+        ):
+            time.sleep(next(retry_delays))
+
+    def _lease_retry_delays(self, deadline):
+        """
+        Yields how long to wait before each next attempt to acquire the lease.
+        Raises LeaseError once ``deadline`` has passed.
+        """
+        import random
+        delay = self.lease_backoff
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise LeaseError(
+                    self.lease_resource, self.lease_owner,
+                    'Lease on {} of {} is held by another runner'.format(self.lease_resource, self),
+                )
+            log.debug('Lease on {} is held by another runner, retrying in {:.3f}s'.format(self.lease_resource, delay))
+            yield min(delay * random.uniform(0.5, 1.5), remaining)
+            delay = min(delay * 2, self.lease_max_backoff)
+
+    def _heartbeat(self):
+        if self._lease_depth and self.lease_ttl is not None and not self.run_options.dry_run:
+            self._call_state_registry(self._real_state_registry, 'heartbeat')
+
+    def _attempt_records(self, sequence_command, timing, error=None):
+        """
+        Returns a list of arguments for `StateRegistry.record_attempt`, one for every attempt timed in
+        ``timing``, the retried ones first, see `SequenceCommand._schedule_retry`. Attempts made during
+        dry runs, and those that never got to call the command, are not recorded.
+        """
+        if self.run_options.dry_run or 'started_at' not in timing:
+            return []
+        previous_status = self.get_command_status(sequence_command)
+        records = [
+            (
+                sequence_command,
+                retry['started_at'],
+                retry['finished_at'],
+                SequenceCommand.status_failed,
+                previous_status,
+                retry['error_type'],
+                retry['retry_delay'],
+            )
+            for retry in timing.get('retries', ())
+        ]
+        records.append((
+            sequence_command,
+            timing['started_at'],
+            timing['finished_at'],
+            SequenceCommand.status_failed if error is not None else SequenceCommand.status_finished,
+            previous_status,
+            type(error).__name__ if error is not None else None,
+        ))
+        return records
+
+    def _record_attempt(self, sequence_command, timing, error=None):
+        """
+        Records attempts to call the command in the real state registry's history.
+        """
+        for record in self._attempt_records(sequence_command, timing, error=error):
+            self._call_state_registry(self._real_state_registry, 'record_attempt', *record)
+
+    @property
+    def results(self):
+        """
+        A read-only mapping of command names to persisted results of commands which have
+        the persist_result option. Commands receive these as arguments named after the commands.
+        """
+        return PersistedResults(self)
+
+    def _lookup_result(self, name, default=None):
+        if self.run_options.dry_run and name in self._dry_run_results:
+            return self._dry_run_results[name]
+        if name in self._results:
+            return self._results[name]
+        if name not in self._base:
+            return default
+        sequence_command = self._get_sequence_command(name)
+        if not sequence_command.options.persist_result:
+            return default
+        stored = self._stored_result(sequence_command)
+        if stored is None or stored[0] is None:
+            return default
+        result = self._results[name] = decode_result(stored[0])
+        return result
+
+    def _stored_input_hashes(self):
+        """
+        Returns a mapping of command names to fingerprints stored in the real state registry,
+        loaded with a single call.
+        """
+        if self._input_hashes is None:
+            self._input_hashes = dict(self._call_state_registry(self._real_state_registry, 'get_input_hashes'))
+        return self._input_hashes
+
+    def _fingerprint(self, sequence_command, kwargs):
+        """
+        Returns the fingerprint of the command called with ``kwargs``, see `SequenceCommand.tracks_inputs`.
+        """
+        if not sequence_command.options.fingerprint:
+            return hash_inputs(kwargs)
+        return hash_inputs({
+            'code': sequence_command.command.code_fingerprint,
+            'version': sequence_command.options.version,
+            'kwargs': kwargs,
+        })
+
+    def _stored_result(self, sequence_command):
+        """
+        Returns the encoded result and input hash of the command stored in the real state registry, or None.
+        """
+        if sequence_command.name not in self._stored_results:
+            self._stored_results[sequence_command.name] = self._call_state_registry(
+                self._real_state_registry, 'load_result', sequence_command,
+            )
+        return self._stored_results[sequence_command.name]
+
+    def _result_record(self, sequence_command, result, kwargs):
+        """
+        Returns arguments for `StateRegistry.save_result`, or None if there is nothing to save:
+        for commands which neither persist results nor track inputs, and in dry runs,
+        in which results are only kept in memory for the commands that follow.
+        """
+        options = sequence_command.options
+        if not (options.persist_result or sequence_command.tracks_inputs):
+            return None
+
+        name = sequence_command.name
+        if self.run_options.dry_run:
+            if options.persist_result:
+                self._dry_run_results[name] = result
+            return None
+
+        data = None
+        if options.persist_result:
+            result_format = 'pickle' if options.persist_result is True else options.persist_result
+            data = encode_result(result, format=result_format, compress=self.compress_results)
+            if self.max_result_size is not None and len(data) > self.max_result_size:
+                log.warning('Result of command "{}" is {} bytes, more than max_result_size, not persisting it'.format(
+                    name, len(data),
+                ))
+                data = None
+                self._results.pop(name, None)
+            else:
+                self._results[name] = result
+
+        input_hash = self._fingerprint(sequence_command, kwargs) if sequence_command.tracks_inputs else None
+        self._stored_results[name] = data, input_hash
+        if self._input_hashes is not None:
+            self._input_hashes[name] = input_hash
+        return sequence_command, data, input_hash
+
+    def _save_result(self, sequence_command, result, kwargs):
+        """
+        Persists the result of the command and the hash of its inputs, as required by the command's options.
+        """
+        record = self._result_record(sequence_command, result, kwargs)
+        if record is not None:
+            self._call_state_registry(self._real_state_registry, 'save_result', *record)
+
+    def _attempt_statistics(self):
+        """
+        Returns a tuple of mappings of command names to the number of attempts, the number
+        of failed attempts, and a list of durations of successful attempts.
+        """
+        attempts = collections.defaultdict(int)
+        failures = collections.defaultdict(int)
+        durations = collections.defaultdict(list)
+        for attempt in self._call_state_registry(self._real_state_registry, 'get_history'):
+            attempts[attempt['name']] += 1
+            if attempt['status'] == SequenceCommand.status_finished:
+                durations[attempt['name']].append(attempt['duration'])
+            else:
+                failures[attempt['name']] += 1
+        return attempts, failures, durations
+
+    def history(self):
+        """
+        Returns statistics of past attempts recorded by the state registry, one dictionary per command
+        in the order of commands, with keys ``name``, ``attempts``, ``failures`` and ``p50``, ``p95``
+        (durations in seconds of successful attempts, None if there are none).
+        """
+        attempts, failures, durations = self._attempt_statistics()
+        return [
+            {
+                'name': command.name,
+                'attempts': attempts[command.name],
+                'failures': failures[command.name],
+                'p50': _percentile(durations[command.name], 50),
+                'p95': _percentile(durations[command.name], 95),
+            }
+            for command in self._base
+        ]
+
+    def estimate_remaining_time(self, percentile=50):
+        """
+        Estimates the time in seconds that running `commands`, starting with `next_command`,
+        would take based on the given percentile of past durations. Commands without
+        successful attempts in history are not accounted for.
+        """
+        _, _, durations = self._attempt_statistics()
+        return sum(_percentile(durations[command.name], percentile) or 0.0 for command in self.commands)
+
+    def _observe_skip(self, command_name, reason):
+        if self.metrics is not None:
+            self.metrics.observe_skip(self, command_name, reason)
+
+    def _call_state_registry(self, state_registry, operation, *args):
+        """
+        Calls the state registry method, measuring the time spent in the real state registry
+        if metrics are collected.
+        """
+        if self.metrics is None or state_registry is not self._real_state_registry:
+            return getattr(state_registry, operation)(*args)
+        started = time.time()
+        try:
+            return getattr(state_registry, operation)(*args)
+        finally:
+            self.metrics.observe_registry(self, operation, time.time() - started)
+
+    def _run_concurrently(self, commands):
+        """
+        Runs commands on a pool of `run_options.max_workers` threads, or processes, see `run`,
+        starting each command as soon as the commands it depends on are done. Commands are prepared
+        and their statuses recorded in the calling thread; workers only call command functions.
+
+        On failure (unless warn_only is set) no further commands are started, the commands
+        already running are waited for, and the first exception is raised.
+
+        Commands which time out are cancelled and no longer waited for, see `idemseq.cancellation`.
+        Timeouts count from when a worker starts running the command. In processes, commands
+        with a timeout run in a process of their own, which is terminated if they time out.
+        At most ``max_workers`` commands run at a time either way, see `_ProcessPool`.
+        """
+        pending = list(commands)
+        unfinished_names = set(c.name for c in commands)
+        running = {}
+        error = None
+        timed_out = False
+
+        # Keep renewing the lease while commands run
+        heartbeat_interval = self.lease_ttl / 3.0 if self.lease_ttl is not None else None
+
+        if self.run_options.executor == 'process':
+            executor = _ProcessPool(max_workers=self.run_options.max_workers)
+        else:
+            executor = futures.ThreadPoolExecutor(max_workers=self.run_options.max_workers)
+        try:
+            while pending or running:
+                ready = []
+                if error is None:
+                    ready = [
+                        c for c in pending
+                        if not unfinished_names.intersection(self._base.dependencies_of(c.name))
+                    ]
+                for command in ready:
+                    pending.remove(command)
+                    try:
+                        submitted = command._submit(executor)
+                    except Exception as e:
+                        error = e
+                        break
+                    if submitted is None:
+                        unfinished_names.discard(command.name)
+                    else:
+                        future, timing, kwargs, cancellation = submitted
+                        running[future] = command, timing, kwargs, cancellation, command.timeout
+
+                if running:
+                    done, _ = futures.wait(
+                        running, timeout=self._next_wait_timeout(running, heartbeat_interval),
+                        return_when=futures.FIRST_COMPLETED,
+                    )
+                    self._heartbeat()
+                    completed = [(future, future) for future in done]
+                    for future, (command, timing, kwargs, cancellation, timeout) in list(running.items()):
+                        if future not in done and self._deadline(timing, timeout) <= time.time():
+                            timed_out = True
+                            future.cancel()
+                            timed_out_timing = {}
+                            timed_out_future = futures.Future()
+                            timed_out_future.set_exception(command._cancel(cancellation, timing, timed_out_timing))
+                            running[future] = command, timed_out_timing, kwargs, cancellation, timeout
+                            completed.append((future, timed_out_future))
+                    for future, outcome in completed:
+                        command, timing, kwargs, _, _ = running.pop(future)
+                        try:
+                            command._complete(outcome, timing, kwargs)
+                        except Exception as e:
+                            error = error or e
+                        unfinished_names.discard(command.name)
+                elif not ready:
+                    break
+        finally:
+            # Don't wait for worker threads of commands which timed out, they may never finish
+            executor.shutdown(wait=not timed_out)
+
+        if error is not None:
+            raise error
+
+    @staticmethod
+    def _deadline(timing, timeout):
+        """
+        Returns the time by which a command submitted to a worker thread must finish.
+        Until a worker starts running the command, the deadline is at least ``timeout`` from now.
+        """
+        if timeout is None:
+            return float('inf')
+        return timing.get('running_since', time.time()) + timeout
+
+    def _next_wait_timeout(self, running, heartbeat_interval):
+        """
+        Returns seconds to wait for running commands before checking their deadlines again
+        and renewing the lease, or None to wait until one of them finishes.
+        """
+        deadline = min(self._deadline(timing, timeout) for _, timing, _, _, timeout in running.values())
+        timeouts = [t for t in (heartbeat_interval, deadline - time.time()) if t != float('inf') and t is not None]
+        return max(min(timeouts), 0) if timeouts else None
+
+    def run_async(self, context=None, **run_options):
+        """
+        Returns a coroutine which runs the sequence of steps on the current event loop.
+        Coroutine commands are awaited, other commands are run in the loop's default executor.
+        With the ``max_workers`` run option, independent commands run concurrently as tasks.
+        ``executor='process'`` is not supported. Requires Python 3.5+.
+        """
+        from idemseq.aio import run_sequence
+        return run_sequence(self, context=context, **run_options)
+
+    def _state_registries_to_update(self):
+        """
+        Returns state registries to which a status update must be written in the current environment.
+        """
+        if self.run_options.dry_run:
+            return [self._dry_run_state_registry]
+        return [self._real_state_registry]
+
+    def _update_status_snapshots(self, state_registry, command_name, status):
+        if self._status_snapshots is not None and state_registry in self._status_snapshots:
+            self._status_snapshots[state_registry][command_name] = status
+
+    def _discard_dry_run_status(self, sequence_command, status):
+        """
+        Called after a real status update so that dry runs see the real status of the command.
+        """
+        dry_run_state_registry = self._dry_run_state_registry_instance
+        if dry_run_state_registry is None or self.run_options.dry_run:
+            return
+        dry_run_state_registry.discard_status(sequence_command)
+        self._update_status_snapshots(dry_run_state_registry, sequence_command.name, status)
 
     def set_command_status(self, sequence_command, status):
         assert sequence_command._sequence is self
-        if not self.run_options.dry_run:
-            self._real_state_registry.update_status(sequence_command, status)
-        self._dry_run_state_registry.update_status(sequence_command, status)
+        for state_registry in self._state_registries_to_update():
+            self._call_state_registry(state_registry, 'update_status', sequence_command, status)
+            self._update_status_snapshots(state_registry, sequence_command.name, status)
+        self._discard_dry_run_status(sequence_command, status)
 
     def get_command_status(self, sequence_command):
         assert sequence_command._sequence is self
-        return self._state_registry.get_status(sequence_command)
+        if self._status_snapshots is not None:
+            return self._get_known_statuses().get(sequence_command.name, SequenceCommand.status_unknown)
+        return self._call_state_registry(self._state_registry, 'get_status', sequence_command)
@@ -23,7 +23,7 @@ setup(
     description='Organise a set of units of code in a sequence that can be rerun repeatedly skipping already completed units',
     long_description=read('README.rst'),
     packages=['idemseq', 'idemseq.examples'],
-    install_requires=['funcsigs>=1.0.2', 'Werkzeug>=0.12', 'click>=6.0'],
+    install_requires=['funcsigs>=1.0.2', 'click>=6.0', 'futures>=3.0; python_version < "3"'],
     classifiers=[
         'Development Status :: 3 - Alpha',
         'Intended Audience :: Developers',
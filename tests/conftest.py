@@ -1,4 +1,5 @@
 import logging
+import sys
 
 import pytest
 
@@ -8,6 +9,9 @@ from idemseq.sequence import SequenceBase
 
 configure_logging(log_level=logging.DEBUG)
 
+if sys.version_info < (3, 7):
+    collect_ignore = ['test_sequence_async.py']
+
 
 @pytest.fixture
 def hello_world_command():
@@ -40,3 +44,36 @@ def three_appenders_sequence_base():
         base.outputs.append(3)
 
     return base
+
+
+@pytest.fixture
+def flaky_base():
+    """
+    A sequence base whose middle command fails on its first call.
+    """
+    base = SequenceBase()
+    base.failures_left = 1
+
+    @base.command
+    def first():
+        pass
+
+    @base.command
+    def flaky():
+        if base.failures_left:
+            base.failures_left -= 1
+            raise RuntimeError('flaky')
+
+    @base.command
+    def last():
+        pass
+
+    return base
+
+
+@pytest.fixture
+def db(tmpdir):
+    """
+    Path of an SQLite database file for state registries.
+    """
+    return str(tmpdir.join('state.db'))
@@ -0,0 +1,55 @@
+import os
+import subprocess
+import sys
+import time
+
+import click
+
+from idemseq.cli import cli
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+list_args = ['-m', 'idemseq.cli', 'idemseq.examples.example01:example', 'list']
+
+# Seconds that `list` may take on top of importing click, which any click CLI pays for
+startup_budget = 0.5
+
+
+def run_python(*args):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(p for p in (root, env.get('PYTHONPATH')) if p)
+    started = time.time()
+    output = subprocess.check_output((sys.executable,) + args, env=env, stderr=subprocess.STDOUT)
+    return output.decode('utf-8'), time.time() - started
+
+
+def test_controllers_are_built_once_per_base():
+    ctx = click.Context(cli)
+    controller = cli.get_command(ctx, 'idemseq.examples.example01:example')
+    assert cli.get_command(ctx, 'idemseq.examples.example01:example') is controller
+
+
+def test_list_imports_only_what_it_needs():
+    output, _ = run_python('-c', '\n'.join([
+        'import sys',
+        'from idemseq.cli import cli',
+        'print(sorted(m for m in sys.modules if m.startswith("idemseq.")))',
+        'try:',
+        '    cli(["idemseq.examples.example01:example", "list"])',
+        'except SystemExit:',
+        '    pass',
+        'print(sorted(m for m in ("logging.config", "pickle", "random", "socket", "zlib") if m in sys.modules))',
+    ]))
+    lines = output.splitlines()
+    assert lines[0] == "['idemseq.cli']"
+    assert ' * greeting (unknown)' in lines
+    assert lines[-1] == '[]'
+
+
+def test_list_starts_up_within_budget():
+    output, _ = run_python(*list_args)
+    assert ' * step_one (unknown)' in output.splitlines()
+
+    list_time = min(run_python(*list_args)[1] for _ in range(3))
+    click_time = min(run_python('-c', 'import click')[1] for _ in range(3))
+    assert list_time - click_time < startup_budget
@@ -1,3 +1,5 @@
+import pytest
+
 from idemseq.command import Command
 
 
@@ -76,3 +78,12 @@ def test_func_doc_is_command_description_for_decorator_declared_commands():
     sequence = base()
 
     assert sequence['c3'].description == 'This does not do much'
+
+
+def test_unsupported_result_format_is_rejected_when_command_is_declared():
+    assert Command(lambda: 1, persist_result='json').options.persist_result == 'json'
+    assert Command(lambda: 1, persist_result=True).options.persist_result is True
+
+    with pytest.raises(ValueError) as excinfo:
+        Command(lambda: 1, persist_result='yaml')
+    assert 'yaml' in str(excinfo.value)
@@ -0,0 +1,109 @@
+import threading
+
+from idemseq.command import Command
+from idemseq.persistence import ConnectionPool, SqliteStateRegistry
+from idemseq.sequence import Sequence, SequenceCommand
+
+
+def pooled_registry_cls(pool):
+    class PooledSqliteStateRegistry(SqliteStateRegistry):
+        connection_pool = pool
+
+    return PooledSqliteStateRegistry
+
+
+def test_registries_reuse_released_connections(tmpdir):
+    pool = ConnectionPool()
+    registry_cls = pooled_registry_cls(pool)
+    db = str(tmpdir.join('pooled.db'))
+    step = SequenceCommand(command=Command(lambda: 1, name='first'))
+
+    connects = []
+
+    class CountingRegistry(registry_cls):
+        def _connect(self):
+            connects.append(1)
+            return super(CountingRegistry, self)._connect()
+
+    for _ in range(10):
+        reg = CountingRegistry(db)
+        reg.update_status(step, SequenceCommand.status_finished)
+        reg.close()
+
+    assert len(connects) == 1
+    assert len(pool) == 1
+
+    pool.clear()
+    assert len(pool) == 0
+
+
+def test_pool_is_bounded_and_evicts_idle_connections(tmpdir):
+    pool = ConnectionPool(max_size=2, idle_timeout=60)
+    registry_cls = pooled_registry_cls(pool)
+
+    registries = [registry_cls(str(tmpdir.join('db{}.db'.format(i)))) for i in range(5)]
+    for reg in registries:
+        assert reg.get_known_statuses() == {}
+    for reg in registries:
+        reg.close()
+
+    assert len(pool) == 2
+
+    # Expired connections are evicted whenever the pool is used
+    pool.idle_timeout = 0
+    reg = registry_cls(str(tmpdir.join('other.db')))
+    assert reg.get_known_statuses() == {}
+    reg.close()
+    assert len(pool) <= 1
+
+
+def test_pool_is_not_used_for_in_memory_databases():
+    pool = ConnectionPool()
+    reg = pooled_registry_cls(pool)()
+    assert reg.get_known_statuses() == {}
+    reg.close()
+    assert len(pool) == 0
+
+
+def test_pooled_connections_can_be_shared_between_threads(tmpdir):
+    pool = ConnectionPool()
+    registry_cls = pooled_registry_cls(pool)
+    db = str(tmpdir.join('threads.db'))
+    errors = []
+
+    def worker(i):
+        try:
+            for j in range(20):
+                reg = registry_cls(db)
+                reg.update_status(
+                    SequenceCommand(command=Command(lambda: 1, name='step-{}-{}'.format(i, j))),
+                    SequenceCommand.status_finished,
+                )
+                reg.close()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert not errors
+    assert len(registry_cls(db).get_known_statuses()) == 80
+    assert len(pool) <= 4
+
+
+def test_sequence_is_a_context_manager_that_releases_its_connection(tmpdir, three_appenders_sequence_base):
+    pool = ConnectionPool()
+
+    class PooledSequence(Sequence):
+        state_registry_cls = pooled_registry_cls(pool)
+
+    db = str(tmpdir.join('sequence.db'))
+    with PooledSequence(base=three_appenders_sequence_base, state_registry_name=db) as sequence:
+        sequence.run()
+        assert len(pool) == 0
+
+    assert len(pool) == 1
+    assert sequence.is_finished
@@ -179,3 +179,13 @@ def test_dummy_cli_marks_step(unique_cli_env, cli_runner, dummy_cli):
     assert list_result.exit_code == 0
     assert '* hello (finished)' in list_result.output
     assert '* bye (failed)' in list_result.output
+
+
+def test_dummy_cli_run_with_lease(unique_cli_env, cli_runner, dummy_cli):
+    run_result = cli_runner.invoke(dummy_cli, ['run', 'hello', '--lease-ttl', '60'])
+    assert run_result.exit_code == 0
+    assert 'Hello!' in run_result.output
+
+    run_result = cli_runner.invoke(dummy_cli, ['run', '--lease-ttl', '60'])
+    assert run_result.exit_code == 0
+    assert 'Bye!' in run_result.output
@@ -0,0 +1,99 @@
+import pytest
+from click.testing import CliRunner
+
+from idemseq.controller import create_controller_cli
+from idemseq.fleet import FleetRunner
+from idemseq.persistence import SharedSqliteStateRegistry
+from idemseq.sequence import Sequence, SequenceBase
+
+
+@pytest.fixture
+def greeter_base():
+    base = SequenceBase()
+    base.outputs = []
+
+    @base.command
+    def greet(name):
+        if name == 'nobody':
+            raise ValueError(name)
+        base.outputs.append(name)
+
+    @base.command
+    def done():
+        pass
+
+    return base
+
+
+def test_fleet_runs_sequences_with_contexts(tmpdir, greeter_base):
+    items = [(str(tmpdir.join(name)), dict(name=name)) for name in ('alice', 'bob', 'nobody')]
+
+    outcomes = {o.sequence_id: o for o in FleetRunner(greeter_base, max_workers=2).run(items)}
+
+    assert sorted(greeter_base.outputs) == ['alice', 'bob']
+    assert outcomes[str(tmpdir.join('alice'))].status == FleetRunner.outcome_finished
+    assert outcomes[str(tmpdir.join('nobody'))].status == FleetRunner.outcome_failed
+    assert isinstance(outcomes[str(tmpdir.join('nobody'))].error, ValueError)
+
+    # Finished sequences are skipped
+    outcomes = {o.sequence_id: o.status for o in FleetRunner(greeter_base, max_workers=2).run(items)}
+    assert outcomes[str(tmpdir.join('alice'))] == FleetRunner.outcome_skipped
+    assert outcomes[str(tmpdir.join('nobody'))] == FleetRunner.outcome_failed
+    assert sorted(greeter_base.outputs) == ['alice', 'bob']
+
+
+def test_fleet_finds_finished_sequences_with_bulk_query(tmpdir, greeter_base):
+    class FleetStateRegistry(SharedSqliteStateRegistry):
+        database = str(tmpdir.join('fleet.db'))
+
+    class FleetSequence(Sequence):
+        state_registry_cls = FleetStateRegistry
+
+    queries = []
+
+    class CountingFleetRunner(FleetRunner):
+        def _find_finished(self, sequence_ids):
+            queries.append(len(sequence_ids))
+            return super(CountingFleetRunner, self)._find_finished(sequence_ids)
+
+    items = [('job{}'.format(i), dict(name='name{}'.format(i))) for i in range(30)]
+    runner = CountingFleetRunner(greeter_base, sequence_cls=FleetSequence, max_workers=4, chunk_size=20)
+
+    outcomes = list(runner.run(items))
+    assert len(outcomes) == 30
+    assert set(o.status for o in outcomes) == {FleetRunner.outcome_finished}
+    assert queries == [20, 10]
+
+    FleetSequence(base=greeter_base, state_registry_name='job3').reset()
+
+    outcomes = {o.sequence_id: o.status for o in runner.run(items)}
+    assert outcomes['job3'] == FleetRunner.outcome_finished
+    assert list(outcomes.values()).count(FleetRunner.outcome_skipped) == 29
+    assert len(greeter_base.outputs) == 31
+
+
+def test_fleet_runs_sequences_in_processes(tmpdir):
+    ids = [str(tmpdir.join('seq{}'.format(i))) for i in range(3)]
+    runner = FleetRunner('idemseq.examples.example02:example', max_workers=2, executor=FleetRunner.executor_process)
+
+    assert sorted(o.status for o in runner.run(ids)) == [FleetRunner.outcome_finished] * 3
+    assert sorted(o.status for o in runner.run(ids)) == [FleetRunner.outcome_skipped] * 3
+
+    with pytest.raises(ValueError):
+        FleetRunner(SequenceBase(), executor=FleetRunner.executor_process)
+
+
+def test_fleet_cli(tmpdir, greeter_base):
+    cli = create_controller_cli(greeter_base)
+    lines = [
+        '{{"sequence_id": "{}", "context": {{"name": "alice"}}}}'.format(tmpdir.join('alice')),
+        '{{"sequence_id": "{}", "context": {{"name": "nobody"}}}}'.format(tmpdir.join('nobody')),
+    ]
+
+    result = CliRunner().invoke(cli, ['fleet', '--max-workers', '2'], input='\n'.join(lines))
+    assert result.exit_code == 1
+    assert '{} finished'.format(tmpdir.join('alice')) in result.output
+    assert '{} failed'.format(tmpdir.join('nobody')) in result.output
+
+    result = CliRunner().invoke(cli, ['fleet', '--processes'], input=str(tmpdir.join('alice')))
+    assert result.exit_code != 0
@@ -0,0 +1,88 @@
+import pytest
+from click.testing import CliRunner
+
+from idemseq.controller import create_controller_cli
+from idemseq.persistence import SqliteStateRegistry, SharedSqliteStateRegistry
+from idemseq.sequence import Sequence, SequenceCommand
+
+
+class HistorySqliteStateRegistry(SqliteStateRegistry):
+    keep_history = True
+
+
+class HistorySequence(Sequence):
+    state_registry_cls = HistorySqliteStateRegistry
+
+
+def test_records_attempts(tmpdir, flaky_base):
+    db = str(tmpdir.join('history.db'))
+    sequence = HistorySequence(base=flaky_base, state_registry_name=db)
+
+    with pytest.raises(RuntimeError):
+        sequence.run()
+    sequence.run()
+    sequence.run(dry_run=True)
+
+    history = HistorySqliteStateRegistry(db).get_history()
+    assert [(a['name'], a['previous_status'], a['status'], a['error_type']) for a in history] == [
+        ('first', 'unknown', 'finished', None),
+        ('flaky', 'unknown', 'failed', 'RuntimeError'),
+        ('flaky', 'unknown', 'finished', None),
+        ('last', 'unknown', 'finished', None),
+    ]
+    assert all(a['duration'] == a['finished_at'] - a['started_at'] for a in history)
+    assert len(HistorySqliteStateRegistry(db).get_history('flaky')) == 2
+
+
+def test_history_statistics_and_remaining_time(flaky_base):
+    flaky_base.failures_left = 0
+    sequence = HistorySequence(base=flaky_base)
+    registry = sequence._real_state_registry
+
+    for name, durations in (('first', [1.0, 2.0, 3.0, 10.0]), ('flaky', [5.0]), ('last', [])):
+        for duration in durations:
+            registry.record_attempt(
+                sequence[name], 100.0, 100.0 + duration, SequenceCommand.status_finished,
+            )
+    registry.record_attempt(sequence['last'], 100.0, 101.0, SequenceCommand.status_failed, error_type='ValueError')
+
+    assert sequence.history() == [
+        {'name': 'first', 'attempts': 4, 'failures': 0, 'p50': 2.0, 'p95': 10.0},
+        {'name': 'flaky', 'attempts': 1, 'failures': 0, 'p50': 5.0, 'p95': 5.0},
+        {'name': 'last', 'attempts': 1, 'failures': 1, 'p50': None, 'p95': None},
+    ]
+
+    assert sequence.estimate_remaining_time() == 7.0
+    assert sequence.estimate_remaining_time(95) == 15.0
+
+    sequence['first'].status = SequenceCommand.status_finished
+    assert sequence.estimate_remaining_time() == 5.0
+
+
+def test_history_is_off_by_default_and_separate_per_shared_sequence(tmpdir, flaky_base):
+    flaky_base.failures_left = 0
+    sequence = flaky_base()
+    sequence.run()
+    assert sequence.history()[0]['attempts'] == 0
+
+    db = str(tmpdir.join('shared.db'))
+    a = SharedSqliteStateRegistry('a', database=db, keep_history=True)
+    b = SharedSqliteStateRegistry('b', database=db, keep_history=True)
+    a.record_attempt(sequence['first'], 1.0, 2.0, SequenceCommand.status_finished)
+    assert len(a.get_history()) == 1
+    assert b.get_history() == []
+
+
+def test_stats_cli(tmpdir, flaky_base, monkeypatch):
+    flaky_base.failures_left = 0
+    monkeypatch.setenv('IDEMSEQ_SEQUENCE_ID', str(tmpdir.join('cli.db')))
+    cli = create_controller_cli(flaky_base)
+    runner = CliRunner()
+
+    assert runner.invoke(cli, ['--keep-history', 'run', '--stop-before', 'last']).exit_code == 0
+
+    result = runner.invoke(cli, ['stats'])
+    assert result.exit_code == 0
+    assert ' * first (attempts=1, failures=0' in result.output
+    assert ' * last (attempts=0, failures=0, p50=-, p95=-)' in result.output
+    assert 'Estimated remaining time from last' in result.output
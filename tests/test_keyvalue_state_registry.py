@@ -0,0 +1,221 @@
+import threading
+
+import pytest
+
+from idemseq.command import Command
+from idemseq.exceptions import StatusConflictError
+from idemseq.keyvalue import InMemoryKeyValueClient, KeyValueStateRegistry, WatchError
+from idemseq.sequence import Sequence, SequenceBase, SequenceCommand
+
+
+@pytest.fixture
+def client():
+    return InMemoryKeyValueClient()
+
+
+@pytest.fixture
+def first():
+    return SequenceCommand(command=Command(lambda: 1, name='first'))
+
+
+@pytest.fixture
+def second():
+    return SequenceCommand(command=Command(lambda: 2, name='second'))
+
+
+def test_key_value_state_registry_basics(client, first, second):
+    with pytest.raises(ValueError):
+        KeyValueStateRegistry('a')
+
+    reg_a = KeyValueStateRegistry('a', client=client)
+    reg_b = KeyValueStateRegistry('b', client=client)
+
+    assert reg_a.get_known_statuses() == {}
+    assert reg_a.get_status(first) == SequenceCommand.status_unknown
+
+    reg_a.update_status(first, SequenceCommand.status_finished)
+    reg_b.update_status(first, SequenceCommand.status_failed)
+    reg_b.update_status(second, SequenceCommand.status_finished)
+
+    assert reg_a.get_known_statuses() == {'first': 'finished'}
+    assert reg_b.get_known_statuses() == {'first': 'failed', 'second': 'finished'}
+    assert reg_a.get_status(second) == SequenceCommand.status_unknown
+
+    with pytest.raises(ValueError):
+        reg_a.update_status(first, 'some_invalid_status')
+
+    assert reg_a.get_known_statuses_by_sequence() == {
+        'a': {'first': 'finished'},
+        'b': {'first': 'failed', 'second': 'finished'},
+    }
+    assert reg_a.get_known_statuses_by_sequence(['b', 'c']) == {'b': {'first': 'failed', 'second': 'finished'}}
+
+
+def test_sequence_with_key_value_state_registry_uses_few_round_trips(client):
+    class KeyValueSequence(Sequence):
+        class state_registry_cls(KeyValueStateRegistry):
+            batch_writes = True
+            keep_history = True
+
+    KeyValueSequence.state_registry_cls.client = client
+
+    base = SequenceBase(*[Command(lambda: None, name='command_{}'.format(i)) for i in range(20)])
+    sequence = KeyValueSequence(base=base, state_registry_name='seq')
+
+    sequence.run()
+
+    # One HGETALL for the run, one transaction (WATCH, HMGET, EXEC) for all writes
+    assert client.round_trips == 4
+    assert sequence.is_finished
+    assert len(sequence.history()) == 20
+
+    # Listing all sequences, then one pipeline for all of them
+    client.round_trips = 0
+    assert list(sequence._real_state_registry.get_known_statuses_by_sequence()) == ['seq']
+    assert client.round_trips == 2
+
+
+def test_key_value_state_registry_persists_results_with_statuses(client):
+    class KeyValueSequence(Sequence):
+        class state_registry_cls(KeyValueStateRegistry):
+            batch_writes = True
+
+    KeyValueSequence.state_registry_cls.client = client
+
+    base = SequenceBase()
+    base.calls = []
+
+    @base.command(persist_result='json')
+    def fetch():
+        base.calls.append('fetch')
+        return {'items': [1, 2]}
+
+    @base.command(invalidate_on_change=True)
+    def parse(fetch, limit=None):
+        base.calls.append(('parse', fetch['items']))
+
+    KeyValueSequence(base=base, state_registry_name='seq').run()
+
+    # One HGETALL for the run, one transaction for statuses and results
+    assert client.round_trips == 4
+    assert base.calls == ['fetch', ('parse', [1, 2])]
+
+    registry = KeyValueStateRegistry('seq', client=client)
+    assert registry.get_known_statuses() == {'fetch': 'finished', 'parse': 'finished'}
+    assert sorted(registry.get_input_hashes()) == ['parse']
+
+    # A new sequence receives the persisted result and only runs what changed
+    sequence = KeyValueSequence(base=base, state_registry_name='seq', context={'limit': 1})
+    sequence.run()
+    assert base.calls == ['fetch', ('parse', [1, 2]), ('parse', [1, 2])]
+    assert sequence.results['fetch'] == {'items': [1, 2]}
+
+
+def test_compare_and_set_detects_concurrent_updates(client, first, second):
+    reg_a = KeyValueStateRegistry('s', client=client)
+    reg_b = KeyValueStateRegistry('s', client=client)
+
+    assert reg_a.get_known_statuses() == {}
+    assert reg_b.get_status(first) == SequenceCommand.status_unknown
+
+    reg_a.update_status(first, SequenceCommand.status_finished)
+
+    # reg_b saw first as unknown but it has been finished meanwhile
+    with pytest.raises(StatusConflictError) as exc_info:
+        reg_b.update_status(first, SequenceCommand.status_failed)
+    assert exc_info.value.expected_status == SequenceCommand.status_unknown
+    assert exc_info.value.actual_status == SequenceCommand.status_finished
+    assert reg_b.get_known_statuses() == {'first': 'finished'}
+
+    # Now that reg_b has seen the actual status, it can update it
+    reg_b.update_status(first, SequenceCommand.status_failed)
+    assert reg_a.get_status(first) == SequenceCommand.status_failed
+
+    # Updates of other commands don't conflict
+    reg_a.update_status(second, SequenceCommand.status_finished)
+    reg_b.update_status(first, SequenceCommand.status_unknown)
+
+    # Without compare-and-set, writes are blind
+    reg_c = KeyValueStateRegistry('s', client=client, compare_and_set=False)
+    reg_c.get_known_statuses()
+    assert reg_a.get_status(first) == SequenceCommand.status_unknown
+    reg_a.update_status(first, SequenceCommand.status_finished)
+    reg_c.update_status(first, SequenceCommand.status_failed)
+    assert reg_a.get_status(first) == SequenceCommand.status_failed
+
+
+def test_transition_status(client, first):
+    registry = KeyValueStateRegistry('s', client=client)
+    assert registry.transition_status(first, SequenceCommand.status_unknown, SequenceCommand.status_failed) is True
+    assert registry.transition_status(first, SequenceCommand.status_unknown, SequenceCommand.status_finished) is False
+    assert registry.transition_status(first, SequenceCommand.status_failed, SequenceCommand.status_finished) is True
+    assert registry.get_status(first) == SequenceCommand.status_finished
+
+
+def test_only_one_of_concurrent_transitions_wins(client, first):
+    outcomes = []
+    start = threading.Event()
+
+    def transition():
+        registry = KeyValueStateRegistry('s', client=client)
+        start.wait()
+        outcomes.append(
+            registry.transition_status(first, SequenceCommand.status_unknown, SequenceCommand.status_finished)
+        )
+
+    threads = [threading.Thread(target=transition) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    start.set()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(outcomes) == [False] * 7 + [True]
+
+
+def test_in_memory_pipeline_watch(client):
+    pipeline = client.pipeline()
+    pipeline.watch('k')
+    assert pipeline.hget('k', 'f') is None
+    pipeline.multi()
+    pipeline.hset('k', 'f', 'v')
+
+    client.hset('k', 'f', 'other')
+    with pytest.raises(WatchError):
+        pipeline.execute()
+    assert client.hget('k', 'f') == 'other'
+
+    with client.pipeline() as pipeline:
+        pipeline.hset('k', mapping={'f': 'v', 'g': 'w'})
+        pipeline.hgetall('k')
+        assert pipeline.execute() == [1, {'f': 'v', 'g': 'w'}]
+
+
+def test_sequences_sharing_state_detect_each_others_progress(client):
+    base = SequenceBase()
+    runs = []
+
+    @base.command
+    def first():
+        runs.append(1)
+        if len(runs) == 1:
+            # Meanwhile, another host runs the same sequence to completion
+            other.run()
+
+    class SharedStateRegistry(KeyValueStateRegistry):
+        pass
+
+    SharedStateRegistry.client = client
+
+    class SharedSequence(Sequence):
+        state_registry_cls = SharedStateRegistry
+
+    sequence = SharedSequence(base=base, state_registry_name='shared')
+    other = SharedSequence(base=base, state_registry_name='shared')
+
+    with pytest.raises(StatusConflictError):
+        sequence.run()
+
+    assert len(runs) == 2
+    assert other.is_finished
+    assert sequence.is_finished
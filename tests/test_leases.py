@@ -0,0 +1,126 @@
+import sqlite3
+import time
+
+import pytest
+
+from idemseq.command import Command
+from idemseq.exceptions import LeaseError
+from idemseq.persistence import SharedSqliteStateRegistry, SqliteStateRegistry
+from idemseq.sequence import Sequence, SequenceBase, SequenceCommand
+
+
+@pytest.fixture
+def first():
+    return SequenceCommand(command=Command(lambda: 1, name='first'))
+
+
+@pytest.mark.parametrize('registry_factory', [
+    lambda db: SqliteStateRegistry(db),
+    lambda db: SharedSqliteStateRegistry('seq', database=db),
+])
+def test_only_one_owner_holds_a_lease(db, registry_factory):
+    reg_a = registry_factory(db)
+    reg_b = registry_factory(db)
+
+    assert reg_a.acquire_lease('sequence', 'a', ttl=60) is True
+    assert reg_a.acquire_lease('sequence', 'a', ttl=60) is True
+    assert reg_b.acquire_lease('sequence', 'b', ttl=60) is False
+
+    # Other resources are independent
+    assert reg_b.acquire_lease('command:first', 'b', ttl=60) is True
+
+    reg_a.release_lease('sequence', 'a')
+    assert reg_b.acquire_lease('sequence', 'b', ttl=60) is True
+    assert reg_a.acquire_lease('sequence', 'a', ttl=60) is False
+
+
+def test_expired_lease_is_taken_over_and_fences_old_owner(db, first):
+    reg_a = SqliteStateRegistry(db)
+    reg_b = SqliteStateRegistry(db)
+
+    assert reg_a.acquire_lease('sequence', 'a', ttl=0.05) is True
+    time.sleep(0.1)
+    assert reg_b.acquire_lease('sequence', 'b', ttl=60) is True
+
+    # The old owner finds out on its next write, which is not applied
+    with pytest.raises(LeaseError):
+        reg_a.update_status(first, SequenceCommand.status_finished)
+    assert reg_b.get_status(first) == SequenceCommand.status_unknown
+
+    # ... and it no longer renews the lease it lost
+    reg_a.update_status(first, SequenceCommand.status_finished)
+    assert reg_b.get_status(first) == SequenceCommand.status_finished
+
+
+def test_heartbeat_renews_due_leases(db):
+    registry = SqliteStateRegistry(db)
+    registry.acquire_lease('sequence', 'a', ttl=0.3)
+
+    time.sleep(0.15)
+    registry.heartbeat()
+    time.sleep(0.2)
+
+    # Without the heartbeat, the lease would have expired by now
+    assert SqliteStateRegistry(db).acquire_lease('sequence', 'b', ttl=60) is False
+
+
+def test_contending_runner_backs_off_instead_of_waiting_for_busy_database(db):
+    registry = SqliteStateRegistry(db)
+    registry.get_known_statuses()
+
+    # Another process is in the middle of a write transaction
+    blocker = sqlite3.connect(db)
+    blocker.execute('BEGIN IMMEDIATE')
+    try:
+        started = time.time()
+        assert registry.acquire_lease('sequence', 'a', ttl=60) is False
+        assert time.time() - started < 1
+    finally:
+        blocker.rollback()
+        blocker.close()
+
+    assert registry.acquire_lease('sequence', 'a', ttl=60) is True
+
+
+def test_sequence_run_holds_lease(db):
+    base = SequenceBase()
+    observed = []
+
+    class LeasedSequence(Sequence):
+        lease_ttl = 60
+
+    @base.command
+    def first():
+        other = LeasedSequence(base=base, state_registry_name=db)
+        with pytest.raises(LeaseError):
+            other.run()
+        observed.append(other.is_finished)
+
+    sequence = LeasedSequence(base=base, state_registry_name=db)
+    sequence.run()
+
+    assert observed == [False]
+    assert sequence.is_finished
+
+    # Released at the end of the run
+    assert SqliteStateRegistry(db).acquire_lease('sequence', 'someone', ttl=60) is True
+
+
+def test_sequence_waits_for_lease_with_backoff(db):
+    base = SequenceBase()
+
+    @base.command
+    def first():
+        pass
+
+    class LeasedSequence(Sequence):
+        lease_ttl = 60
+        lease_timeout = 0.3
+        lease_backoff = 0.01
+
+    holder = SqliteStateRegistry(db)
+    assert holder.acquire_lease('sequence', 'holder', ttl=0.1)
+
+    sequence = LeasedSequence(base=base, state_registry_name=db)
+    sequence.run()
+    assert sequence.is_finished
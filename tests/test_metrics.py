@@ -0,0 +1,75 @@
+import json
+
+import pytest
+
+from idemseq.metrics import InMemoryMetrics, MetricsHook
+from idemseq.sequence import Sequence
+
+
+@pytest.fixture
+def metrics():
+    return InMemoryMetrics()
+
+
+@pytest.fixture
+def measured_sequence_cls(metrics):
+    class MeasuredSequence(Sequence):
+        pass
+
+    MeasuredSequence.metrics = metrics
+    return MeasuredSequence
+
+
+def test_records_command_attempts_and_skips(metrics, measured_sequence_cls, flaky_base):
+    sequence = measured_sequence_cls(base=flaky_base)
+
+    with pytest.raises(RuntimeError):
+        sequence.run()
+    sequence.run()
+
+    snapshot = metrics.snapshot()
+    assert snapshot['runs']['count'] == 2
+    assert snapshot['commands']['first']['attempts'] == 1
+    assert snapshot['commands']['flaky']['attempts'] == 2
+    assert snapshot['commands']['flaky']['failures'] == 1
+    assert snapshot['commands']['last']['attempts'] == 1
+    assert snapshot['skips'] == {'first': {MetricsHook.skip_already_finished: 1}}
+    assert snapshot['registry']['get_known_statuses']['calls'] >= 2
+    assert snapshot['registry']['update_status']['calls'] == 3
+    assert snapshot['runs']['wall_seconds'] >= snapshot['commands']['flaky']['wall_seconds']
+
+
+def test_records_skip_reasons(metrics, measured_sequence_cls, three_appenders_sequence_base):
+    sequence = measured_sequence_cls(base=three_appenders_sequence_base)
+
+    sequence.run(dry_run=True)
+    sequence.run(stop_before='appender2')
+    sequence.run(start_at='appender2', stop_before='appender3')
+
+    assert metrics.snapshot()['skips'] == {
+        'appender1': {MetricsHook.skip_dry_run: 1, MetricsHook.skip_start_at: 1},
+        'appender2': {MetricsHook.skip_dry_run: 1, MetricsHook.skip_stop_before: 1},
+        'appender3': {MetricsHook.skip_dry_run: 1, MetricsHook.skip_stop_before: 2},
+    }
+    assert 'appender1' in metrics.snapshot()['commands']
+
+
+def test_exports(metrics, measured_sequence_cls, flaky_base):
+    flaky_base.failures_left = 0
+    measured_sequence_cls(base=flaky_base).run()
+
+    exported = json.loads(metrics.to_json())
+    assert exported['commands']['flaky']['attempts'] == 1
+
+    text = metrics.to_prometheus()
+    assert '# TYPE idemseq_command_attempts_total counter' in text
+    assert 'idemseq_command_attempts_total{command="flaky"} 1' in text
+    assert 'idemseq_runs_total 1' in text
+    assert 'idemseq_registry_calls_total{operation="update_status"} 3' in text
+
+
+def test_no_metrics_by_default(three_appenders_sequence_base):
+    sequence = three_appenders_sequence_base()
+    assert sequence.metrics is None
+    sequence.run()
+    assert sequence.is_finished
@@ -1,15 +1,16 @@
 import pytest
 
-from idemseq.base import Options, AttrDict
+from idemseq.base import Options, AttrDict, FlatOptions, FlatAttrDict
 
 
-def test_nested_attr_dict():
-    first = AttrDict(a=1, b=2, c=3)
+@pytest.mark.parametrize('attr_dict_cls', [AttrDict, FlatAttrDict])
+def test_nested_attr_dict(attr_dict_cls):
+    first = attr_dict_cls(a=1, b=2, c=3)
 
-    second = AttrDict(d=4)
+    second = attr_dict_cls(d=4)
     second.set_parent(first)
 
-    third = AttrDict(b=222)
+    third = attr_dict_cls(b=222)
     third.set_parent(second)
 
     assert first.a == 1
@@ -36,8 +37,9 @@ def test_nested_attr_dict():
     assert 'e' not in third
 
 
-def test_nested_options():
-    class CustomOptions(Options):
+@pytest.mark.parametrize('options_cls', [Options, FlatOptions])
+def test_nested_options(options_cls):
+    class CustomOptions(options_cls):
         _valid_options = {
             'a': 1,
             'b': 2,
@@ -64,3 +66,78 @@ def test_nested_options():
     assert 'b' in fourth
     assert 'c' in fourth
     assert 'd' not in fourth
+
+
+def test_flat_attr_dict_takes_snapshot_of_parent():
+    first = FlatAttrDict(a=1)
+    second = FlatAttrDict(b=2)
+    second.set_parent(first)
+
+    assert second.flat_view() == {'a': 1, 'b': 2}
+
+    # Own writes are visible, writes to parent made after set_parent are not
+    second.b = 22
+    second['c'] = 3
+    first['a'] = 11
+    assert (second.a, second.b, second.c) == (1, 22, 3)
+
+    del second['c']
+    assert 'c' not in second
+
+    second.set_parent(None)
+    assert 'a' not in second
+    assert second.flat_view() == {'b': 22}
+
+
+def test_flat_options_fall_back_to_defaults():
+    class CustomOptions(FlatOptions):
+        _valid_options = {
+            'a': 1,
+            'b': 2,
+        }
+
+    first = CustomOptions(a=11)
+    second = CustomOptions()
+    second.set_parent(first)
+
+    assert (second.a, second.b) == (11, 2)
+    assert 'a' in second
+    assert 'b' not in second
+    assert second.flat_view() == {'a': 11}
+
+    second.b = 22
+    assert second.b == 22
+
+    with pytest.raises(AttributeError):
+        assert second.c
+
+    with pytest.raises(ValueError):
+        CustomOptions(c=3)
+
+
+def test_flat_views_follow_all_dict_mutations():
+    class CustomOptions(FlatOptions):
+        _valid_options = {
+            'a': 1,
+            'b': 2,
+            'c': 3,
+        }
+
+    for cls in (FlatAttrDict, CustomOptions):
+        parent = cls(a=1)
+        child = cls(b=2, c=3)
+        child.set_parent(parent)
+
+        assert child.pop('b') == 2
+        assert 'b' not in child.flat_view()
+        assert child.pop('b', None) is None
+
+        assert child.setdefault('b', 22) == 22
+        assert child.flat_view()['b'] == 22
+
+        key, value = child.popitem()
+        assert key not in child.flat_view()
+
+        child.clear()
+        assert child.flat_view() == {'a': 1}
+        assert child.a == 1
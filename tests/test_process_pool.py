@@ -0,0 +1,174 @@
+import errno
+import hashlib
+import os
+import time
+
+import pytest
+
+from idemseq.command import Command
+from idemseq.exceptions import CommandTimeoutError, SequenceCommandException
+from idemseq.metrics import InMemoryMetrics
+from idemseq.persistence import SqliteStateRegistry
+from idemseq.sequence import Sequence, SequenceBase, SequenceCommand
+
+
+base = SequenceBase()
+
+
+@base.command(persist_result=True)
+def checksum(data):
+    return hashlib.sha1(data.encode('utf-8')).hexdigest(), os.getpid()
+
+
+@base.command(depends_on=[], persist_result=True)
+def other_checksum(data):
+    return hashlib.sha1(data.upper().encode('utf-8')).hexdigest(), os.getpid()
+
+
+@base.command(persist_result=True)
+def report(checksum, other_checksum):
+    return checksum[0] != other_checksum[0], os.getpid()
+
+
+failing_base = SequenceBase()
+
+
+@failing_base.command
+def failing():
+    raise ValueError('failed in {}'.format(os.getpid()))
+
+
+hanging_base = SequenceBase()
+
+
+@hanging_base.command(timeout=0.2)
+def hanging(pid_file):
+    with open(pid_file, 'w') as f:
+        f.write(str(os.getpid()))
+    # Ignores cancellation
+    time.sleep(10)
+
+
+timed_base = SequenceBase()
+
+
+def _sleep_and_report():
+    started = time.time()
+    time.sleep(0.3)
+    return started, time.time()
+
+
+for i in range(4):
+    timed_base.command(name='timed_{}'.format(i), depends_on=[], timeout=0.5, persist_result=True)(
+        _sleep_and_report,
+    )
+
+
+class ParentOnlyStateRegistry(SqliteStateRegistry):
+    keep_history = True
+
+    writers = set()
+
+    def update_status(self, command, status):
+        self.writers.add(os.getpid())
+        super(ParentOnlyStateRegistry, self).update_status(command, status)
+
+
+class ProcessSequence(Sequence):
+    state_registry_cls = ParentOnlyStateRegistry
+
+
+def test_commands_run_in_worker_processes(tmpdir):
+    sequence = ProcessSequence(base, str(tmpdir.join('processes.db')), context=dict(data='abc'))
+    sequence.run(executor='process', max_workers=2)
+
+    assert sequence.is_finished
+    digest, pid = sequence.results['checksum']
+    assert digest == hashlib.sha1(b'abc').hexdigest()
+    assert pid != os.getpid()
+    assert sequence.results['report'][0] is True
+    assert sequence.results['report'][1] != os.getpid()
+
+    # Statuses and history are written by the parent only
+    assert ParentOnlyStateRegistry.writers == {os.getpid()}
+    assert len(sequence._real_state_registry.get_history()) == 3
+
+
+def test_failures_in_worker_processes_are_raised_and_recorded(tmpdir):
+    sequence = ProcessSequence(failing_base, str(tmpdir.join('processes.db')))
+    with pytest.raises(ValueError) as exc_info:
+        sequence.run(executor='process')
+    assert str(os.getpid()) not in str(exc_info.value)
+    history = sequence._real_state_registry.get_history()
+    assert [(a['status'], a['error_type']) for a in history] == [(SequenceCommand.status_failed, 'ValueError')]
+
+
+def test_commands_in_worker_processes_are_measured(tmpdir):
+    metrics = InMemoryMetrics()
+
+    sequence = ProcessSequence(base, str(tmpdir.join('processes.db')), context=dict(data='abc'))
+    sequence.metrics = metrics
+    sequence.run(executor='process', max_workers=2)
+
+    sequence = ProcessSequence(failing_base, str(tmpdir.join('failing.db')))
+    sequence.metrics = metrics
+    with pytest.raises(ValueError):
+        sequence.run(executor='process')
+
+    commands = metrics.snapshot()['commands']
+    assert sorted(commands) == ['checksum', 'failing', 'other_checksum', 'report']
+    assert [commands[name]['attempts'] for name in sorted(commands)] == [1, 1, 1, 1]
+    assert commands['failing']['failures'] == 1
+    assert commands['checksum']['failures'] == 0
+    assert commands['checksum']['wall_seconds'] > 0
+
+
+def test_commands_with_timeout_in_processes_respect_max_workers(tmpdir):
+    sequence = ProcessSequence(timed_base, str(tmpdir.join('timed.db')))
+    sequence.run(executor='process', max_workers=2)
+    assert sequence.is_finished
+
+    # At most two commands ran at a time, and none of them timed out waiting for the others
+    intervals = [sequence.results['timed_{}'.format(i)] for i in range(4)]
+    for started, _ in intervals:
+        assert sum(1 for s, f in intervals if s <= started < f) <= 2
+
+
+def test_dry_run_with_process_pool_runs_nothing(tmpdir):
+    sequence = ProcessSequence(failing_base, str(tmpdir.join('processes.db')))
+    sequence.run(dry_run=True, executor='process')
+    assert sequence['failing'].status == SequenceCommand.status_unknown
+    assert sequence._real_state_registry.get_history() == []
+
+
+def test_commands_which_are_not_importable_can_not_run_in_processes():
+    lambda_base = SequenceBase(Command(lambda: None, name='anonymous'))
+    with pytest.raises(SequenceCommandException):
+        lambda_base().run(executor='process')
+
+    assert Command(checksum._func).import_path == '{}:checksum'.format(__name__)
+    assert Command(lambda: None).import_path is None
+
+
+def test_commands_which_time_out_in_processes_are_terminated(tmpdir):
+    pid_file = str(tmpdir.join('pid'))
+    sequence = hanging_base(context=dict(pid_file=pid_file))
+
+    started = time.time()
+    with pytest.raises(CommandTimeoutError):
+        sequence.run(executor='process')
+    assert time.time() - started < 5
+    assert sequence['hanging'].status == SequenceCommand.status_timed_out
+
+    with open(pid_file) as f:
+        pid = int(f.read())
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        try:
+            os.kill(pid, 0)
+        except OSError as e:
+            assert e.errno == errno.ESRCH
+            break
+        time.sleep(0.05)
+    else:
+        pytest.fail('Process of the command which timed out is still running')
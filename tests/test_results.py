@@ -0,0 +1,283 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from idemseq.command import Command
+from idemseq.persistence import SharedSqliteStateRegistry, SqliteStateRegistry
+from idemseq.results import decode_result, encode_result, hash_inputs
+from idemseq.sequence import Sequence, SequenceBase
+
+
+@pytest.mark.parametrize('result_format', ['pickle', 'json'])
+@pytest.mark.parametrize('compress', [False, True])
+def test_encode_and_decode_result(result_format, compress):
+    value = {'a': [1, 2, 3], 'b': 'x' * 1000}
+    encoded = encode_result(value, format=result_format, compress=compress)
+    assert decode_result(encoded) == value
+    if compress:
+        assert len(encoded) < 1000
+
+
+def test_hash_inputs():
+    assert hash_inputs({'a': 1, 'b': [2]}) == hash_inputs({'b': [2], 'a': 1})
+    assert hash_inputs({'a': 1}) != hash_inputs({'a': 2})
+
+    # Keys of mixed types
+    assert hash_inputs({'m': {1: 'a', 'b': 2}}) == hash_inputs({'m': {'b': 2, 1: 'a'}})
+    assert hash_inputs({'m': {1: 'a'}}) != hash_inputs({'m': {'1': 'a'}})
+
+
+def test_hash_of_set_inputs_does_not_depend_on_hash_seed():
+    script = (
+        'from idemseq.results import hash_inputs\n'
+        'print(hash_inputs({"tags": {"alpha", "beta", "gamma", "delta", "epsilon"}, "ids": frozenset([1, "x"])}))\n'
+    )
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    hashes = set()
+    for seed in ('1', '2', '3', '4'):
+        env = dict(os.environ, PYTHONHASHSEED=seed)
+        hashes.add(subprocess.check_output([sys.executable, '-c', script], cwd=root, env=env).strip())
+    assert len(hashes) == 1
+
+
+def test_commands_with_mixed_key_inputs_finish(db):
+    calls = []
+    base = SequenceBase()
+
+    @base.command(invalidate_on_change=True)
+    def mapping(m):
+        calls.append(m)
+
+    base(db, context=dict(m={1: 'a', 'b': 2})).run()
+    sequence = base(db, context=dict(m={1: 'a', 'b': 2}))
+    assert sequence.is_finished
+    sequence.run()
+    assert len(calls) == 1
+
+
+def create_base(calls):
+    base = SequenceBase()
+
+    @base.command(persist_result='json')
+    def fetch(url):
+        calls.append('fetch')
+        return {'url': url, 'items': [1, 2, 3]}
+
+    @base.command(persist_result=True)
+    def parse(fetch):
+        calls.append('parse')
+        return sum(fetch['items'])
+
+    @base.command
+    def report(parse, fetch):
+        calls.append('report')
+        return '{}: {}'.format(fetch['url'], parse)
+
+    return base
+
+
+def test_downstream_commands_receive_persisted_results(db):
+    calls = []
+    base = create_base(calls)
+
+    sequence = base(db, context=dict(url='http://example.com'))
+    sequence.run(stop_before='report')
+    assert calls == ['fetch', 'parse']
+    assert sequence.results['parse'] == 6
+
+    # A new process doesn't run fetch and parse again, and report gets their results
+    calls = []
+    base = create_base(calls)
+    sequence = base(db)
+    assert sequence['report'].run() == 'http://example.com: 6'
+    assert calls == ['report']
+    assert sequence.results['fetch'] == {'url': 'http://example.com', 'items': [1, 2, 3]}
+    assert 'report' not in sequence.results
+
+    # Context overrides persisted results
+    sequence['report'].reset()
+    with sequence.env(context=dict(parse=7)):
+        assert sequence['report'].run() == 'http://example.com: 7'
+
+
+def test_results_in_dry_run_are_not_persisted(db):
+    calls = []
+    sequence = create_base(calls)(db, context=dict(url='u'))
+
+    sequence.run(dry_run=True)
+    assert calls == []
+    assert 'fetch' not in sequence.results
+
+    sequence.run()
+    assert calls == ['fetch', 'parse', 'report']
+
+
+def test_large_results_are_not_persisted(db):
+    class SmallResultsSequence(Sequence):
+        max_result_size = 100
+
+    base = SequenceBase()
+
+    @base.command(persist_result=True)
+    def big():
+        return 'x' * 1000
+
+    @base.command(persist_result=True)
+    def small():
+        return 'x'
+
+    sequence = SmallResultsSequence(base, db)
+    sequence.run()
+    assert sequence.is_finished
+
+    sequence = SmallResultsSequence(base, db)
+    assert 'big' not in sequence.results
+    assert sequence.results['small'] == 'x'
+
+    class CompressedResultsSequence(SmallResultsSequence):
+        compress_results = True
+
+    sequence = CompressedResultsSequence(base, db)
+    sequence['big'].reset()
+    sequence.run()
+    assert CompressedResultsSequence(base, db).results['big'] == 'x' * 1000
+
+
+def test_commands_run_again_when_inputs_change(tmpdir):
+    calls = []
+    base = SequenceBase()
+
+    @base.command(persist_result=True, invalidate_on_change=True)
+    def download(url):
+        calls.append(('download', url))
+        return url.upper()
+
+    @base.command(invalidate_on_change=True)
+    def process(download, mode='fast'):
+        calls.append(('process', download, mode))
+
+    @base.command
+    def notify():
+        calls.append(('notify',))
+
+    class JobsStateRegistry(SharedSqliteStateRegistry):
+        database = str(tmpdir.join('jobs.db'))
+
+    class JobSequence(Sequence):
+        state_registry_cls = JobsStateRegistry
+
+    JobSequence(base, 'job', context=dict(url='a')).run()
+    assert calls == [('download', 'a'), ('process', 'A', 'fast'), ('notify',)]
+
+    # Same inputs, nothing to do
+    del calls[:]
+    JobSequence(base, 'job', context=dict(url='a')).run()
+    assert calls == []
+
+    # Changed input reruns the command, and the commands whose inputs changed as a result
+    JobSequence(base, 'job', context=dict(url='b')).run()
+    assert calls == [('download', 'b'), ('process', 'B', 'fast')]
+
+    del calls[:]
+    JobSequence(base, 'job', context=dict(url='b', mode='slow')).run()
+    assert calls == [('process', 'B', 'slow')]
+
+    # Other sequences in the same database are unaffected
+    del calls[:]
+    JobSequence(base, 'other-job', context=dict(url='b')).run()
+    assert calls == [('download', 'b'), ('process', 'B', 'fast'), ('notify',)]
+
+
+def test_commands_run_again_when_code_or_version_changes(db):
+    calls = []
+
+    def create_fingerprinted_base(factor, version=None):
+        base = SequenceBase()
+
+        @base.command(fingerprint=True, version=version)
+        def compute(x):
+            calls.append('compute')
+            return x * factor if factor > 1 else x
+
+        @base.command
+        def other():
+            calls.append('other')
+
+        return base
+
+    create_fingerprinted_base(2)(db, context=dict(x=1)).run()
+    assert calls == ['compute', 'other']
+
+    del calls[:]
+    create_fingerprinted_base(2)(db, context=dict(x=1)).run()
+    assert calls == []
+
+    # Closure values aren't part of the code; a changed version is
+    create_fingerprinted_base(3)(db, context=dict(x=1)).run()
+    assert calls == []
+    create_fingerprinted_base(3, version=2)(db, context=dict(x=1)).run()
+    assert calls == ['compute']
+
+    del calls[:]
+    create_fingerprinted_base(3, version=2)(db, context=dict(x=5)).run()
+    assert calls == ['compute']
+
+
+def test_code_fingerprint_ignores_comments_but_not_code():
+    def f(x):
+        # a comment
+        return x + 1
+
+    def g(x):
+        return x + 1
+
+    def h(x):
+        return x + 2
+
+    fingerprint = Command(f).code_fingerprint
+    assert fingerprint == Command(g).code_fingerprint
+    assert fingerprint != Command(h).code_fingerprint
+
+
+def test_code_fingerprint_does_not_depend_on_hash_seed():
+    script = (
+        'from idemseq.command import Command\n'
+        'def f(x):\n'
+        '    return x in {"alpha", "beta", "gamma", "delta", "epsilon"}\n'
+        'print(Command(f).code_fingerprint)\n'
+    )
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    fingerprints = set()
+    for seed in ('1', '2', '3', '4'):
+        env = dict(os.environ, PYTHONHASHSEED=seed)
+        fingerprints.add(subprocess.check_output([sys.executable, '-c', script], cwd=root, env=env).strip())
+    assert len(fingerprints) == 1
+
+
+def test_fingerprints_are_loaded_once_per_run(db):
+    base = SequenceBase()
+    for i in range(20):
+        base.command(name='command_{}'.format(i), fingerprint=True)(lambda: None)
+
+    base(db).run()
+
+    loads = []
+
+    class CountingStateRegistry(SqliteStateRegistry):
+        def get_input_hashes(self):
+            loads.append('get_input_hashes')
+            return super(CountingStateRegistry, self).get_input_hashes()
+
+        def load_result(self, command):
+            loads.append('load_result')
+            return super(CountingStateRegistry, self).load_result(command)
+
+    class CountingSequence(Sequence):
+        state_registry_cls = CountingStateRegistry
+
+    sequence = CountingSequence(base, db)
+    sequence.run()
+    assert loads == ['get_input_hashes']
+    assert sequence.is_finished
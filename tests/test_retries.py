@@ -0,0 +1,155 @@
+import logging
+import sqlite3
+import time
+
+import pytest
+
+from idemseq.persistence import SqliteStateRegistry
+from idemseq.sequence import Sequence, SequenceBase, SequenceCommand
+
+
+class HistorySqliteStateRegistry(SqliteStateRegistry):
+    keep_history = True
+
+
+class RetryingSequence(Sequence):
+    state_registry_cls = HistorySqliteStateRegistry
+    retry_backoff = 0.01
+
+
+def create_flaky_base(failures, **options):
+    base = SequenceBase()
+    base.calls = []
+
+    @base.command
+    def first():
+        pass
+
+    @base.command(**options)
+    def flaky():
+        base.calls.append(time.time())
+        if len(base.calls) <= failures:
+            raise IOError('flaky')
+
+    return base
+
+
+def test_failed_commands_are_retried_with_backoff(db):
+    base = create_flaky_base(2, max_attempts=3, retry_backoff=0.05)
+    sequence = RetryingSequence(base, db)
+    sequence.run()
+    assert sequence.is_finished
+    assert len(base.calls) == 3
+
+    # Delays grow exponentially, with jitter of +-50%
+    assert base.calls[1] - base.calls[0] >= 0.025
+    assert base.calls[2] - base.calls[1] >= 0.05
+
+    history = HistorySqliteStateRegistry(db).get_history('flaky')
+    assert [(a['status'], a['error_type']) for a in history] == [
+        (SequenceCommand.status_failed, 'OSError' if IOError is OSError else 'IOError'),
+        (SequenceCommand.status_failed, 'OSError' if IOError is OSError else 'IOError'),
+        (SequenceCommand.status_finished, None),
+    ]
+    assert 0.025 <= history[0]['retry_delay'] <= 0.075
+    assert 0.05 <= history[1]['retry_delay'] <= 0.15
+    assert history[2]['retry_delay'] is None
+    assert sequence.history()[1]['attempts'] == 3
+
+
+def test_commands_fail_when_attempts_run_out(db):
+    base = create_flaky_base(3, max_attempts=3)
+    sequence = RetryingSequence(base, db)
+    with pytest.raises(IOError):
+        sequence.run()
+    assert len(base.calls) == 3
+    assert not sequence['flaky'].is_finished
+
+    # Without max_attempts, commands are not retried
+    base = create_flaky_base(1)
+    with pytest.raises(IOError):
+        RetryingSequence(base, db).run()
+    assert len(base.calls) == 1
+
+
+def test_failure_is_logged_once_after_the_last_attempt(db, caplog):
+    base = create_flaky_base(3, max_attempts=3)
+    with pytest.raises(IOError):
+        RetryingSequence(base, db).run()
+
+    errors = [record for record in caplog.records if record.levelno >= logging.ERROR]
+    assert [record.getMessage() for record in errors] == ['Command "flaky" failed with an exception']
+    retries = [record for record in caplog.records if record.levelno == logging.WARNING]
+    assert len(retries) == 2
+
+
+def test_only_retryable_exceptions_are_retried(db):
+    base = create_flaky_base(1, max_attempts=3, retry_on=(ValueError, KeyError))
+    with pytest.raises(IOError):
+        RetryingSequence(base, db).run()
+    assert len(base.calls) == 1
+
+    base = create_flaky_base(1, max_attempts=3, retry_on=EnvironmentError)
+    RetryingSequence(base, db).run()
+    assert len(base.calls) == 2
+
+
+def test_retries_stop_when_budget_is_spent(db):
+    base = create_flaky_base(10, max_attempts=10, retry_backoff=0.1, retry_budget=0.25)
+    with pytest.raises(IOError):
+        RetryingSequence(base, db).run()
+    # The budget counts from the start of the first attempt, not from opening the state registry
+    assert base.calls[-1] - base.calls[0] < 0.25
+    assert 1 < len(base.calls) < 4
+
+
+def test_no_write_lock_is_held_while_waiting_to_retry(db):
+    base = SequenceBase()
+    writes = []
+
+    @base.command
+    def first():
+        pass
+
+    @base.command(max_attempts=2)
+    def flaky():
+        if not writes:
+            # Another process can write to the database before the command is retried
+            connection = sqlite3.connect(db, timeout=0)
+            connection.execute('BEGIN IMMEDIATE')
+            connection.rollback()
+            connection.close()
+            writes.append(True)
+            raise IOError('flaky')
+
+    class BatchingStateRegistry(HistorySqliteStateRegistry):
+        batch_writes = True
+
+    class BatchingSequence(RetryingSequence):
+        state_registry_cls = BatchingStateRegistry
+
+    for run_options in [{}, {'max_workers': 2}]:
+        del writes[:]
+        sequence = BatchingSequence(base, db)
+        sequence.reset()
+        sequence.run(**run_options)
+        assert sequence.is_finished
+        assert len(writes) == 1
+
+
+def test_history_tables_of_older_databases_are_upgraded(db):
+    connection = sqlite3.connect(db)
+    connection.execute(
+        'CREATE TABLE steps_history (name varchar NOT NULL, started_at real, finished_at real, duration real, '
+        'previous_status varchar, status varchar, error_type varchar)'
+    )
+    connection.execute("INSERT INTO steps_history VALUES ('flaky', 1.0, 2.0, 1.0, 'unknown', 'failed', 'IOError')")
+    connection.execute('PRAGMA user_version = 4')
+    connection.commit()
+    connection.close()
+
+    registry = HistorySqliteStateRegistry(db)
+    registry.record_attempt(
+        SequenceCommand(create_flaky_base(0)['flaky']), 3.0, 4.0, SequenceCommand.status_finished, retry_delay=0.5,
+    )
+    assert [a['retry_delay'] for a in registry.get_history()] == [None, 0.5]
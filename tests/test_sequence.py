@@ -235,3 +235,37 @@ def test_run_always_and_run_until_finished_do_not_affect_next_command():
     seq['three'].status = SequenceCommand.status_finished
 
     assert seq.next_command is None
+
+
+def test_run_reads_statuses_once_and_writes_once_per_command():
+    from idemseq.persistence import SqliteStateRegistry
+
+    calls = []
+
+    class CountingStateRegistry(SqliteStateRegistry):
+        def get_status(self, command):
+            calls.append('get_status')
+            return super(CountingStateRegistry, self).get_status(command)
+
+        def get_known_statuses(self):
+            calls.append('get_known_statuses')
+            return super(CountingStateRegistry, self).get_known_statuses()
+
+        def update_status(self, command, status):
+            calls.append('update_status')
+            return super(CountingStateRegistry, self).update_status(command, status)
+
+    class CountingSequence(Sequence):
+        state_registry_cls = CountingStateRegistry
+
+    base = SequenceBase(*[Command(lambda: None, name='command_{}'.format(i)) for i in range(50)])
+    sequence = CountingSequence(base=base)
+
+    sequence.run()
+    assert sequence.is_finished
+
+    # One bulk read for the run, one write per command, and one bulk read
+    # for the final is_finished check. The dry run registry isn't touched.
+    assert calls.count('get_status') == 0
+    assert calls.count('get_known_statuses') == 2
+    assert calls.count('update_status') == 50
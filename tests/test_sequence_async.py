@@ -0,0 +1,265 @@
+import asyncio
+import threading
+
+import pytest
+
+from idemseq.aio import get_async_state_registry
+from idemseq.cancellation import current_cancellation
+from idemseq.exceptions import CommandTimeoutError, LeaseError, SequenceCommandException
+from idemseq.metrics import InMemoryMetrics
+from idemseq.persistence import SqliteStateRegistry
+from idemseq.sequence import Sequence, SequenceBase, SequenceCommand
+
+
+@pytest.fixture
+def async_sequence_base():
+    base = SequenceBase()
+    base.outputs = []
+
+    @base.command
+    async def fetch(url):
+        await asyncio.sleep(0.01)
+        base.outputs.append(('fetch', url))
+
+    @base.command
+    def store():
+        base.outputs.append('store')
+
+    return base
+
+
+def test_coroutine_commands_are_awaited(async_sequence_base):
+    sequence = async_sequence_base(context=dict(url='http://example.com'))
+
+    asyncio.run(sequence.run_async())
+
+    assert async_sequence_base.outputs == [('fetch', 'http://example.com'), 'store']
+    assert sequence.is_finished
+
+    asyncio.run(sequence.run_async())
+    assert len(async_sequence_base.outputs) == 2
+
+
+def test_coroutine_commands_cannot_be_run_synchronously(async_sequence_base):
+    sequence = async_sequence_base(context=dict(url='http://example.com'))
+
+    with pytest.raises(SequenceCommandException):
+        sequence.run()
+
+    assert not sequence['fetch'].is_finished
+
+    asyncio.run(sequence['fetch'].run_async())
+    assert sequence['fetch'].is_finished
+    assert not sequence.is_finished
+
+
+def test_run_async_respects_run_options(async_sequence_base):
+    sequence = async_sequence_base()
+
+    asyncio.run(sequence.run_async(context=dict(url='u'), dry_run=True))
+    assert async_sequence_base.outputs == []
+    assert not sequence.is_finished
+
+    asyncio.run(sequence.run_async(context=dict(url='u'), stop_before='store'))
+    assert async_sequence_base.outputs == [('fetch', 'u')]
+    assert not sequence['store'].is_finished
+
+
+def test_one_event_loop_drives_many_sequences(tmpdir):
+    base = SequenceBase()
+    running = []
+    max_running = []
+
+    @base.command
+    async def work(n):
+        running.append(n)
+        max_running.append(len(running))
+        await asyncio.sleep(0.01)
+        running.remove(n)
+
+    sequences = [base(str(tmpdir.join('{}.db'.format(n))), context=dict(n=n)) for n in range(50)]
+
+    async def main():
+        await asyncio.gather(*[s.run_async() for s in sequences])
+
+    asyncio.run(main())
+
+    assert all(s.is_finished for s in sequences)
+    assert max(max_running) > 1
+
+
+def test_run_async_persists_results(tmpdir):
+    db = str(tmpdir.join('results.db'))
+    base = SequenceBase()
+
+    @base.command(persist_result=True, invalidate_on_change=True)
+    async def fetch(url):
+        return url.upper()
+
+    @base.command
+    def store(fetch):
+        return fetch
+
+    asyncio.run(base(db, context=dict(url='u')).run_async(stop_before='store'))
+
+    sequence = base(db)
+    assert asyncio.run(sequence['store'].run_async()) == 'U'
+    assert sequence.results['fetch'] == 'U'
+
+
+def test_coroutine_commands_are_retried():
+    base = SequenceBase()
+    calls = []
+
+    @base.command(max_attempts=2, retry_backoff=0.01)
+    async def fetch():
+        calls.append('fetch')
+        if len(calls) == 1:
+            raise IOError('flaky')
+
+    sequence = base()
+    asyncio.run(sequence.run_async())
+    assert calls == ['fetch', 'fetch']
+    assert sequence.is_finished
+
+
+def test_coroutine_command_which_times_out_is_cancelled():
+    base = SequenceBase()
+    events = []
+
+    @base.command(timeout=0.05)
+    async def hanging():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            events.append('cancelled')
+            raise
+
+    sequence = base()
+    with pytest.raises(CommandTimeoutError):
+        asyncio.run(sequence.run_async())
+    assert events == ['cancelled']
+    assert sequence['hanging'].status == SequenceCommand.status_timed_out
+
+    # Plain commands running in the executor are asked to stop
+    events = []
+    base = SequenceBase()
+
+    @base.command(timeout=0.05)
+    def stubborn():
+        current_cancellation().wait(10)
+        events.append('cancelled')
+
+    @base.command(depends_on=[])
+    def independent():
+        pass
+
+    sequence = base()
+    asyncio.run(sequence.run_async(on_timeout='continue'))
+    assert sequence['independent'].is_finished
+    assert events == ['cancelled']
+
+
+def test_run_async_holds_lease_and_reports_metrics(tmpdir):
+    db = str(tmpdir.join('leased.db'))
+    base = SequenceBase()
+    observed = []
+
+    class LeasedSequence(Sequence):
+        lease_ttl = 60
+        metrics = InMemoryMetrics()
+
+    @base.command
+    async def first():
+        other = LeasedSequence(base=base, state_registry_name=db)
+        with pytest.raises(LeaseError):
+            other.run()
+
+    @base.command
+    def second():
+        observed.append('second')
+
+    sequence = LeasedSequence(base=base, state_registry_name=db)
+    asyncio.run(sequence.run_async(stop_before='second'))
+    asyncio.run(sequence.run_async())
+
+    assert observed == ['second']
+    assert sequence.is_finished
+    # Released at the end of the run
+    assert SqliteStateRegistry(db).acquire_lease('sequence', 'someone', ttl=60) is True
+
+    snapshot = LeasedSequence.metrics.snapshot()
+    # Both async runs and the run that couldn't get the lease
+    assert snapshot['runs']['count'] == 3
+    assert snapshot['commands']['first']['attempts'] == 1
+    assert snapshot['skips']['first'] == {'already_finished': 1}
+    assert snapshot['skips']['second'] == {'stop_before': 1}
+
+
+def test_run_async_runs_independent_commands_concurrently():
+    base = SequenceBase()
+    events = []
+
+    @base.command(depends_on=[])
+    async def upload_a():
+        events.append('a started')
+        await asyncio.sleep(0.05)
+        events.append('a finished')
+
+    @base.command(depends_on=[])
+    async def upload_b():
+        events.append('b started')
+        await asyncio.sleep(0.05)
+        events.append('b finished')
+
+    @base.command(depends_on=['upload_a', 'upload_b'])
+    def notify():
+        events.append('notify')
+
+    sequence = base()
+    asyncio.run(sequence.run_async(max_workers=2))
+
+    assert events[:2] == ['a started', 'b started']
+    assert events[-1] == 'notify'
+    assert sequence.is_finished
+
+    with pytest.raises(ValueError):
+        asyncio.run(base().run_async(executor='process'))
+
+
+def test_standalone_command_flushes_without_blocking_the_loop(tmpdir):
+    db = str(tmpdir.join('batched.db'))
+    flushed_in = []
+
+    class BatchedStateRegistry(SqliteStateRegistry):
+        batch_writes = True
+
+        def flush(self):
+            if self._pending_statuses:
+                flushed_in.append(threading.current_thread())
+            super(BatchedStateRegistry, self).flush()
+
+    class BatchedSequence(Sequence):
+        state_registry_cls = BatchedStateRegistry
+
+    base = SequenceBase()
+
+    @base.command
+    async def first():
+        pass
+
+    sequence = BatchedSequence(base, db)
+    asyncio.run(sequence['first'].run_async())
+
+    assert SqliteStateRegistry(db).get_known_statuses() == {'first': 'finished'}
+    assert len(flushed_in) == 1
+    assert flushed_in[0] is not threading.current_thread()
+
+
+def test_async_state_registries_are_not_shared_between_event_loops(tmpdir):
+    registry = SqliteStateRegistry(str(tmpdir.join('loops.db')))
+
+    async def get():
+        return get_async_state_registry(registry)
+
+    assert asyncio.run(get()) is not asyncio.run(get())
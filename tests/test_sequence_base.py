@@ -2,6 +2,7 @@ import copy
 
 import pytest
 
+from idemseq.command import Command
 from idemseq.sequence import SequenceBase, Sequence, SequenceCommand
 
 
@@ -92,3 +93,60 @@ def test_can_access_commands_by_name(hello_world_command, square_command):
     sb = SequenceBase(hello_world_command, square_command)
     assert sb['hello_world'] == hello_world_command
     assert sb['square'] == square_command
+
+
+def test_ordered_index_and_slicing():
+    sb = SequenceBase()
+
+    @sb.command(order=30)
+    def c():
+        pass
+
+    @sb.command(order=10)
+    def a():
+        pass
+
+    @sb.command(order=20)
+    def b():
+        pass
+
+    assert sb.names == ('a', 'b', 'c')
+    assert [sb.index_of(n) for n in ('a', 'b', 'c')] == [0, 1, 2]
+    assert [cmd.name for cmd in sb.commands_before('c')] == ['a', 'b']
+    assert sb.commands_before('a') == ()
+    assert [cmd.name for cmd in sb.commands_between(start_at='b')] == ['b', 'c']
+    assert [cmd.name for cmd in sb.commands_between(stop_before='b')] == ['a']
+    assert [cmd.name for cmd in sb.commands_between('b', 'c')] == ['b']
+
+    # Index is rebuilt when a command is registered
+    @sb.command(order=15)
+    def a2():
+        pass
+
+    assert sb.names == ('a', 'a2', 'b', 'c')
+    assert sb.index_of('b') == 2
+
+
+def test_frozen_base_does_not_accept_commands(hello_world_command, square_command):
+    sb = SequenceBase(hello_world_command).freeze()
+    assert sb.is_frozen
+
+    with pytest.raises(RuntimeError):
+        sb.command(lambda: 1)
+
+    with pytest.raises(RuntimeError):
+        sb._register_command(square_command)
+
+    assert len(sb) == 1
+    assert sb().is_finished is False
+
+
+def test_long_chains_of_dependencies():
+    sb = SequenceBase(*[Command(lambda: None, name='c{}'.format(i)) for i in range(3000)])
+    assert len(sb.requirements_of('c2999')) == 2999
+
+    chained = SequenceBase(*[
+        Command(lambda: None, name='c{}'.format(i), depends_on=['c{}'.format(i - 1)] if i else [])
+        for i in range(3000)
+    ])
+    assert len(chained.requirements_of('c2999')) == 2999
@@ -39,3 +39,15 @@ def test_sequence_command_interface(one_command_sequence_base):
     sequence_command.reset()
     assert not sequence.is_finished
     assert not sequence_command.is_finished
+
+
+def test_sequence_returns_cached_sequence_commands(one_command_sequence_base):
+    sequence = one_command_sequence_base()
+
+    assert sequence['command_0'] is sequence['command_0']
+    assert list(sequence.all_commands)[0] is sequence['command_0']
+    assert sequence['command_0'] == sequence['command_0']
+    assert sequence['command_0'] != one_command_sequence_base()['command_0']
+
+    assert sequence['command_0'].name == 'command_0'
+    assert sequence['command_0'].options.run_always is None
@@ -0,0 +1,131 @@
+import threading
+
+import pytest
+
+from idemseq.command import Command
+from idemseq.exceptions import SequenceCommandException
+from idemseq.sequence import SequenceBase
+
+
+@pytest.fixture
+def diamond_sequence_base():
+    base = SequenceBase()
+    base.outputs = []
+    base.barrier = threading.Barrier(2, timeout=5) if hasattr(threading, 'Barrier') else None
+
+    @base.command(depends_on=[])
+    def prepare():
+        base.outputs.append('prepare')
+
+    @base.command(depends_on=[prepare])
+    def upload_a():
+        if base.barrier:
+            base.barrier.wait()
+        base.outputs.append('upload_a')
+
+    @base.command(depends_on=['prepare'])
+    def upload_b():
+        if base.barrier:
+            base.barrier.wait()
+        base.outputs.append('upload_b')
+
+    @base.command(depends_on=['upload_a', 'upload_b'])
+    def publish():
+        base.outputs.append('publish')
+
+    return base
+
+
+def test_commands_without_depends_on_require_all_previous_commands(three_appenders_sequence_base):
+    base = three_appenders_sequence_base
+    assert base.dependencies_of('appender1') == ()
+    assert base.dependencies_of('appender3') == ('appender1', 'appender2')
+    assert base.requirements_of('appender3') == ('appender1', 'appender2')
+
+
+def test_declared_dependencies(diamond_sequence_base):
+    base = diamond_sequence_base
+    assert base.dependencies_of('upload_a') == ('prepare',)
+    assert base.dependencies_of('publish') == ('upload_a', 'upload_b')
+    assert base.requirements_of('publish') == ('prepare', 'upload_a', 'upload_b')
+    assert base.requirements_of('prepare') == ()
+
+
+def test_invalid_dependencies_are_rejected():
+    base = SequenceBase(
+        Command(lambda: 1, name='first', depends_on=['second']),
+        Command(lambda: 2, name='second'),
+        Command(lambda: 3, name='third', depends_on=['unknown']),
+    )
+
+    with pytest.raises(ValueError):
+        base.dependencies_of('first')
+
+    with pytest.raises(ValueError):
+        base.dependencies_of('third')
+
+
+def test_independent_commands_can_run_before_previous_commands_finish(diamond_sequence_base):
+    diamond_sequence_base.barrier = None
+    sequence = diamond_sequence_base()
+    sequence['prepare'].run()
+    sequence['upload_b'].run()
+
+    with pytest.raises(SequenceCommandException):
+        sequence['publish'].run()
+
+    sequence['upload_a'].run()
+    sequence['publish'].run()
+    assert sequence.is_finished
+
+
+def test_concurrent_run_overlaps_independent_commands(diamond_sequence_base):
+    base = diamond_sequence_base
+    sequence = base()
+
+    # Both uploads wait on a barrier, so this would time out if they ran one after another
+    sequence.run(max_workers=2)
+
+    assert sequence.is_finished
+    assert base.outputs[0] == 'prepare'
+    assert sorted(base.outputs[1:3]) == ['upload_a', 'upload_b']
+    assert base.outputs[3] == 'publish'
+
+    sequence.run(max_workers=2)
+    assert len(base.outputs) == 4
+
+
+def test_concurrent_run_respects_total_order_by_default(three_appenders_sequence_base):
+    sequence = three_appenders_sequence_base()
+    sequence.run(max_workers=4)
+    assert three_appenders_sequence_base.outputs == [1, 2, 3]
+    assert sequence.is_finished
+
+
+def test_concurrent_run_stops_scheduling_after_failure():
+    outputs = []
+    base = SequenceBase()
+
+    @base.command(depends_on=[])
+    def fails():
+        raise RuntimeError('failed')
+
+    @base.command(depends_on=[])
+    def succeeds():
+        outputs.append('succeeds')
+
+    @base.command(depends_on=['fails', 'succeeds'])
+    def after():
+        outputs.append('after')
+
+    sequence = base()
+    with pytest.raises(RuntimeError):
+        sequence.run(max_workers=2)
+
+    assert 'after' not in outputs
+    assert not sequence['fails'].is_finished
+    assert not sequence['after'].is_finished
+
+    # warn_only keeps going with whatever can run
+    sequence.run(max_workers=2, warn_only=True)
+    assert not sequence['after'].is_finished
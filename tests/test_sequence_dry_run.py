@@ -1,4 +1,6 @@
-from idemseq.sequence import SequenceBase
+from idemseq.command import Command
+from idemseq.persistence import SqliteStateRegistry
+from idemseq.sequence import Sequence, SequenceBase, SequenceCommand
 
 
 def test_dry_run(three_appenders_sequence_base):
@@ -87,3 +89,61 @@ def test_dry_run_state_registry_knows_everything():
         assert sequence.is_finished
 
     assert not sequence.is_finished
+
+
+def test_dry_run_is_an_overlay_over_real_state():
+    calls = []
+
+    class CountingStateRegistry(SqliteStateRegistry):
+        def get_known_statuses(self):
+            calls.append('get_known_statuses')
+            return super(CountingStateRegistry, self).get_known_statuses()
+
+        def update_status(self, command, status):
+            calls.append('update_status')
+            return super(CountingStateRegistry, self).update_status(command, status)
+
+    class CountingSequence(Sequence):
+        state_registry_cls = CountingStateRegistry
+
+    base = SequenceBase(*[Command(lambda: None, name='command_{}'.format(i)) for i in range(10)])
+    sequence = CountingSequence(base=base)
+    sequence.run(stop_before='command_5')
+    del calls[:]
+
+    # A dry run reads real state once and never writes to the real registry
+    sequence.run(dry_run=True)
+    assert calls == ['get_known_statuses']
+    assert sequence._dry_run_state_registry_instance._storage == dict(
+        ('command_{}'.format(i), SequenceCommand.status_finished) for i in range(5, 10)
+    )
+    del calls[:]
+
+    # Real runs write to the real registry only
+    sequence.run(stop_before='command_7')
+    assert calls.count('update_status') == 2
+    assert sorted(sequence._dry_run_state_registry_instance._storage) == ['command_7', 'command_8', 'command_9']
+
+
+def test_real_status_supersedes_dry_run_status():
+    base = SequenceBase()
+
+    @base.command
+    def first():
+        pass
+
+    sequence = base()
+
+    with sequence.env(dry_run=True):
+        sequence.run()
+        assert sequence['first'].is_finished
+
+    sequence['first'].status = SequenceCommand.status_failed
+
+    with sequence.env(dry_run=True):
+        assert sequence['first'].status == SequenceCommand.status_failed
+
+        sequence['first'].status = SequenceCommand.status_finished
+        assert sequence['first'].status == SequenceCommand.status_finished
+
+    assert sequence['first'].status == SequenceCommand.status_failed
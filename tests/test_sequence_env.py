@@ -1,6 +1,15 @@
+import gc
+import threading
+
 import pytest
 
-from idemseq.sequence import SequenceEnv, get_current_sequence_env, SequenceBase
+from idemseq.base import AttrDict, Options
+from idemseq.command import Command
+from idemseq.exceptions import MissingContextError
+from idemseq.persistence import DryRunStateRegistry
+from idemseq.sequence import (
+    Sequence, SequenceEnv, SequenceRunOptions, SequenceBase, get_current_sequence_env, _sequence_env_stacks,
+)
 
 
 def test_initialises_sequence_env(three_appenders_sequence_base):
@@ -94,3 +103,167 @@ def test_context_is_injected_where_needed():
     assert sequence['needs_x'].is_finished
     assert sequence['needs_y'].is_finished
     assert sequence.is_finished
+
+
+def test_missing_context_is_reported_before_command_runs():
+    dummy = SequenceBase()
+    calls = []
+
+    @dummy.command
+    def needs_x_and_y(x, y, z=3, *args, **kwargs):
+        calls.append((x, y, z))
+
+    sequence = dummy()
+
+    with pytest.raises(MissingContextError) as exc_info:
+        sequence.run(context=dict(x=1))
+    assert exc_info.value.missing == ['y']
+    assert calls == []
+
+    # Dry runs report missing context too
+    with pytest.raises(MissingContextError):
+        sequence.run(dry_run=True)
+
+    with sequence.env(context=dict(x=1)):
+        with sequence.env(context=dict(y=2, kwargs='not bound')):
+            sequence.run(context=dict(x=10))
+
+    assert calls == [(10, 2, 3)]
+
+
+def test_binding_plan(square_command):
+    def func(a, b=2, *args, **kwargs):
+        pass
+
+    plan = Command(func).binding_plan
+    assert plan.names == ('a', 'b')
+    assert plan.required == {'a'}
+    assert plan.defaults == {'b': 2}
+    assert plan.accepts_var_kwargs is True
+
+    assert square_command.binding_plan.names == ('x',)
+    assert square_command.bind({'y': 1}, {'x': 2, 'y': 3}) == ({'x': 2}, [])
+    assert square_command.bind({'y': 1}) == ({}, ['x'])
+
+
+class LinkedSequenceRunOptions(Options):
+    _valid_options = SequenceRunOptions._valid_options
+
+
+class LinkedSequenceEnv(SequenceEnv):
+    context_cls = AttrDict
+    run_options_cls = LinkedSequenceRunOptions
+
+
+@pytest.mark.parametrize('env_cls', [SequenceEnv, LinkedSequenceEnv])
+def test_flattened_and_linked_envs_resolve_the_same(env_cls):
+    envs = [
+        env_cls(sequence_uid='test-envs', context=dict(a=1, b=1), force=True),
+        env_cls(sequence_uid='test-envs', context=dict(b=2), dry_run=True),
+        env_cls(sequence_uid='test-envs', context=dict(c=3), force=False),
+    ]
+    for env in envs:
+        env.push()
+
+    try:
+        top = get_current_sequence_env('test-envs')
+        assert top is envs[-1]
+        assert (top.context.a, top.context.b, top.context.c) == (1, 2, 3)
+        assert top.flat_context() == dict(a=1, b=2, c=3)
+        assert top.run_options.force is False
+        assert top.run_options.dry_run is True
+        assert top.run_options.warn_only is False
+        assert 'warn_only' not in top.run_options
+    finally:
+        for env in reversed(envs):
+            env.pop()
+
+
+def test_deeply_nested_envs():
+    sequence = SequenceBase()()
+
+    envs = []
+    for i in range(2000):
+        env = sequence.env(context={'level_{}'.format(i): i}, force=bool(i % 2))
+        env.push()
+        envs.append(env)
+
+    assert sequence.context.level_0 == 0
+    assert sequence.context.level_1999 == 1999
+    assert sequence.run_options.force is True
+    assert sequence.run_options.dry_run is None
+
+    for env in reversed(envs):
+        env.pop()
+
+    assert 'level_0' not in sequence.context
+
+
+def test_env_stack_is_released_with_sequence():
+    sequence = SequenceBase()()
+    uid = sequence.uid
+
+    with sequence.env(context=dict(x=1)):
+        assert get_current_sequence_env(uid).context.x == 1
+
+    assert uid in _sequence_env_stacks
+    del sequence
+    gc.collect()
+    assert uid not in _sequence_env_stacks
+
+    # An env without a sequence keeps its own stack only while pushed
+    with SequenceEnv(sequence_uid='no-sequence', context=dict(x=2)):
+        assert get_current_sequence_env('no-sequence').context.x == 2
+    assert 'no-sequence' not in _sequence_env_stacks
+
+
+def test_env_stack_is_thread_local():
+    sequence = SequenceBase()(context=dict(x=1))
+    seen = []
+
+    def read_env():
+        try:
+            seen.append(sequence.context.x)
+        except RuntimeError:
+            seen.append(None)
+        with sequence.env(context=dict(x=3)):
+            seen.append(sequence.context.x)
+
+    with sequence.env(context=dict(x=2)):
+        thread = threading.Thread(target=read_env)
+        thread.start()
+        thread.join()
+        assert sequence.context.x == 2
+
+    assert seen == [None, 3]
+    assert sequence.context.x == 1
+
+
+def test_creating_many_sequences_does_not_leak_memory():
+    tracemalloc = pytest.importorskip('tracemalloc')
+
+    class LightSequence(Sequence):
+        state_registry_cls = DryRunStateRegistry
+
+    base = SequenceBase()
+
+    @base.command
+    def noop():
+        pass
+
+    LightSequence(base).run()
+    gc.collect()
+
+    tracemalloc.start()
+    try:
+        allocated_before = tracemalloc.get_traced_memory()[0]
+        for _ in range(1000):
+            LightSequence(base)
+        gc.collect()
+        allocated_after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+    assert len(_sequence_env_stacks) < 1000
+    # A sequence costs a few kilobytes, so keeping them all alive would take megabytes
+    assert allocated_after - allocated_before < 512 * 1024
@@ -0,0 +1,84 @@
+import pytest
+
+from idemseq.command import Command
+from idemseq.persistence import SharedSqliteStateRegistry
+from idemseq.sequence import Sequence, SequenceCommand
+
+
+@pytest.fixture
+def shared_db(tmpdir):
+    return str(tmpdir.join('shared.db'))
+
+
+def test_shared_sqlite_state_registry_keeps_sequences_apart(shared_db):
+    first = SequenceCommand(command=Command(lambda: 1, name='first'))
+    second = SequenceCommand(command=Command(lambda: 2, name='second'))
+
+    reg_a = SharedSqliteStateRegistry('a', database=shared_db)
+    reg_b = SharedSqliteStateRegistry('b', database=shared_db)
+
+    assert reg_a.get_known_statuses() == {}
+    assert reg_a.get_status(first) == SequenceCommand.status_unknown
+
+    reg_a.update_status(first, SequenceCommand.status_finished)
+    reg_b.update_status(first, SequenceCommand.status_failed)
+    reg_b.update_status(second, SequenceCommand.status_finished)
+
+    assert reg_a.get_known_statuses() == {'first': 'finished'}
+    assert reg_b.get_known_statuses() == {'first': 'failed', 'second': 'finished'}
+    assert reg_a.get_status(second) == SequenceCommand.status_unknown
+
+    with pytest.raises(ValueError):
+        reg_a.update_status(first, 'some_invalid_status')
+
+
+def test_shared_sqlite_state_registry_queries_across_sequences(shared_db):
+    first = SequenceCommand(command=Command(lambda: 1, name='first'))
+
+    for i in range(1200):
+        SharedSqliteStateRegistry('seq{:04d}'.format(i), database=shared_db).update_status(
+            first, SequenceCommand.status_failed if i % 100 == 0 else SequenceCommand.status_finished,
+        )
+
+    reg = SharedSqliteStateRegistry('seq0000', database=shared_db)
+
+    assert len(reg.list_sequences()) == 1200
+    assert reg.find_sequences('first', SequenceCommand.status_failed) == [
+        'seq{:04d}'.format(i) for i in range(0, 1200, 100)
+    ]
+    assert reg.find_sequences('second', SequenceCommand.status_failed) == []
+
+    by_sequence = reg.get_known_statuses_by_sequence(['seq{:04d}'.format(i) for i in range(1100, 1300)])
+    assert len(by_sequence) == 100
+    assert by_sequence['seq1100'] == {'first': 'failed'}
+    assert by_sequence['seq1101'] == {'first': 'finished'}
+
+    assert len(reg.get_known_statuses_by_sequence()) == 1200
+
+    plan = reg._connection.execute(
+        'EXPLAIN QUERY PLAN ' + reg._sql['find_sequences'], ('first', 'failed'),
+    ).fetchall()
+    assert 'sequence_steps_name_status' in ' '.join(str(r) for r in plan)
+
+
+def test_shared_sqlite_state_registry_requires_database_and_sequence_id(shared_db):
+    with pytest.raises(ValueError):
+        SharedSqliteStateRegistry('a')
+
+    with pytest.raises(ValueError):
+        SharedSqliteStateRegistry(database=shared_db)
+
+
+def test_sequences_share_database(shared_db, three_appenders_sequence_base):
+    class JobsStateRegistry(SharedSqliteStateRegistry):
+        database = shared_db
+
+    class JobSequence(Sequence):
+        state_registry_cls = JobsStateRegistry
+
+    JobSequence(base=three_appenders_sequence_base, state_registry_name='job1').run()
+    JobSequence(base=three_appenders_sequence_base, state_registry_name='job2').run(stop_before='appender3')
+
+    assert JobSequence(base=three_appenders_sequence_base, state_registry_name='job1').is_finished
+    assert not JobSequence(base=three_appenders_sequence_base, state_registry_name='job2').is_finished
+    assert JobsStateRegistry('job1').find_sequences('appender3', SequenceCommand.status_finished) == ['job1']
@@ -23,3 +23,133 @@ def test_sqlite_step_registry():
 
     with pytest.raises(ValueError):
         reg.update_status(step, 'some_invalid_status')
+
+
+def test_sqlite_step_registry_batches_finished_statuses(tmpdir):
+    db = str(tmpdir.join('batched.db'))
+    steps = [SequenceCommand(command=Command(lambda: 1, name='step{}'.format(i))) for i in range(5)]
+
+    reg = SqliteStateRegistry(db, batch_writes=True, flush_every=3)
+    other = SqliteStateRegistry(db)
+
+    reg.update_status(steps[0], SequenceCommand.status_finished)
+    reg.update_status(steps[1], SequenceCommand.status_finished)
+
+    # Pending statuses are visible to the registry that holds them, but not yet written
+    assert reg.get_status(steps[0]) == SequenceCommand.status_finished
+    assert reg.get_known_statuses() == {'step0': 'finished', 'step1': 'finished'}
+    assert other.get_known_statuses() == {}
+
+    reg.update_status(steps[2], SequenceCommand.status_finished)
+    assert other.get_known_statuses() == {'step0': 'finished', 'step1': 'finished', 'step2': 'finished'}
+
+    reg.update_status(steps[3], SequenceCommand.status_finished)
+    assert 'step3' not in other.get_known_statuses()
+
+    reg.flush()
+    assert other.get_status(steps[3]) == SequenceCommand.status_finished
+
+
+def test_sqlite_step_registry_writes_non_finished_statuses_immediately(tmpdir):
+    db = str(tmpdir.join('batched.db'))
+    step0 = SequenceCommand(command=Command(lambda: 1, name='step0'))
+    step1 = SequenceCommand(command=Command(lambda: 1, name='step1'))
+
+    reg = SqliteStateRegistry(db, batch_writes=True)
+    other = SqliteStateRegistry(db)
+
+    reg.update_status(step0, SequenceCommand.status_finished)
+    assert other.get_known_statuses() == {}
+
+    reg.update_status(step1, SequenceCommand.status_failed)
+    assert other.get_known_statuses() == {'step0': 'finished', 'step1': 'failed'}
+
+    reg.update_status(step0, SequenceCommand.status_unknown)
+    assert other.get_status(step0) == SequenceCommand.status_unknown
+
+
+def test_sequence_run_flushes_batched_statuses(tmpdir, three_appenders_sequence_base):
+    from idemseq.sequence import Sequence
+
+    class BatchedSqliteStateRegistry(SqliteStateRegistry):
+        batch_writes = True
+
+    class BatchedSequence(Sequence):
+        state_registry_cls = BatchedSqliteStateRegistry
+
+    db = str(tmpdir.join('batched.db'))
+    sequence = BatchedSequence(base=three_appenders_sequence_base, state_registry_name=db)
+
+    sequence.run()
+    assert SqliteStateRegistry(db).get_known_statuses() == {
+        'appender1': 'finished',
+        'appender2': 'finished',
+        'appender3': 'finished',
+    }
+
+
+def test_sqlite_step_registry_uses_wal_and_does_not_block_readers(tmpdir):
+    import sqlite3
+
+    db = str(tmpdir.join('wal.db'))
+    step = SequenceCommand(command=Command(lambda: 1, name='first'))
+
+    writer = SqliteStateRegistry(db)
+    writer.update_status(step, SequenceCommand.status_finished)
+    assert writer._connection.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+    # Hold a write transaction open, readers still see the last committed state
+    writer._connection.execute('BEGIN IMMEDIATE')
+    writer._connection.execute("UPDATE steps SET status = 'failed'")
+    try:
+        assert SqliteStateRegistry(db).get_known_statuses() == {'first': 'finished'}
+    finally:
+        writer._connection.rollback()
+
+    conn = sqlite3.connect(db)
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == SqliteStateRegistry._schema_version
+
+
+def test_sqlite_step_registry_opens_database_created_without_schema_version(tmpdir):
+    import sqlite3
+
+    db = str(tmpdir.join('legacy.db'))
+    conn = sqlite3.connect(db)
+    conn.execute('CREATE TABLE steps (name varchar primary key, status varchar);')
+    conn.execute("INSERT INTO steps (name, status) VALUES ('first', 'finished')")
+    conn.commit()
+    conn.close()
+
+    assert SqliteStateRegistry(db).get_known_statuses() == {'first': 'finished'}
+
+
+def test_flush_error_does_not_mask_command_error(tmpdir, caplog):
+    from idemseq.sequence import Sequence, SequenceBase
+
+    class FailingFlushStateRegistry(SqliteStateRegistry):
+        batch_writes = True
+
+        def flush(self):
+            raise RuntimeError('flush failed')
+
+    class FailingFlushSequence(Sequence):
+        state_registry_cls = FailingFlushStateRegistry
+
+    base = SequenceBase()
+
+    @base.command
+    def fails():
+        raise ValueError('command failed')
+
+    sequence = FailingFlushSequence(base=base, state_registry_name=str(tmpdir.join('failing.db')))
+
+    with pytest.raises(ValueError):
+        sequence.run()
+    assert any(
+        record.exc_info and record.exc_info[0] is RuntimeError for record in caplog.records
+    )
+
+    # Without a command error, the flush error is raised
+    with pytest.raises(RuntimeError):
+        with sequence._status_snapshot():
+            pass
@@ -0,0 +1,159 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from idemseq.cancellation import current_cancellation
+from idemseq.exceptions import CancelledError, CommandTimeoutError
+from idemseq.metrics import InMemoryMetrics
+from idemseq.persistence import SqliteStateRegistry
+from idemseq.sequence import Sequence, SequenceBase, SequenceCommand
+
+
+class HistorySqliteStateRegistry(SqliteStateRegistry):
+    keep_history = True
+
+
+class HistorySequence(Sequence):
+    state_registry_cls = HistorySqliteStateRegistry
+
+
+def create_hanging_base(events, **options):
+    base = SequenceBase()
+
+    @base.command(**options)
+    def hanging():
+        events.append('started')
+        try:
+            while True:
+                current_cancellation().raise_if_cancelled()
+                time.sleep(0.01)
+        except CancelledError:
+            events.append('cancelled')
+            raise
+
+    @base.command(depends_on=[])
+    def independent():
+        events.append('independent')
+
+    return base
+
+
+def wait_for(condition, timeout=1):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_command_which_times_out_is_cancelled_and_marked(tmpdir):
+    events = []
+    sequence = HistorySequence(create_hanging_base(events, timeout=0.1), str(tmpdir.join('timeouts.db')))
+
+    started = time.time()
+    with pytest.raises(CommandTimeoutError) as exc_info:
+        sequence.run()
+    assert 0.1 <= time.time() - started < 1
+    assert exc_info.value.timeout == 0.1
+
+    assert sequence['hanging'].status == SequenceCommand.status_timed_out
+    assert not sequence['independent'].is_finished
+    assert wait_for(lambda: events == ['started', 'cancelled'])
+
+    history = sequence._real_state_registry.get_history()
+    assert [(a['status'], a['error_type']) for a in history] == [
+        (SequenceCommand.status_failed, 'CommandTimeoutError'),
+    ]
+    assert history[0]['duration'] >= 0.1
+
+
+def test_timeout_run_option_and_on_timeout_policy():
+    events = []
+    sequence = create_hanging_base(events)()
+
+    with pytest.raises(CommandTimeoutError):
+        sequence.run(timeout=0.05)
+
+    sequence.run(timeout=0.05, on_timeout='continue')
+    assert sequence['hanging'].status == SequenceCommand.status_timed_out
+    assert sequence['independent'].is_finished
+
+
+@pytest.mark.parametrize('max_workers', [None, 2])
+def test_on_timeout_continue_skips_only_dependent_commands(max_workers):
+    events = []
+    base = create_hanging_base(events, timeout=0.05)
+
+    @base.command
+    def follower():
+        events.append('follower')
+
+    @base.command(depends_on=['follower'])
+    def follower_of_follower():
+        events.append('follower_of_follower')
+
+    @base.command(depends_on=['independent'])
+    def other():
+        events.append('other')
+
+    metrics = InMemoryMetrics()
+    sequence = base()
+    sequence.metrics = metrics
+    sequence.run(on_timeout='continue', max_workers=max_workers)
+
+    assert sequence['hanging'].status == SequenceCommand.status_timed_out
+    assert sequence['independent'].is_finished
+    assert sequence['other'].is_finished
+    assert 'follower' not in events
+    assert 'follower_of_follower' not in events
+    assert metrics.snapshot()['skips'] == {
+        'follower': {'dependency_timed_out': 1},
+        'follower_of_follower': {'dependency_timed_out': 1},
+    }
+
+
+def test_commands_raising_timeout_error_do_not_time_out():
+    base = SequenceBase()
+
+    @base.command(timeout=10)
+    def first():
+        raise socket.timeout('not a timeout of the command')
+
+    sequence = base()
+    with pytest.raises(socket.timeout):
+        sequence.run()
+    assert sequence['first'].status != SequenceCommand.status_timed_out
+
+
+def test_concurrent_run_does_not_wait_for_commands_which_timed_out():
+    base = SequenceBase()
+    events = []
+    release = threading.Event()
+
+    @base.command(timeout=0.1)
+    def stubborn():
+        # Ignores cancellation
+        release.wait(2)
+
+    @base.command(depends_on=[])
+    def quick():
+        events.append('quick')
+
+    sequence = base()
+    started = time.time()
+    with pytest.raises(CommandTimeoutError):
+        sequence.run(max_workers=2)
+    assert time.time() - started < 1
+    assert sequence['stubborn'].status == SequenceCommand.status_timed_out
+    assert sequence['quick'].is_finished
+    release.set()
+
+    # Timeouts count from when a worker starts the command
+    events = []
+    sequence = create_hanging_base(events, timeout=0.1)()
+    sequence.run(max_workers=1, on_timeout='continue')
+    assert sequence['independent'].is_finished
+    assert sequence['hanging'].status == SequenceCommand.status_timed_out
+    assert wait_for(lambda: 'cancelled' in events)
+